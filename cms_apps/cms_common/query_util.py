@@ -0,0 +1,29 @@
+from django.conf import settings
+from django.db import connection
+
+
+class QueryCounter(object):
+    """Counts the queries run inside a "with" block, also when settings.DEBUG is False
+
+        with QueryCounter() as counter:
+            ...
+        print counter.num_queries
+    """
+    def __init__(self, using_connection=None):
+        self.connection = using_connection or connection
+        self.num_queries = 0
+        self.queries = []
+
+    def __enter__(self):
+        self.old_use_debug_cursor = self.connection.use_debug_cursor
+        self.connection.use_debug_cursor = True     # log the queries in connection.queries
+        self.start = len(self.connection.queries)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.queries = self.connection.queries[self.start:]
+        self.num_queries = len(self.queries)
+        self.connection.use_debug_cursor = self.old_use_debug_cursor
+        if not self.old_use_debug_cursor and not settings.DEBUG:
+            del self.connection.queries[self.start:]    # the queries were only logged for the count
+        return False
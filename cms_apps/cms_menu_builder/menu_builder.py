@@ -12,16 +12,24 @@ Purpose: To build navigation where each Node is replaced by the appropriate subc
             > node_obj.get_absolute_url
                 - where the node_obj could be a Node, Page, PageDirectLink, etc
 """
+from django.conf import settings
+from django.core.exceptions import ObjectDoesNotExist
 from django.db.models import Q
+from django.db.models.query import QuerySet
 from cms_common.msg_util import *
-from cms_menu_node.models import Node
+from cms_common.query_util import QueryCounter
+from cms_menu_builder.menu_stats import MenuBuildStats, NULL_PHASE, is_menu_stats_enabled, send_menu_stats
+from cms_menu_node.models import Node, BREADCRUMB_SEPARATOR, STR_NO_NODE_URL
+from cms_menu_node.tree_builder import get_node_subclass, get_node_subclass_accessors
+from cms_menu_node.tree_snapshot import get_tree_snapshot
 from cms_page.models import *
 
 class NodeProcessor:
     """Purpose: To build navigation where each Node has appropriate subclass attached.
     Trying to do this with fewer queries than a reverse lookup for --each-- node
 
-    Instead, pull each subclass type based on the node ids in the queryset
+    Instead, join each node to its subclass row in the same query 
+    (subclasses are looked up in the cms_menu_node registry--see tree_builder.register_node_subclass)
     
     Also, adds: "selected_node" and "active_path" attributes
     
@@ -31,70 +39,82 @@ class NodeProcessor:
         
     """
     @staticmethod
-    def add_node_subclasses(node_qs, active_path_ids=[]):
+    def add_node_subclasses(node_qs, active_path_ids=[], stats=None, query_phase='menu_query', join_subclasses=True):
+        """stats: MenuBuildStats to record the query (as query_phase), subclass and flag phases
+        join_subclasses: False to keep the Node rows (links from Node.cached_url, labels from Node.name)"""
         if node_qs is None:
             return node_qs
 
+        def stats_phase(phase_name):
+            if stats is None:
+                return NULL_PHASE
+            return stats.phase(phase_name)
+
         if active_path_ids is None:
             active_path_ids = []
-        # retrieve node subclass names.  e.g.: "Page", "PageDirect", "PageCustomView", etc
-        subclass_dict = {}  # { subclass name : 1 }
-        map(lambda x: subclass_dict.update({x.subclass_name:1}), node_qs)
+            
+        # reverse one-to-one names of the subclasses, e.g. { 'Page' : 'page', 'PageDirectLink' : 'pagedirectlink' }
+        subclass_accessors = get_node_subclass_accessors(Node)
 
-        # retrieve node ids
-        node_ids = map(lambda x: x.id, node_qs)
+        # retrieve the nodes, each joined to its subclass row (one query, evaluated once)
+        with stats_phase(query_phase):
+            if isinstance(node_qs, QuerySet) and join_subclasses:
+                nodes = list(node_qs.select_related('parent', *subclass_accessors.values()))
+            else:
+                nodes = list(node_qs)
+        if stats is not None:
+            stats.add_rows(query_phase, len(nodes))
+        
+        if not join_subclasses:
+            with stats_phase('flags'):
+                return set_menu_item_flags(nodes, active_path_ids)
+        
+        with stats_phase('subclasses'):
+            node_subclass_objects = NodeProcessor.get_node_subclass_objects(nodes, subclass_accessors\
+                                                        , isinstance(node_qs, QuerySet))
+                    
+        # Iterate through the nodes and, if subclass available, REPLACE with the appropriate 'subclass'
+        formatted_nodes = map(lambda nd: node_subclass_objects.get(nd.id, nd), nodes)
+        with stats_phase('flags'):
+            return set_menu_item_flags(formatted_nodes, active_path_ids)
 
+    @staticmethod
+    def get_node_subclass_objects(nodes, subclass_accessors, subclasses_joined=True):
+        """subclasses_joined: False if the nodes weren't fetched with the subclass rows"""
+        if subclasses_joined:
+            joined_nodes = nodes
+        else:
+            # a list of nodes, e.g. breadcrumbs: fetch the subclass rows in one query
+            subclass_node_ids = [nd.id for nd in nodes if nd.subclass_name]
+            joined_nodes = []
+            if subclass_node_ids:
+                joined_nodes = Node.objects.select_related(*subclass_accessors.values()).filter(id__in=subclass_node_ids)
+        
         # build a lookup of Node subclass instances { node_id : instance of subclass }; 
         #   e.g. { 31: <Page: yellow>, 32: <Page: banana>,29: <PageDirect: www.google.com>, 30: <Page: cherry>}
         #
         node_subclass_objects = {}  
-        for subclass_name in subclass_dict.keys():  # iterate through node subclass names
-
-            if (not subclass_name) or subclass_name == '':
-                continue    # go to the next subclass name
-            page_obj_type = eval(subclass_name)     # e.g. eval('Page')
-            # retrieve subclass instances
-            subclass_object_qs = page_obj_type.objects.select_related().filter(id__in=node_ids, visible=True) 
-            # put subclass instances into lookup
-            for subclass_obj in subclass_object_qs:  
-                node_subclass_objects.update({ subclass_obj.id: subclass_obj })
-        # Iterate through the nodes and, if subclass available, REPLACE with the appropriate 'subclass'
-        #
-        formatted_nodes = []
-        menu_level_parent_lu = {}   # { menu_level : node }  e.g. { 2 : node obj, 3: node obj}
-        for nd in node_qs:
-            # if subclass is available, replace the node with its subclass
-            #formatted_nodes.append(node_subclass_objects.get(nd.id, nd))
-            subclass_obj = node_subclass_objects.get(nd.id, None)
-            if subclass_obj:
-                formatted_node = subclass_obj
-            else:
-                # subclass not found, use the Node
-                formatted_node = nd
-
-            menu_level_parent_lu.update({ formatted_node.menu_level : formatted_node })
-            
-            formatted_node.is_node_first_sibling = formatted_node.is_first_sibling_check(menu_level_parent_lu.get(formatted_node.menu_level-1))
-            formatted_node.is_node_last_sibling = formatted_node.is_last_sibling_check(menu_level_parent_lu.get(formatted_node.menu_level-1))
-            
-
-            if formatted_node.id in active_path_ids[1:]:
-                formatted_node.active_branch = True
-            elif formatted_node.parent_node_id in active_path_ids[1:]:
-                formatted_node.active_branch = True
-            else:
-                formatted_node.active_branch = False
-            
-            if formatted_node.id in active_path_ids:
-                formatted_node.active_path = True
-            else:
-                formatted_node.active_path = False
-                
-            if len(active_path_ids) > 0 and nd.id == active_path_ids[-1]:
-                formatted_node.selected_node = True
-                
-            formatted_nodes.append(formatted_node)      
-        return formatted_nodes
+        indirect_subclass_ids = {}      # { subclass name : [node id, ...] } subclass of a subclass, e.g. of Page
+        for nd in joined_nodes:
+            if not nd.subclass_name:
+                continue
+            accessor = subclass_accessors.get(nd.subclass_name, None)
+            if accessor is None:
+                indirect_subclass_ids.setdefault(nd.subclass_name, []).append(nd.id)
+                continue
+            try:
+                subclass_obj = getattr(nd, accessor)
+            except ObjectDoesNotExist:
+                subclass_obj = None
+            if subclass_obj is not None:
+                node_subclass_objects[nd.id] = subclass_obj
+        
+        for subclass_name, node_ids in indirect_subclass_ids.items():
+            node_subclass = get_node_subclass(subclass_name)
+            if node_subclass is not None:
+                for subclass_obj in node_subclass.objects.filter(id__in=node_ids, visible=True):
+                    node_subclass_objects[subclass_obj.id] = subclass_obj
+        return node_subclass_objects
 
 
 class BreadcrumbHandler:
@@ -122,12 +142,185 @@ class BreadcrumbHandler:
         
 
         
+# Node attributes copied to a MenuItem, and the flags set by set_menu_item_flags()
+MENU_ITEM_NODE_ATTRS = ('id', 'name', 'slug', 'menu_level', 'left_val', 'right_val', 'parent_node_id', 'subclass_name', 'is_root', 'visible'\
+                        , 'link_target', 'breadcrumb_path')
+MENU_ITEM_FLAGS = ('is_node_first_sibling', 'is_node_last_sibling', 'active_branch', 'active_path', 'selected_node')
+
+class MenuItem(object):
+    """Compact menu item: only what the menu templates use--name, URL, level and the flags.
+    A fraction of the size of a Page (no content, teaser, author, etc)
+    
+    MenuItem(node) copies a Node, or subclass, and computes its URL once
+    """
+    __slots__ = MENU_ITEM_NODE_ATTRS + MENU_ITEM_FLAGS + ('label', 'url')
+    
+    def __init__(self, node=None):
+        for attr in MENU_ITEM_FLAGS:
+            setattr(self, attr, False)
+        self.label = None
+        self.url = None
+        self.breadcrumb_path = ''
+        if node is None:
+            return
+            
+        for attr in MENU_ITEM_NODE_ATTRS:
+            setattr(self, attr, getattr(node, attr))
+        for attr in MENU_ITEM_FLAGS:
+            setattr(self, attr, bool(getattr(node, attr, False)))
+        self.label = unicode(node)      # e.g. a Page shows its title
+        self.url = getattr(node, 'cached_url', '') or node.get_absolute_url()
+
+    def __unicode__(self):
+        if self.label is None:
+            return self.name
+        return self.label
+
+    def __str__(self):
+        return self.__unicode__().encode('utf-8')
+
+    def get_absolute_url(self):
+        return self.url
+
+    def __getstate__(self):
+        """With __slots__ and no __dict__, pickle protocols 0 and 1 (e.g. python-memcached) need the state as a dict"""
+        state = {}
+        for cls in type(self).__mro__:
+            for attr in getattr(cls, '__slots__', ()):
+                if hasattr(self, attr):
+                    state[attr] = getattr(self, attr)
+        return state
+
+    def __setstate__(self, state):
+        for attr, value in state.items():
+            setattr(self, attr, value)
+
+    def breadcrumb(self, exclude_leaf_node=False):
+        """Same as Node.breadcrumb(): from the stored breadcrumb_path, no query.
+        If it isn't set yet, one query"""
+        sep = ' %s ' % BREADCRUMB_SEPARATOR
+        if self.breadcrumb_path:
+            if exclude_leaf_node:
+                return self.breadcrumb_path.rsplit(sep, 1)[0]
+            return self.breadcrumb_path
+        if self.left_val < 1:       # not on the MPTT tree: the Node follows the parent relationships
+            return Node.objects.get(id=self.id).breadcrumb(exclude_leaf_node)
+        if exclude_leaf_node:
+            qs = Node.objects.filter(left_val__lt=self.left_val, right_val__gt=self.right_val)
+        else:
+            qs = Node.objects.filter(left_val__lte=self.left_val, right_val__gte=self.right_val)
+        return sep.join(qs.order_by('left_val').values_list('name', flat=True))
+
+    def breadcrumb_without_leaf(self):
+        return self.breadcrumb(exclude_leaf_node=True)
+
+
+class SnapshotMenuItem(MenuItem):
+    """A menu item built from the tree snapshot (cms_menu_node.tree_snapshot)--no query needed.
+
+    get_absolute_url() needs the subclass (e.g. Page) and loads it on first use
+    """
+    __slots__ = ('snapshot', 'idx', 'node_obj')
+    
+    def __init__(self, snapshot, idx):
+        super(SnapshotMenuItem, self).__init__()
+        self.snapshot = snapshot
+        self.idx = idx
+        self.node_obj = None
+        
+        self.id = snapshot.ids[idx]
+        self.name = snapshot.names[idx]
+        self.slug = snapshot.slugs[idx]
+        self.menu_level = snapshot.menu_levels[idx]
+        self.left_val = snapshot.left_vals[idx]
+        self.right_val = snapshot.right_vals[idx]
+        self.subclass_name = snapshot.get_subclass_name(idx)
+        self.link_target = snapshot.link_targets[idx]
+        self.label = snapshot.menu_labels[idx] or None   # None: the name
+        self.url = snapshot.cached_urls[idx] or None     # None: loaded by get_absolute_url()
+        if not self.subclass_name:
+            self.url = STR_NO_NODE_URL
+        self.visible = True
+
+        parent_idx = snapshot.get_parent(idx)
+        self.is_root = parent_idx is None
+        if parent_idx is None:
+            self.parent_node_id = -1
+        else:
+            self.parent_node_id = snapshot.ids[parent_idx]
+
+    def breadcrumb(self, exclude_leaf_node=False):
+        sep = ' %s ' % BREADCRUMB_SEPARATOR
+        return sep.join([self.snapshot.names[i] for i in self.snapshot.get_ancestors(self.idx, include_self=not exclude_leaf_node)])
+
+    def __getstate__(self):
+        """The loaded Node isn't pickled, get_node() loads it again"""
+        state = super(SnapshotMenuItem, self).__getstate__()
+        state['node_obj'] = None
+        return state
+
+    def get_node(self):
+        """The Node--or its subclass, e.g. Page.  One or two queries, the first time"""
+        if self.node_obj is None:
+            node = Node.objects.get(id=self.id)
+            self.node_obj = node.get_subclass_obj() or node
+        return self.node_obj
+
+    def get_absolute_url(self):
+        if self.url is None:
+            self.url = self.get_node().get_absolute_url()
+        return self.url
+
+
+def set_menu_item_flags(menu_items, active_path_ids=[]):
+    """Adds the sibling and active path attributes to each menu item (Node, subclass or SnapshotMenuItem):
+        is_node_first_sibling, is_node_last_sibling, active_branch, active_path, selected_node
+    """
+    if active_path_ids is None:
+        active_path_ids = []
+    active_path_id_set = set(active_path_ids)
+    active_branch_id_set = set(active_path_ids[1:])
+    selected_node_id = None
+    if len(active_path_ids) > 0:
+        selected_node_id = active_path_ids[-1]
+        
+    menu_level_parent_lu = {}   # { menu_level : item }  e.g. { 2 : node obj, 3: node obj}
+    for item in menu_items:
+        menu_level_parent_lu[item.menu_level] = item
+        
+        # On the MPTT menu tree, is the item the first/last child of the last item one level up?
+        parent_item = menu_level_parent_lu.get(item.menu_level-1)
+        item.is_node_first_sibling = False
+        item.is_node_last_sibling = False
+        if parent_item is not None and item.left_val > -1 and parent_item.left_val > -1:
+            item.is_node_first_sibling = (item.left_val - 1) == parent_item.left_val
+            item.is_node_last_sibling = (item.right_val + 1) == parent_item.right_val
+
+        item.active_branch = item.id in active_branch_id_set or item.parent_node_id in active_branch_id_set
+        item.active_path = item.id in active_path_id_set
+        item.selected_node = item.id == selected_node_id
+    return menu_items
+
+
 class MenuBuilder:
     """Used to build various menus and add 'active_path' attribute
     kwargs:  
         selected_node   (default: None)
         include_root_node (default: True)
         breadcrumb_exclude_selected_node (default: False)
+        use_tree_snapshot (default: False) - build from the tree snapshot, no queries 
+                    beyond the tree version check.  Menu items are SnapshotMenuItem objects
+        tree_snapshot (default: None) - snapshot to use, e.g. one loaded for the request
+        compact_menu_items (default: False) - menu items and breadcrumbs are MenuItem objects
+                    instead of Node/Page instances
+        breadcrumb_source (default: None) - MenuBuilder for the same selected node, its breadcrumbs
+                    and active path are reused (see cms_menu_builder/request_menus.py)
+        build_menu_items (default: True) - False: only the breadcrumbs and active path
+        count_queries (default: False) - set self.num_queries, the queries used to build the menu
+        join_subclasses (default: settings.CMS_MENU_JOIN_SUBCLASSES or True) - False: menu items are
+                    Node rows, with the link from Node.cached_url and the label from Node.name
+        collect_stats (default: settings.CMS_MENU_STATS) - set self.stats, the queries, rows and time 
+                    of each phase (see cms_menu_builder/menu_stats.py)
     """
     def __init__(self, **kwargs):
         self.selected_node = kwargs.get('selected_node', None)  
@@ -137,21 +330,74 @@ class MenuBuilder:
         self.is_mobile_browser = kwargs.get('is_mobile_browser', False)
         
         self.is_left_menu = kwargs.get('is_left_menu', False)
+        self.compact_menu_items = kwargs.get('compact_menu_items', False)
+        self.join_subclasses = kwargs.get('join_subclasses', getattr(settings, 'CMS_MENU_JOIN_SUBCLASSES', True))
+        
+        # another MenuBuilder, same selected node: reuse its breadcrumbs and active path
+        self.breadcrumb_source = kwargs.get('breadcrumb_source', None)
         
+        self.tree_snapshot = kwargs.get('tree_snapshot', None)
+        if self.tree_snapshot is None and kwargs.get('use_tree_snapshot', False):
+            self.tree_snapshot = get_tree_snapshot()
+        self.selected_idx = None
+        if self.tree_snapshot is not None and self.selected_node is not None:
+            self.selected_idx = self.tree_snapshot.get_index(self.selected_node.id)
+            if self.selected_idx is None:
+                self.tree_snapshot = None       # selected node isn't on the tree, use the queries
         
         
         self.breadcrumb_nodes = []
         self.last_breadcrumb_string = None
         
         self.active_path_ids = []
+        self.active_path_nodes = []     # root to selected node, fetched once by set_breadcrumb_nodes
         self.menu_items = []
-        if self.build_full_tree_to_level3:
+        
+        self.stats = None
+        if kwargs.get('collect_stats', False) or is_menu_stats_enabled():
+            self.stats = MenuBuildStats(self.get_menu_name(kwargs.get('build_menu_items', True)))
+        
+        # count_queries=True: self.num_queries is the number of queries used to build the menu
+        self.num_queries = None
+        if kwargs.get('count_queries', False):
+            with QueryCounter() as query_counter:
+                self.build(kwargs.get('build_menu_items', True))
+            self.num_queries = query_counter.num_queries
+        else:
+            self.build(kwargs.get('build_menu_items', True))
+            
+        if self.stats is not None:
+            send_menu_stats(self.stats)
+            
+    def get_menu_name(self, build_menu_items=True):
+        if not build_menu_items:
+            return 'breadcrumb'
+        elif self.build_full_tree_to_level3:
+            return 'level3'
+        elif self.is_left_menu:
+            return 'left'
+        return 'top'
+        
+    def stats_phase(self, phase_name):
+        """with self.stats_phase('menu_query'): ...  -- records the phase if stats are on"""
+        if self.stats is None:
+            return NULL_PHASE
+        return self.stats.phase(phase_name)
+            
+    def build(self, build_menu_items=True):
+        if not build_menu_items:
+            self.set_breadcrumb_nodes()     # breadcrumbs and active path only
+        elif self.build_full_tree_to_level3:
             self.build_menu_through_level3()
         elif self.is_left_menu:
             self.build_left_menu()  # minimum: selected L2, all L3 under L2
             #self.build_the_menu()
         else:
             self.build_the_menu()
+            
+        if self.compact_menu_items and self.tree_snapshot is None:
+            self.menu_items = map(MenuItem, self.menu_items)
+            self.breadcrumb_nodes = map(MenuItem, self.breadcrumb_nodes)
     
     @staticmethod
     def get_default_menu_items(build_full_tree_to_level3=False):
@@ -210,15 +456,19 @@ class MenuBuilder:
         return self.menu_items
     
     def build_menu_through_level3(self):
+        if self.tree_snapshot is not None:
+            return self.build_menu_through_level3_from_snapshot()
+        
         # step 1: build the breadcrumb trail, also sets active_path_ids
         self.set_breadcrumb_nodes()
         
         # step 2: get the menu items!
         # 2a: get L2 menu items
-        l1_to_l3_menu_items = Node.objects.select_related('parent').filter(visible=True\
+        l1_to_l3_menu_items = Node.objects.select_related('parent').filter(visible=True, left_val__gt=0\
                 , menu_level__lte=5).order_by('left_val', 'sibling_order')
 
-        self.menu_items = NodeProcessor.add_node_subclasses(l1_to_l3_menu_items, self.active_path_ids)
+        self.menu_items = NodeProcessor.add_node_subclasses(l1_to_l3_menu_items, self.active_path_ids, self.stats\
+                                                    , join_subclasses=self.join_subclasses)
 
         # check if we need to go below L3
         if self.selected_node is None or self.active_path_ids in (None, [],):
@@ -241,11 +491,15 @@ class MenuBuilder:
         if self.selected_node and self.selected_node.menu_level == item_num:   
             return self.selected_node  
             
-        if self.active_path_ids and len(self.active_path_ids) >= item_num:   
-            try:
-                return Node.objects.get(visible=True, id=self.active_path_ids[item_num-1])
-            except:
-                pass
+        if item_num < 1 or len(self.active_path_ids) < item_num:
+            return None
+            
+        if self.tree_snapshot is not None:
+            return SnapshotMenuItem(self.tree_snapshot, self.tree_snapshot.get_index(self.active_path_ids[item_num-1]))
+            
+        # fetched with the breadcrumbs, no query
+        if len(self.active_path_nodes) >= item_num:
+            return self.active_path_nodes[item_num-1]
 
         return None
         
@@ -270,14 +524,18 @@ class MenuBuilder:
             - selected node siblings 
             - selected node descendants one level below it
         """
+        if self.tree_snapshot is not None:
+            return self.build_left_menu_from_snapshot()
+            
         # step 1: build the breadcrumb trail, also sets active_path_ids
         self.set_breadcrumb_nodes()
 
         # Pull the L2 menu item on the active path (if it exists)
-        l2_node_of_active_path = self.get_l2_menu_item_on_active_path()
+        with self.stats_phase('active_path'):
+            l2_node_of_active_path = self.get_l2_menu_item_on_active_path()
 
         # step 2: get the menu items!
-        qs1 = Node.objects.select_related('parent').filter(visible=True)
+        qs1 = Node.objects.select_related('parent').filter(visible=True, left_val__gt=0)     # on the tree
         if self.selected_node and l2_node_of_active_path:
             # Show at least the 3rd menu level, more if node selected is fourth or more
             menu_level_to_check = max(3, self.selected_node.menu_level)
@@ -289,9 +547,10 @@ class MenuBuilder:
             # A bit messy, show left menu for L3 to L6
             #
             if self.selected_node.menu_level > 3:        # greater than L3
-                qclauses.append(Q(parent=self.selected_node.parent))  # siblings 
+                qclauses.append(Q(parent=self.selected_node.parent_id))  # siblings 
                 
-                l3_node_of_active_path = self.get_l3_menu_item_on_active_path()
+                with self.stats_phase('active_path'):
+                    l3_node_of_active_path = self.get_l3_menu_item_on_active_path()
                 #print 'l3_node_of_active_path', l3_node_of_active_path
                 if l3_node_of_active_path:
                     qclauses.append(Q(parent=l3_node_of_active_path))       # siblings of L3
@@ -339,7 +598,8 @@ class MenuBuilder:
 
         all_menu_items = menu_items.order_by('left_val', 'sibling_order').distinct()
 
-        self.menu_items = NodeProcessor.add_node_subclasses(all_menu_items, self.active_path_ids)
+        self.menu_items = NodeProcessor.add_node_subclasses(all_menu_items, self.active_path_ids, self.stats\
+                                                    , join_subclasses=self.join_subclasses)
 
 
     def build_the_menu(self):
@@ -348,14 +608,18 @@ class MenuBuilder:
             - selected node siblings 
             - selected node descendants one level below it
         """
+        if self.tree_snapshot is not None:
+            return self.build_the_menu_from_snapshot()
+            
         # step 1: build the breadcrumb trail, also sets active_path_ids
         self.set_breadcrumb_nodes()
         
         # Pull the L2 menu item on the active path (if it exists)
-        l2_node_of_active_path = self.get_l2_menu_item_on_active_path()
+        with self.stats_phase('active_path'):
+            l2_node_of_active_path = self.get_l2_menu_item_on_active_path()
        
         # step 2: get the menu items!
-        qs1 = Node.objects.select_related('parent').filter(visible=True)
+        qs1 = Node.objects.select_related('parent').filter(visible=True, left_val__gt=0)     # on the tree
         if self.selected_node and l2_node_of_active_path:
             # menu_level 2 | siblings and above on active path | selected node direct descendents 
             menu_items = qs1.filter(\
@@ -374,7 +638,8 @@ class MenuBuilder:
 
         all_menu_items = menu_items.order_by('left_val', 'sibling_order').distinct()
 
-        self.menu_items = NodeProcessor.add_node_subclasses(all_menu_items, self.active_path_ids)
+        self.menu_items = NodeProcessor.add_node_subclasses(all_menu_items, self.active_path_ids, self.stats\
+                                                    , join_subclasses=self.join_subclasses)
         
        
        
@@ -386,7 +651,7 @@ class MenuBuilder:
         if (level is None) or str(level).isdigit() is False: 
             return None
 
-        qs1 = Node.objects.select_related('parent').filter(visible=True)
+        qs1 = Node.objects.select_related('parent').filter(visible=True, left_val__gt=0)     # on the tree
 
         if include_root_node:
             qs2 = qs1.filter(Q(menu_level=level) | Q(menu_level=1)).order_by('left_val', 'sibling_order')
@@ -426,7 +691,7 @@ class MenuBuilder:
         #
         # - Anything where parent is selected node (one step lower than initial part of query)
         #
-        qs = Node.objects.filter(visible=True).filter( \
+        qs = Node.objects.filter(visible=True, left_val__gt=0).filter( \
                 Q(left_val__gt=level2_of_active_path.left_val,\
                     left_val__lt=level2_of_active_path.right_val,\
                     menu_level__lte=menu_level_to_check) |\
@@ -442,23 +707,136 @@ class MenuBuilder:
          To exclude the selected node, the last node in the breadcrumb trail,
          set breadcrumb_exclude_selected_node to True
         """
+        if self.breadcrumb_source is not None:
+            return self.set_breadcrumb_nodes_from_source()
+        if self.tree_snapshot is not None:
+            return self.set_breadcrumb_nodes_from_snapshot()
+            
         self.breadcrumb_nodes = []
         selected_node = self.selected_node
         if selected_node is None:
             return None
 
         # include the selected node, neeeded for active_path_ids
-        qs = Node.objects.select_related().filter(visible=True\
+        #   one query: the ancestor chain, with subclasses, serves the breadcrumbs, 
+        #   active_path_ids and get_menu_item_on_active_path()
+        #   the ancestor ids are primary key lookups.  On the tree without stored ancestor ids, use the
+        #   left/right range.  (not on the tree: left_val is -1, the range would match every detached node)
+        if selected_node.left_val > 0 and not selected_node.ancestor_ids:
+            qs = Node.objects.filter(visible=True\
                     , left_val__lte=selected_node.left_val\
                     , right_val__gte=selected_node.right_val).order_by('left_val')
+            ancestor_ids = None
+        else:
+            ancestor_ids = selected_node.get_ancestor_ids()
+            qs = Node.objects.filter(visible=True, id__in=ancestor_ids).order_by('left_val')
         
-        self.active_path_ids = map(lambda x: x.id, qs)      # pull the active path ids for later use
+        self.active_path_nodes = NodeProcessor.add_node_subclasses(qs, stats=self.stats, query_phase='breadcrumb'\
+                                                    , join_subclasses=self.join_subclasses)
+        if ancestor_ids is not None:
+            # root first, also for detached nodes (their left_val are all -1)
+            self.active_path_nodes.sort(key=lambda x: ancestor_ids.index(x.id))
+        self.active_path_ids = map(lambda x: x.id, self.active_path_nodes)      # pull the active path ids for later use
         # exclude selected node from breadcrumb
         if self.breadcrumb_exclude_selected_node:       
-            qs2 = qs.exclude(id=selected_node.id)
-            self.breadcrumb_nodes = NodeProcessor.add_node_subclasses(qs2) 
+            self.breadcrumb_nodes = filter(lambda x: x.id != selected_node.id, self.active_path_nodes)
         else:
             # regular breadcrumb
-            self.breadcrumb_nodes = NodeProcessor.add_node_subclasses(qs) 
+            self.breadcrumb_nodes = list(self.active_path_nodes)
+
+
+    def set_breadcrumb_nodes_from_source(self):
+        """Copy the breadcrumbs and active path from self.breadcrumb_source, no query"""
+        source = self.breadcrumb_source
+        self.breadcrumb_nodes = list(source.breadcrumb_nodes)
+        self.last_breadcrumb_string = source.last_breadcrumb_string
+        self.active_path_ids = list(source.active_path_ids)
+        self.active_path_nodes = list(source.active_path_nodes)
+
+
+    # ------------------------------------------
+    # Tree snapshot versions of the functions above.
+    #   Same nodes, order and flags as the queries--computed in memory
+    # ------------------------------------------
+    def get_snapshot_menu_items(self, indexes):
+        snapshot = self.tree_snapshot
+        with self.stats_phase('menu_query'):
+            menu_items = [SnapshotMenuItem(snapshot, idx) for idx in sorted(indexes)]     # left_val order
+        if self.stats is not None:
+            self.stats.add_rows('menu_query', len(menu_items))
+        with self.stats_phase('flags'):
+            return set_menu_item_flags(menu_items, self.active_path_ids)
+        
+    def set_breadcrumb_nodes_from_snapshot(self):
+        self.breadcrumb_nodes = []
+        if self.selected_idx is None:
+            return None
+            
+        snapshot = self.tree_snapshot
+        with self.stats_phase('breadcrumb'):
+            path_indexes = snapshot.get_ancestors(self.selected_idx, include_self=True)
+            self.active_path_ids = [snapshot.ids[idx] for idx in path_indexes]
+            
+            if self.breadcrumb_exclude_selected_node:
+                path_indexes = path_indexes[:-1]
+            breadcrumb_nodes = [SnapshotMenuItem(snapshot, idx) for idx in path_indexes]
+        if self.stats is not None:
+            self.stats.add_rows('breadcrumb', len(breadcrumb_nodes))
+        with self.stats_phase('flags'):
+            self.breadcrumb_nodes = set_menu_item_flags(breadcrumb_nodes)
+        
+    def get_active_path_index(self, menu_level):
+        """Index of the node at this menu level on the active path, or None"""
+        if menu_level > len(self.active_path_ids):
+            return None
+        return self.tree_snapshot.get_index(self.active_path_ids[menu_level-1])
+        
+    def build_menu_through_level3_from_snapshot(self):
+        self.set_breadcrumb_nodes()
+        self.menu_items = self.get_snapshot_menu_items(self.tree_snapshot.get_indexes_to_level(5))
+        
+    def build_the_menu_from_snapshot(self):
+        self.set_breadcrumb_nodes()
+        snapshot = self.tree_snapshot
+        
+        with self.stats_phase('menu_query'):
+            # menu_level 2 | siblings and above on active path | selected node direct descendents 
+            indexes = set(snapshot.get_indexes_to_level(2))
+            l2_idx = self.get_active_path_index(2)
+            if self.selected_idx is not None and l2_idx is not None:
+                start, stop = snapshot.get_descendant_range(l2_idx)
+                indexes.update(snapshot.get_indexes_to_level(snapshot.menu_levels[self.selected_idx], start, stop))
+                indexes.update(snapshot.get_children(self.selected_idx))
+        
+            if not self.include_root_node:
+                indexes = filter(lambda idx: snapshot.menu_levels[idx] != 1, indexes)
+        
+        self.menu_items = self.get_snapshot_menu_items(indexes)
+    
+    def build_left_menu_from_snapshot(self):
+        self.set_breadcrumb_nodes()
+        snapshot = self.tree_snapshot
+        
+        with self.stats_phase('menu_query'):
+            l2_idx = self.get_active_path_index(2)
+            if self.selected_idx is not None and l2_idx is not None:
+                selected_level = snapshot.menu_levels[self.selected_idx]
+                # L3 under L2, descendents of selected node
+                indexes = set(snapshot.get_children(l2_idx))
+                indexes.update(snapshot.get_children(self.selected_idx))
+                if selected_level > 3:
+                    indexes.update(snapshot.get_siblings(self.selected_idx))
+                    l3_idx = self.get_active_path_index(3)
+                    if l3_idx is not None:
+                        # siblings of L3, branches down from L3
+                        indexes.update(snapshot.get_children(l3_idx))
+                        start, stop = snapshot.get_descendant_range(l3_idx)
+                        indexes.update(snapshot.get_indexes_to_level(selected_level - 1, start, stop))
+            else:
+                # get only level 2 menus
+                indexes = snapshot.get_indexes_to_level(2)
+        
+            if not self.include_root_node:
+                indexes = filter(lambda idx: snapshot.menu_levels[idx] != 1, indexes)
         
-        
\ No newline at end of file
+        self.menu_items = self.get_snapshot_menu_items(indexes)
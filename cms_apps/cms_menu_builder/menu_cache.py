@@ -0,0 +1,226 @@
+"""
+Cache for MenuBuilder output and rendered menu fragments.
+
+The same selected node gives the same menu until the tree changes.  Entries
+are keyed by:
+    (menu mode, selected node id, include_root_node, breadcrumb_exclude_selected_node, tree version)
+
+so a tree update (cms_menu_node.tree_builder.bump_tree_version) makes the old entries
+unreachable.  The in-process cache is cleared when a new tree version is seen.
+
+clear_menu_cache() changes the menu generation stored in the Django cache, which is 
+part of each key there: the menu entries become unreachable, other entries (sessions, 
+other apps) are left alone.
+
+In settings.py (all optional):
+
+    CMS_MENU_CACHE_SIZE = 500           # entries in the in-process LRU cache, 0 to turn it off
+    CMS_MENU_CACHE_BACKEND = 'default'  # also use this Django cache (settings.CACHES), shared by processes
+    CMS_MENU_CACHE_TIMEOUT = 3600       # seconds, for the Django cache
+
+Usage:
+
+    menu = get_cached_menu(selected_node=page, is_left_menu=True)
+    menu.get_menu_items()
+
+    html = get_cached_menu_fragment('menus/left_menu.html', selected_node=page, is_left_menu=True)
+"""
+import hashlib
+import threading
+import uuid
+from collections import OrderedDict
+
+from django.conf import settings
+from django.template.loader import render_to_string
+
+from cms_common.msg_util import *
+from cms_menu_node.tree_builder import get_tree_version_key
+from cms_menu_builder.menu_builder import MenuBuilder, MenuItem, BreadcrumbHandler
+
+DEFAULT_CACHE_SIZE = 500
+DEFAULT_CACHE_TIMEOUT = 3600
+
+MENU_GENERATION_KEY = 'cms_menu:generation'
+
+MENU_MODE_TOP = 'top'
+MENU_MODE_LEFT = 'left'
+MENU_MODE_LEVEL3 = 'level3'
+
+
+class LRUCache(object):
+    """Thread-safe dict with a maximum size; the least recently used entries are dropped first"""
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self.lock:
+            if key not in self.entries:
+                return default
+            value = self.entries.pop(key)
+            self.entries[key] = value       # most recently used goes last
+            return value
+
+    def set(self, key, value):
+        if self.max_size < 1:
+            return
+        with self.lock:
+            self.entries.pop(key, None)
+            self.entries[key] = value
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def __len__(self):
+        return len(self.entries)
+
+
+class CachedMenu(object):
+    """MenuBuilder output with compact MenuItem objects, safe to keep across requests
+    and to pickle.  Has the MenuBuilder functions used by templates"""
+
+    def __init__(self, menu_builder):
+        self.menu_items = map(MenuItem, menu_builder.get_menu_items())
+        self.breadcrumb_nodes = map(MenuItem, menu_builder.get_breadcrumb_nodes())
+        self.last_breadcrumb_string = menu_builder.last_breadcrumb_string
+        self.active_path_ids = list(menu_builder.active_path_ids)
+
+        # { menu level : item } for get_menu_item_on_active_path()
+        self.active_path_items = {}
+        for item_num in range(1, len(self.active_path_ids) + 1):
+            item = menu_builder.get_menu_item_on_active_path(item_num)
+            if item is not None:
+                self.active_path_items[item_num] = MenuItem(item)
+
+    def get_menu_items(self):
+        return self.menu_items
+
+    def get_num_menu_items(self):
+        return len(self.menu_items)
+
+    def get_breadcrumb_nodes(self):
+        return self.breadcrumb_nodes
+
+    def get_num_breadcrumbs(self):
+        return len(self.breadcrumb_nodes)
+
+    def get_breadcrumb_handler(self):
+        return BreadcrumbHandler(self.breadcrumb_nodes, self.last_breadcrumb_string)
+
+    def get_menu_item_on_active_path(self, item_num):
+        if not str(item_num).isdigit():
+            return None
+        return self.active_path_items.get(int(item_num), None)
+
+    def get_l2_menu_item_on_active_path(self):
+        return self.get_menu_item_on_active_path(2)
+
+    def get_l3_menu_item_on_active_path(self):
+        return self.get_menu_item_on_active_path(3)
+
+
+# ------------------------------------------
+# Cache lookups
+# ------------------------------------------
+_local_cache = LRUCache(getattr(settings, 'CMS_MENU_CACHE_SIZE', DEFAULT_CACHE_SIZE))
+_local_cache_version = { 'version_key' : None }
+
+def get_backend_cache():
+    """The Django cache named in CMS_MENU_CACHE_BACKEND, or None"""
+    backend_name = getattr(settings, 'CMS_MENU_CACHE_BACKEND', None)
+    if not backend_name:
+        return None
+    from django.core.cache import get_cache
+    return get_cache(backend_name)
+
+
+def get_menu_mode(menu_kwargs):
+    if menu_kwargs.get('build_full_tree_to_level3', False):
+        return MENU_MODE_LEVEL3
+    if menu_kwargs.get('is_left_menu', False):
+        return MENU_MODE_LEFT
+    return MENU_MODE_TOP
+
+
+def get_menu_cache_key(menu_kwargs, version_key, fragment_name=''):
+    """e.g. 'cms_menu:3f2a...' -- hashed to stay short and memcached-safe"""
+    selected_node = menu_kwargs.get('selected_node', None)
+    selected_node_id = None
+    if selected_node is not None:
+        selected_node_id = selected_node.id
+
+    key_parts = (get_menu_mode(menu_kwargs)
+                , selected_node_id
+                , bool(menu_kwargs.get('include_root_node', True))
+                , bool(menu_kwargs.get('breadcrumb_exclude_selected_node', False))
+                , version_key
+                , fragment_name)
+    return 'cms_menu:%s' % hashlib.md5(repr(key_parts)).hexdigest()
+
+
+def get_cache_timeout():
+    return getattr(settings, 'CMS_MENU_CACHE_TIMEOUT', DEFAULT_CACHE_TIMEOUT)
+
+
+def get_backend_key(backend_cache, key):
+    """key for the Django cache, with the menu generation (see clear_menu_cache)"""
+    return '%s:%s' % (key, backend_cache.get(MENU_GENERATION_KEY) or '')
+
+
+def get_cached_value(key, version_key, build_func):
+    """In-process cache, then the Django cache (if any), then build_func()"""
+    if _local_cache_version['version_key'] != version_key:
+        _local_cache.clear()        # new tree version: the old entries can't be reached
+        _local_cache_version['version_key'] = version_key
+
+    value = _local_cache.get(key)
+    if value is not None:
+        return value
+
+    backend_cache = get_backend_cache()
+    if backend_cache is not None:
+        backend_key = get_backend_key(backend_cache, key)
+        value = backend_cache.get(backend_key)
+
+    if value is None:
+        value = build_func()
+        if backend_cache is not None:
+            backend_cache.set(backend_key, value, get_cache_timeout())
+
+    _local_cache.set(key, value)
+    return value
+
+
+def get_cached_menu(**menu_kwargs):
+    """A CachedMenu for the MenuBuilder kwargs, e.g. get_cached_menu(selected_node=page, is_left_menu=True)"""
+    version_key = get_tree_version_key()
+    key = get_menu_cache_key(menu_kwargs, version_key)
+    return get_cached_value(key, version_key, lambda: CachedMenu(MenuBuilder(**menu_kwargs)))
+
+
+def get_cached_menu_fragment(template_name, **menu_kwargs):
+    """Rendered template, with the CachedMenu as "menu" in the context.
+    The template should only depend on the menu (no request or user specific content)"""
+    version_key = get_tree_version_key()
+    key = get_menu_cache_key(menu_kwargs, version_key, template_name)
+
+    def render_fragment():
+        return render_to_string(template_name, { 'menu' : get_cached_menu(**menu_kwargs) })
+
+    return get_cached_value(key, version_key, render_fragment)
+
+
+def clear_menu_cache():
+    """Clear the in-process cache and make the menu entries in the Django cache unreachable.
+    The Django cache isn't flushed, it may be shared (sessions, other apps).  Entries
+    of the old generation expire with CMS_MENU_CACHE_TIMEOUT--so does the generation"""
+    _local_cache.clear()
+    _local_cache_version['version_key'] = None
+    backend_cache = get_backend_cache()
+    if backend_cache is not None:
+        backend_cache.set(MENU_GENERATION_KEY, uuid.uuid4().hex, get_cache_timeout())
@@ -0,0 +1,168 @@
+"""
+Queries, rows and time for each phase of a MenuBuilder build.
+
+Phases:
+    breadcrumb    - ancestor chain of the selected node
+    active_path   - level-N items on the active path (e.g. the L2 and L3 nodes)
+    menu_query    - the menu nodes
+    subclasses    - replacing nodes with their subclass (Page, PageDirectLink, etc)
+    flags         - active path and sibling flags
+
+In settings.py (all optional):
+
+    CMS_MENU_STATS = True       # collect stats for every MenuBuilder, see MenuBuilder.stats
+    CMS_MENU_STATS_HOOK = 'myproject.stats.send_menu_stats'     # called with each MenuBuildStats
+
+    MIDDLEWARE_CLASSES = (
+        ...
+        'cms_menu_builder.middleware.MenuServerTimingMiddleware',   # Server-Timing response header
+    )
+
+When stats are off, each phase costs an attribute check.
+Hooks can also be added with register_menu_stats_hook(func)
+"""
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+from django.utils.importlib import import_module
+
+from cms_common.msg_util import *
+from cms_common.query_util import QueryCounter
+
+MENU_BUILD_PHASES = ('breadcrumb', 'active_path', 'menu_query', 'subclasses', 'flags')
+
+
+class MenuBuildStats(object):
+    """{ phase : { 'queries' : int, 'rows' : int, 'ms' : float } } for one MenuBuilder"""
+
+    def __init__(self, menu_name=''):
+        self.menu_name = menu_name
+        self.phases = OrderedDict()
+        for phase_name in MENU_BUILD_PHASES:
+            self.phases[phase_name] = { 'queries' : 0, 'rows' : 0, 'ms' : 0.0 }
+
+    def phase(self, phase_name):
+        return StatsPhase(self.phases[phase_name])
+
+    def add_rows(self, phase_name, num_rows):
+        self.phases[phase_name]['rows'] += num_rows
+
+    def add(self, other_stats):
+        for phase_name, phase_stats in other_stats.phases.items():
+            for key, value in phase_stats.items():
+                self.phases[phase_name][key] += value
+
+    def get_total(self, key):
+        return sum(map(lambda phase_stats: phase_stats[key], self.phases.values()))
+
+    def get_total_queries(self):
+        return self.get_total('queries')
+
+    def get_total_ms(self):
+        return self.get_total('ms')
+
+    def as_dict(self):
+        return { 'menu_name' : self.menu_name, 'phases' : self.phases\
+                , 'total_queries' : self.get_total_queries(), 'total_ms' : self.get_total_ms() }
+
+
+class StatsPhase(object):
+    """Adds the queries and time of a "with" block to a phase"""
+
+    def __init__(self, phase_stats):
+        self.phase_stats = phase_stats
+        self.query_counter = QueryCounter()
+
+    def __enter__(self):
+        self.query_counter.__enter__()
+        self.start_time = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.phase_stats['ms'] += (time.time() - self.start_time) * 1000.0
+        self.query_counter.__exit__(exc_type, exc_value, traceback)
+        self.phase_stats['queries'] += self.query_counter.num_queries
+        return False
+
+
+class NullPhase(object):
+    """Used when stats are off"""
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+NULL_PHASE = NullPhase()
+
+
+# ------------------------------------------
+# Turning stats on: settings.CMS_MENU_STATS or the current request
+# (MenuServerTimingMiddleware)
+# ------------------------------------------
+_request_stats = threading.local()
+
+def is_menu_stats_enabled():
+    return getattr(settings, 'CMS_MENU_STATS', False) or getattr(_request_stats, 'stats_list', None) is not None
+
+def start_request_stats():
+    """Collect the stats of the MenuBuilders of this thread until end_request_stats()"""
+    _request_stats.stats_list = []
+
+def end_request_stats():
+    """The MenuBuildStats collected since start_request_stats()"""
+    stats_list = getattr(_request_stats, 'stats_list', None) or []
+    _request_stats.stats_list = None
+    return stats_list
+
+
+# ------------------------------------------
+# Hooks, called with each MenuBuildStats
+# ------------------------------------------
+_stats_hooks = []
+_settings_hook_loaded = []
+
+def register_menu_stats_hook(func):
+    if func not in _stats_hooks:
+        _stats_hooks.append(func)
+
+def unregister_menu_stats_hook(func):
+    if func in _stats_hooks:
+        _stats_hooks.remove(func)
+
+def load_settings_hook():
+    """Register settings.CMS_MENU_STATS_HOOK, e.g. 'myproject.stats.send_menu_stats', once"""
+    if _settings_hook_loaded:
+        return
+    _settings_hook_loaded.append(True)
+    hook_path = getattr(settings, 'CMS_MENU_STATS_HOOK', None)
+    if not hook_path:
+        return
+    module_name, func_name = hook_path.rsplit('.', 1)
+    register_menu_stats_hook(getattr(import_module(module_name), func_name))
+
+def send_menu_stats(stats):
+    load_settings_hook()
+    stats_list = getattr(_request_stats, 'stats_list', None)
+    if stats_list is not None:
+        stats_list.append(stats)
+    for func in _stats_hooks:
+        try:
+            func(stats)
+        except Exception, e:
+            msg('menu stats hook error: %s' % e)     # stats never break a page
+
+
+def get_server_timing_header(stats_list):
+    """e.g. 'menu-breadcrumb;dur=0.41;desc="1 queries, 3 rows", menu-menu_query;dur=1.20;desc="1 queries, 9 rows"'"""
+    total_stats = MenuBuildStats()
+    for stats in stats_list:
+        total_stats.add(stats)
+
+    timings = []
+    for phase_name, phase_stats in total_stats.phases.items():
+        timings.append('menu-%s;dur=%.2f;desc="%s queries, %s rows"'\
+                    % (phase_name, phase_stats['ms'], phase_stats['queries'], phase_stats['rows']))
+    return ', '.join(timings)
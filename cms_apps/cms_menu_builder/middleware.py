@@ -0,0 +1,26 @@
+from cms_menu_builder.request_menus import RequestMenus
+from cms_menu_builder.menu_stats import start_request_stats, end_request_stats, get_server_timing_header
+
+
+class RequestMenusMiddleware(object):
+    """Adds request.cms_menus, a RequestMenus for the node named in the view kwargs
+    (e.g. page_id or page_slug).  Nothing is queried until a menu is used"""
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        request.cms_menus = RequestMenus(view_kwargs=view_kwargs)
+        return None
+
+
+class MenuServerTimingMiddleware(object):
+    """Collects the MenuBuilder stats of the request (cms_menu_builder/menu_stats.py)
+    and adds them as a Server-Timing header"""
+
+    def process_request(self, request):
+        start_request_stats()
+        return None
+
+    def process_response(self, request, response):
+        stats_list = end_request_stats()
+        if stats_list:
+            response['Server-Timing'] = get_server_timing_header(stats_list)
+        return response
@@ -0,0 +1,141 @@
+"""
+One set of menus per request.
+
+A page usually shows a top menu, a left menu and breadcrumbs.  RequestMenus
+looks up the selected node once, builds the breadcrumbs/active path once and
+gives each menu a MenuBuilder that reuses them (MenuBuilder(breadcrumb_source=...)).
+By default the menus are built from the tree snapshot (cms_menu_node.tree_snapshot).
+
+In settings.py:
+
+    MIDDLEWARE_CLASSES = (
+        ...
+        'cms_menu_builder.middleware.RequestMenusMiddleware',
+    )
+    CMS_MENU_USE_TREE_SNAPSHOT = True   # default
+
+In a view:
+
+    menus = get_request_menus(request, selected_node=page)
+    menus.get_top_menu().get_menu_items()
+
+In a template, see cms_menu_builder/templatetags/cms_menu_tags.py
+"""
+from django.conf import settings
+
+from cms_common.msg_util import *
+from cms_menu_node.models import Node
+from cms_menu_node.tree_snapshot import get_tree_snapshot
+from cms_menu_builder.menu_builder import MenuBuilder
+
+# view kwargs used to find the selected node, e.g. from cms_page/urls.py
+NODE_ID_VIEW_KWARGS = ('page_id', 'node_id')
+NODE_SLUG_VIEW_KWARGS = ('page_slug', 'node_slug')
+
+
+class RequestMenus(object):
+    """The menus for one selected node.  Each menu is built on first use"""
+
+    def __init__(self, selected_node=None, view_kwargs=None, **kwargs):
+        self.view_kwargs = view_kwargs or {}
+        self.include_root_node = kwargs.get('include_root_node', True)
+        self.breadcrumb_exclude_selected_node = kwargs.get('breadcrumb_exclude_selected_node', False)
+        self.use_tree_snapshot = kwargs.get('use_tree_snapshot'\
+                                , getattr(settings, 'CMS_MENU_USE_TREE_SNAPSHOT', True))
+        self.count_queries = kwargs.get('count_queries', False)
+        self.set_selected_node(selected_node)
+
+    def set_selected_node(self, selected_node):
+        """e.g. called by the view once it has the page.  Discards menus already built"""
+        self.selected_node = selected_node
+        self.selected_node_resolved = selected_node is not None
+        self.tree_snapshot = None
+        self.path_builder = None
+        self.menu_builders = {}     # { 'top' | 'left' | 'level3' : MenuBuilder }
+
+    def get_selected_node(self):
+        """The node passed in, or the visible node named by the view kwargs (page_id, page_slug, etc).
+        Looked up once"""
+        if self.selected_node_resolved:
+            return self.selected_node
+        self.selected_node_resolved = True
+
+        lookup = None
+        for kwarg_name in NODE_ID_VIEW_KWARGS:
+            if str(self.view_kwargs.get(kwarg_name, '')).isdigit():
+                lookup = { 'id' : self.view_kwargs[kwarg_name] }
+                break
+        else:
+            for kwarg_name in NODE_SLUG_VIEW_KWARGS:
+                if self.view_kwargs.get(kwarg_name, None):
+                    lookup = { 'slug' : self.view_kwargs[kwarg_name] }
+                    break
+        if lookup is None:
+            return None
+
+        try:
+            self.selected_node = Node.objects.get(visible=True, **lookup)
+        except (Node.DoesNotExist, Node.MultipleObjectsReturned):
+            self.selected_node = None
+        return self.selected_node
+
+    def get_menu_builder_kwargs(self):
+        if self.use_tree_snapshot and self.tree_snapshot is None:
+            self.tree_snapshot = get_tree_snapshot()
+        return { 'selected_node' : self.get_selected_node()\
+                , 'include_root_node' : self.include_root_node\
+                , 'breadcrumb_exclude_selected_node' : self.breadcrumb_exclude_selected_node\
+                , 'tree_snapshot' : self.tree_snapshot\
+                , 'count_queries' : self.count_queries }
+
+    def get_path_builder(self):
+        """MenuBuilder with the breadcrumbs and active path only, shared by the menus"""
+        if self.path_builder is None:
+            self.path_builder = MenuBuilder(build_menu_items=False, **self.get_menu_builder_kwargs())
+        return self.path_builder
+
+    def get_menu_builder(self, menu_name, **kwargs):
+        if menu_name not in self.menu_builders:
+            path_builder = self.get_path_builder()
+            self.menu_builders[menu_name] = MenuBuilder(breadcrumb_source=path_builder\
+                                                    , **dict(self.get_menu_builder_kwargs(), **kwargs))
+        return self.menu_builders[menu_name]
+
+    def get_top_menu(self):
+        return self.get_menu_builder('top')
+
+    def get_left_menu(self):
+        return self.get_menu_builder('left', is_left_menu=True)
+
+    def get_level3_menu(self):
+        return self.get_menu_builder('level3', build_full_tree_to_level3=True)
+
+    def get_breadcrumb_nodes(self):
+        return self.get_path_builder().get_breadcrumb_nodes()
+
+    def get_breadcrumb_handler(self):
+        return self.get_path_builder().get_breadcrumb_handler()
+
+    def get_active_path_ids(self):
+        return self.get_path_builder().active_path_ids
+
+    def get_num_queries(self):
+        """Queries used by the menus built so far (RequestMenus(count_queries=True)), or None"""
+        if not self.count_queries:
+            return None
+        builders = self.menu_builders.values()
+        if self.path_builder is not None:
+            builders.append(self.path_builder)
+        return sum(map(lambda mb: mb.num_queries, builders))
+
+
+def get_request_menus(request, selected_node=None):
+    """The RequestMenus for this request, created if the middleware isn't installed.
+    If selected_node is given, it replaces the node found by the middleware"""
+    request_menus = getattr(request, 'cms_menus', None)
+    if request_menus is None:
+        request_menus = RequestMenus(selected_node)
+        request.cms_menus = request_menus
+    elif selected_node is not None and request_menus.selected_node is not selected_node:
+        request_menus.set_selected_node(selected_node)
+    return request_menus
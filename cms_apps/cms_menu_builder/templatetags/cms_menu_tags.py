@@ -0,0 +1,54 @@
+"""
+Menus for the current request, all built from one RequestMenus
+(cms_menu_builder/request_menus.py)
+
+    {% load cms_menu_tags %}
+
+    {% get_top_menu as top_menu %}
+    {% for item in top_menu.get_menu_items %}...{% endfor %}
+
+    {% get_left_menu as left_menu %}
+    {% get_level3_menu as level3_menu %}
+    {% get_breadcrumbs as breadcrumbs %}      (a BreadcrumbHandler)
+
+Needs "request" in the context (django.core.context_processors.request).
+Without it, the menus are built for the "page" in the context, if any
+"""
+from django import template
+
+from cms_menu_builder.request_menus import RequestMenus, get_request_menus
+
+register = template.Library()
+
+CONTEXT_MENUS_KEY = '_cms_request_menus'
+
+
+def get_context_menus(context):
+    request = context.get('request', None)
+    if request is not None:
+        return get_request_menus(request)
+
+    # no request: keep one RequestMenus in the context
+    for context_dict in context.dicts:
+        if CONTEXT_MENUS_KEY in context_dict:
+            return context_dict[CONTEXT_MENUS_KEY]
+    request_menus = RequestMenus(context.get('page', None))
+    context.dicts[0][CONTEXT_MENUS_KEY] = request_menus
+    return request_menus
+
+
+@register.assignment_tag(takes_context=True)
+def get_top_menu(context):
+    return get_context_menus(context).get_top_menu()
+
+@register.assignment_tag(takes_context=True)
+def get_left_menu(context):
+    return get_context_menus(context).get_left_menu()
+
+@register.assignment_tag(takes_context=True)
+def get_level3_menu(context):
+    return get_context_menus(context).get_level3_menu()
+
+@register.assignment_tag(takes_context=True)
+def get_breadcrumbs(context):
+    return get_context_menus(context).get_breadcrumb_handler()
@@ -0,0 +1,300 @@
+"""
+Benchmarks for the tree updates and menus on synthetic trees, run on a SQLite 
+(or PostgreSQL) test database.
+
+    manage.py benchmark_tree --sizes=1000,10000,100000 --depth=6 --fan-out=10 --output=bench.json
+    manage.py benchmark_tree --sizes=1000 --compare=bench_before.json
+
+For each tree size:
+    - the tree is generated breadth first: each node has --fan-out children,
+      down to --depth menu levels
+    - each benchmark runs --samples times, on the same (seeded) sample of nodes,
+      and records the time (min/mean/max ms) and the queries per run
+    - the main tree queries are timed and their EXPLAIN plans recorded ("query_plans")
+
+To see what the indexes in cms_menu_node/db_indexes.py do, compare a run --without-indexes:
+
+    manage.py benchmark_tree --sizes=100000 --without-indexes --output=bench_no_indexes.json
+    manage.py benchmark_tree --sizes=100000 --compare=bench_no_indexes.json
+
+Results are written as JSON, e.g. to compare two commits
+"""
+import json
+import platform
+import random
+import subprocess
+import time
+from datetime import datetime
+
+import django
+from django.contrib.auth.models import User
+from django.core.management.color import no_style
+from django.core.urlresolvers import get_urlconf, set_urlconf
+from django.db import connection, transaction
+from django.template import Template, Context
+from django.test.client import RequestFactory
+
+from cms_common.msg_util import *
+from cms_common.query_util import QueryCounter
+
+DEFAULT_SIZES = (1000, 10000, 100000)
+DEFAULT_DEPTH = 6
+DEFAULT_FAN_OUT = 10
+DEFAULT_SAMPLES = 20
+DEFAULT_SEED = 1
+DEFAULT_ADMIN_CHOICES_MAX_NODES = 100000    # to skip the admin parent choices on larger trees
+
+BENCHMARK_URLCONF = 'cms_page.urls'     # for Page.get_absolute_url()
+BENCHMARK_DATABASES = ('sqlite', 'postgresql')
+
+# EXPLAIN prefix by database
+EXPLAIN_SQL = { 'sqlite' : 'EXPLAIN QUERY PLAN ', 'postgresql' : 'EXPLAIN ' }
+
+PAGE_MENUS_TEMPLATE = '{% load cms_menu_tags %}{% get_top_menu as top_menu %}{% get_left_menu as left_menu %}'\
+                    '{% get_breadcrumbs as breadcrumbs %}'\
+                    '{% for item in top_menu.get_menu_items %}<a href="{{ item.get_absolute_url }}">{{ item }}</a>{% endfor %}'\
+                    '{% for item in left_menu.get_menu_items %}<a href="{{ item.get_absolute_url }}">{{ item }}</a>{% endfor %}'\
+                    '{% for item in breadcrumbs.get_breadcrumbs %}{{ item }}{% endfor %}'
+
+
+def get_tree_rows(num_nodes, depth, fan_out):
+    """[(id, parent id, sibling_order), ...] breadth first, ids from 1.
+    Raises ValueError if depth and fan_out allow fewer than num_nodes"""
+    rows = [(1, None, 1)]
+    level_ids = [1]
+    for menu_level in range(2, depth + 1):
+        next_level_ids = []
+        for parent_id in level_ids:
+            for sibling_order in range(1, fan_out + 1):
+                if len(rows) == num_nodes:
+                    return rows
+                node_id = len(rows) + 1
+                rows.append((node_id, parent_id, sibling_order))
+                next_level_ids.append(node_id)
+        level_ids = next_level_ids
+    if len(rows) < num_nodes:
+        raise ValueError('A tree with depth %s and fan-out %s has fewer than %s nodes' % (depth, fan_out, num_nodes))
+    return rows
+
+
+def create_tree(num_nodes, depth, fan_out):
+    """Insert the nodes without the save signals, then rebuild the tree once"""
+    from cms_menu_node.models import Node
+    from cms_menu_node.tree_builder import rebuild_tree_full
+
+    nodes = []
+    for node_id, parent_id, sibling_order in get_tree_rows(num_nodes, depth, fan_out):
+        name = 'node-%s' % node_id
+        nodes.append(Node(id=node_id, name=name, slug=name, parent_id=parent_id\
+                        , sibling_order=sibling_order, is_root=parent_id is None))
+    with transaction.commit_on_success():
+        Node.objects.bulk_create(nodes, batch_size=500)     # SQLite: at most 999 query variables
+        # PostgreSQL: the ids were given, move the id sequence past them
+        cursor = connection.cursor()
+        for sql in connection.ops.sequence_reset_sql(no_style(), [Node]):
+            cursor.execute(sql)
+    rebuild_tree_full(Node)
+
+
+def time_runs(func, args_list):
+    """Call func(*args) for each args in args_list.  Returns the time and queries per run"""
+    times = []
+    num_queries = []
+    for args in args_list:
+        with QueryCounter() as query_counter:
+            start_time = time.time()
+            func(*args)
+            times.append((time.time() - start_time) * 1000.0)
+        num_queries.append(query_counter.num_queries)
+
+    return { 'runs' : len(times)\
+            , 'min_ms' : round(min(times), 3)\
+            , 'mean_ms' : round(sum(times) / len(times), 3)\
+            , 'max_ms' : round(max(times), 3)\
+            , 'queries_per_run' : round(sum(num_queries) / float(len(num_queries)), 2) }
+
+
+def get_query_plan(qs):
+    """The EXPLAIN lines for a queryset"""
+    sql, params = qs.query.sql_with_params()
+    cursor = connection.cursor()
+    cursor.execute(EXPLAIN_SQL[connection.vendor] + sql, params)
+    if connection.vendor == 'sqlite':       # (id, parent, notused, detail)
+        return map(lambda row: row[-1], cursor.fetchall())
+    return map(lambda row: row[0], cursor.fetchall())
+
+
+def get_tree_querysets(node, page):
+    """{ name : queryset } for the main tree queries, for a selected node and page"""
+    from cms_menu_node.models import Node
+    from cms_page.models import Page
+
+    return { 'top_menu' : Node.objects.filter(visible=True, menu_level__lte=2).order_by('left_val')\
+        , 'level3_menu' : Node.objects.filter(visible=True, menu_level__lte=5).order_by('left_val', 'sibling_order')\
+        , 'breadcrumb_range' : Node.objects.filter(visible=True, left_val__lte=node.left_val\
+                                            , right_val__gte=node.right_val).order_by('left_val')\
+        , 'left_menu_siblings' : Node.objects.filter(visible=True, parent=node.parent_id).order_by('left_val')\
+        , 'subtree' : Node.objects.filter(left_val__gt=node.left_val, left_val__lt=node.right_val)\
+        , 'root_check' : Node.objects.filter(is_root=True, visible=True)\
+        , 'page_by_slug' : Page.objects.filter(slug=page.slug, visible=True) }
+
+
+def run_query_benchmarks(result, node, page, samples):
+    """Time each tree query and record its plan"""
+    result['query_plans'] = {}
+    for name, qs in get_tree_querysets(node, page).items():
+        result['query_plans'][name] = get_query_plan(qs)
+        result['benchmarks']['query_%s' % name] = time_runs(lambda: list(qs.all()), [()] * samples)
+
+
+def run_size_benchmarks(num_nodes, depth, fan_out, samples, seed, admin_choices_max_nodes):
+    """Build a tree of num_nodes and run each benchmark on it"""
+    from cms_menu_node.models import Node
+    from cms_menu_node.tree_builder import rebuild_tree_full
+    from cms_menu_node.tree_snapshot import get_tree_snapshot, clear_tree_snapshot
+    from cms_menu_node.node_paths import clear_admin_parent_choices
+    from cms_page.models import Page
+    from cms_menu_builder.menu_builder import MenuBuilder
+    from cms_menu_builder.middleware import RequestMenusMiddleware
+
+    start_time = time.time()
+    create_tree(num_nodes, depth, fan_out)
+    result = { 'num_nodes' : num_nodes, 'create_seconds' : round(time.time() - start_time, 3), 'benchmarks' : {} }
+    benchmarks = result['benchmarks']
+
+    rand = random.Random(seed)
+    sample_ids = rand.sample(xrange(2, num_nodes + 1), min(samples, num_nodes - 1))
+    sample_nodes = list(Node.objects.filter(id__in=sample_ids).order_by('id'))
+    author, created = User.objects.get_or_create(username='benchmark')
+
+    # tree updates: rebuild_tree_after_node_saved, via save()
+    benchmarks['rebuild_tree_full'] = time_runs(rebuild_tree_full, [(Node,)] * 3)
+
+    new_pages = [Page(name='page-%s' % nd.id, title='Page %s' % nd.id, content='content', author=author, parent=nd)\
+                    for nd in sample_nodes]
+    benchmarks['save_new_page'] = time_runs(lambda page: page.save(), [(page,) for page in new_pages])
+
+    def rename_page(page):
+        page.name = page.name + '-renamed'
+        page.save()
+    benchmarks['save_renamed_page'] = time_runs(rename_page, [(page,) for page in new_pages])
+
+    def move_page(page, new_parent):
+        page.parent = new_parent
+        page.save()
+    new_parents = sample_nodes[1:] + sample_nodes[:1]
+    benchmarks['save_moved_page'] = time_runs(move_page, zip(new_pages, new_parents))
+
+    # menus for the pages, from queries and from the tree snapshot
+    selected_pages = list(Page.objects.filter(id__in=[page.id for page in new_pages]))
+    menu_modes = (('top', {}), ('left', { 'is_left_menu' : True }), ('level3', { 'build_full_tree_to_level3' : True }))
+    for mode_name, kwargs in menu_modes:
+        benchmarks['menu_%s' % mode_name] = time_runs(lambda page: MenuBuilder(selected_node=page, **kwargs)\
+                                                , [(page,) for page in selected_pages])
+
+    clear_tree_snapshot()
+    benchmarks['tree_snapshot_load'] = time_runs(lambda: (clear_tree_snapshot(), get_tree_snapshot()), [()])
+    for mode_name, kwargs in menu_modes:
+        benchmarks['menu_%s_snapshot' % mode_name] = time_runs(\
+                            lambda page: MenuBuilder(selected_node=page, use_tree_snapshot=True, **kwargs)\
+                            , [(page,) for page in selected_pages])
+
+    benchmarks['node_breadcrumb'] = time_runs(lambda page: page.breadcrumb(), [(page,) for page in selected_pages])
+
+    if num_nodes <= admin_choices_max_nodes:
+        # after a tree change (the choices are reloaded), then for the same tree version
+        benchmarks['admin_parent_choices'] = time_runs(lambda: (clear_admin_parent_choices(), Node.get_admin_parent_choices())\
+                                                    , [()] * 3)
+        benchmarks['admin_parent_choices_cached'] = time_runs(Node.get_admin_parent_choices, [()] * 3)
+
+    # the menus of a page view: middleware, template tags and rendering
+    request_factory = RequestFactory()
+    template = Template(PAGE_MENUS_TEMPLATE)
+    def render_page_menus(page):
+        request = request_factory.get(page.get_absolute_url())
+        RequestMenusMiddleware().process_view(request, None, (), { 'page_slug' : page.slug })
+        template.render(Context({ 'request' : request }))
+    benchmarks['page_view_menus'] = time_runs(render_page_menus, [(page,) for page in selected_pages])
+
+    # a deep node: its menu level is the most selective
+    deepest_node = Node.objects.filter(visible=True).order_by('-menu_level', 'id')[0]
+    run_query_benchmarks(result, deepest_node, selected_pages[0], samples)
+    return result
+
+
+def get_git_commit():
+    try:
+        return subprocess.Popen(['git', 'rev-parse', 'HEAD'], stdout=subprocess.PIPE\
+                            , stderr=subprocess.PIPE).communicate()[0].strip() or None
+    except OSError:
+        return None
+
+
+def run_benchmarks(sizes=DEFAULT_SIZES, depth=DEFAULT_DEPTH, fan_out=DEFAULT_FAN_OUT, samples=DEFAULT_SAMPLES\
+                , seed=DEFAULT_SEED, admin_choices_max_nodes=DEFAULT_ADMIN_CHOICES_MAX_NODES, with_indexes=True\
+                , verbosity=1):
+    """Each size runs in a new test database.  Returns the results as a dict
+        with_indexes - False: drop the indexes in cms_menu_node/db_indexes.py first"""
+    from cms_menu_node.db_indexes import drop_tree_indexes
+
+    if connection.vendor not in BENCHMARK_DATABASES:
+        raise ValueError('The benchmarks run on SQLite or PostgreSQL, the default database is "%s"' % connection.vendor)
+
+    results = { 'created' : datetime.now().isoformat()\
+              , 'git_commit' : get_git_commit()\
+              , 'python' : platform.python_version()\
+              , 'django' : django.get_version()\
+              , 'database' : connection.vendor\
+              , 'options' : { 'sizes' : list(sizes), 'depth' : depth, 'fan_out' : fan_out, 'samples' : samples\
+                            , 'seed' : seed, 'admin_choices_max_nodes' : admin_choices_max_nodes\
+                            , 'with_indexes' : with_indexes }\
+              , 'results' : [] }
+
+    old_urlconf = get_urlconf()
+    set_urlconf(BENCHMARK_URLCONF)
+    try:
+        for num_nodes in sizes:
+            if verbosity > 0:
+                msg('benchmark: %s nodes' % num_nodes)
+            old_name = connection.settings_dict['NAME']
+            connection.creation.create_test_db(verbosity=0, autoclobber=True)
+            try:
+                if not with_indexes:
+                    drop_tree_indexes()
+                results['results'].append(run_size_benchmarks(num_nodes, depth, fan_out, samples, seed\
+                                                        , admin_choices_max_nodes))
+            finally:
+                connection.creation.destroy_test_db(old_name, verbosity=0)
+    finally:
+        set_urlconf(old_urlconf)
+    return results
+
+
+def compare_results(old_results, new_results):
+    """Lines of 'num_nodes benchmark: old mean ms -> new mean ms (change %)'"""
+    old_lookup = {}
+    for size_result in old_results.get('results', []):
+        for name, stats in size_result['benchmarks'].items():
+            old_lookup[(size_result['num_nodes'], name)] = stats
+
+    lines = []
+    for size_result in new_results['results']:
+        for name in sorted(size_result['benchmarks'].keys()):
+            stats = size_result['benchmarks'][name]
+            old_stats = old_lookup.get((size_result['num_nodes'], name), None)
+            if old_stats is None or not old_stats['mean_ms']:
+                lines.append('%7s %-24s %10s -> %10.3f ms' % (size_result['num_nodes'], name, '-', stats['mean_ms']))
+                continue
+            change = (stats['mean_ms'] - old_stats['mean_ms']) / old_stats['mean_ms'] * 100.0
+            lines.append('%7s %-24s %10.3f -> %10.3f ms (%+.1f%%), queries %s -> %s'\
+                    % (size_result['num_nodes'], name, old_stats['mean_ms'], stats['mean_ms'], change\
+                    , old_stats['queries_per_run'], stats['queries_per_run']))
+    return lines
+
+
+def write_results(results, output_filename):
+    fh = open(output_filename, 'w')
+    try:
+        json.dump(results, fh, indent=2, sort_keys=True)
+    finally:
+        fh.close()
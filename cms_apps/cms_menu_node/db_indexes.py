@@ -0,0 +1,110 @@
+"""
+Composite indexes on the Node table, matched to the tree and menu queries.
+
+They are created after syncdb (new databases, test databases).  For an existing database:
+
+    manage.py create_tree_indexes
+
+    manage.py create_tree_indexes --drop     (e.g. to benchmark without them)
+
+    manage.py create_tree_indexes --database=<alias>
+
+
+Each index lists its columns in the order the queries use them:  equality first,
+then the range column.
+"""
+from django.db import connections, transaction, DEFAULT_DB_ALIAS
+
+from cms_common.msg_util import *
+
+# (index name, Node field names)
+#   left_val is in one index only: an insert or move shifts left_val on half the
+#   table, each index holding it is rewritten
+TREE_INDEXES = (
+    # tree shifts (WHERE left_val >= ...), subtree and breadcrumb ranges, snapshot load
+    ('cms_menu_node_node_left_right', ('left_val', 'right_val'))\
+    # top/level-3 menus: visible, menu_level <= n
+    , ('cms_menu_node_node_visible_level', ('visible', 'menu_level'))\
+    # left menus and insert positions: siblings/children by parent, visible
+    , ('cms_menu_node_node_parent_visible', ('parent', 'visible'))\
+    # root checks: is_root, visible
+    , ('cms_menu_node_node_root_visible', ('is_root', 'visible'))\
+    # page views: the visible node with a slug.  (the slug index alone loses to 
+    #   visible_level in SQLite's planner, both look like one equality match)
+    , ('cms_menu_node_node_slug_visible', ('slug', 'visible'))\
+    )
+
+
+def get_tree_index_names():
+    return map(lambda index: index[0], TREE_INDEXES)
+
+
+def get_create_index_sql(NODE_CLASS, index_name, field_names, using=DEFAULT_DB_ALIAS):
+    qn = connections[using].ops.quote_name
+    columns = map(lambda field_name: qn(NODE_CLASS._meta.get_field(field_name).column), field_names)
+    return 'CREATE INDEX %s ON %s (%s)' % (qn(index_name), qn(NODE_CLASS._meta.db_table), ', '.join(columns))
+
+
+def get_drop_index_sql(NODE_CLASS, index_name, using=DEFAULT_DB_ALIAS):
+    connection = connections[using]
+    qn = connection.ops.quote_name
+    if connection.vendor == 'mysql':
+        return 'DROP INDEX %s ON %s' % (qn(index_name), qn(NODE_CLASS._meta.db_table))
+    return 'DROP INDEX %s' % qn(index_name)
+
+
+def get_existing_index_names(NODE_CLASS, using=DEFAULT_DB_ALIAS):
+    """Index names on the Node table, or None if the database isn't supported"""
+    connection = connections[using]
+    table_name = NODE_CLASS._meta.db_table
+    if connection.vendor == 'sqlite':
+        sql = "SELECT name FROM sqlite_master WHERE type = 'index' AND tbl_name = %s"
+    elif connection.vendor == 'postgresql':
+        sql = 'SELECT indexname FROM pg_indexes WHERE tablename = %s'
+    elif connection.vendor == 'mysql':
+        sql = 'SELECT DISTINCT index_name FROM information_schema.statistics WHERE table_schema = DATABASE() AND table_name = %s'
+    else:
+        return None
+    cursor = connection.cursor()
+    cursor.execute(sql, [table_name])
+    return set(map(lambda row: row[0], cursor.fetchall()))
+
+
+def execute_index_sql(sql_statements, using=DEFAULT_DB_ALIAS):
+    cursor = connections[using].cursor()
+    for sql in sql_statements:
+        cursor.execute(sql)
+    transaction.commit_unless_managed(using=using)
+
+
+def create_tree_indexes(NODE_CLASS=None, using=DEFAULT_DB_ALIAS):
+    """Create the missing indexes in the "using" database.  Returns their names"""
+    if NODE_CLASS is None:
+        from cms_menu_node.models import Node as NODE_CLASS
+
+    existing_names = get_existing_index_names(NODE_CLASS, using) or set()
+    missing_indexes = filter(lambda index: index[0] not in existing_names, TREE_INDEXES)
+    execute_index_sql(map(lambda index: get_create_index_sql(NODE_CLASS, index[0], index[1], using), missing_indexes), using)
+    return map(lambda index: index[0], missing_indexes)
+
+
+def drop_tree_indexes(NODE_CLASS=None, using=DEFAULT_DB_ALIAS):
+    """Drop the indexes that exist in the "using" database.  Returns their names"""
+    if NODE_CLASS is None:
+        from cms_menu_node.models import Node as NODE_CLASS
+
+    existing_names = get_existing_index_names(NODE_CLASS, using)
+    index_names = get_tree_index_names()
+    if existing_names is not None:
+        index_names = filter(lambda index_name: index_name in existing_names, index_names)
+    execute_index_sql(map(lambda index_name: get_drop_index_sql(NODE_CLASS, index_name, using), index_names), using)
+    return index_names
+
+
+def create_tree_indexes_after_syncdb(sender, created_models=(), db=DEFAULT_DB_ALIAS, **kwargs):
+    """post_syncdb: add the indexes when the Node table is created.
+    "db" is the alias syncdb ran against, e.g. syncdb --database=other"""
+    from cms_menu_node.models import Node
+
+    if Node in created_models:
+        create_tree_indexes(Node, using=db)
@@ -16,4 +16,13 @@ class RootNodeAlreadyExists(Exception):
         #self.value = value
         
     def __str__(self):
-        return """Please choose a parent for node "%s"!  A root node already exists.""" % self.value
\ No newline at end of file
+        return """Please choose a parent for node "%s"!  A root node already exists.""" % self.value
+
+class InvalidNodeMove(Exception):
+    """Used to raise an exception when Node.move_to() can't place the node"""
+    def __init__(self, value, reason):
+        self.value = value
+        self.reason = reason
+
+    def __str__(self):
+        return """Node "%s" can't be moved: %s""" % (self.value, self.reason)
@@ -1,17 +1,31 @@
 from django import forms
 from cms_menu_node.models import *
+from cms_menu_node.widgets import ParentAutocompleteWidget, get_parent_autocomplete_url
+
+
+def set_parent_field(form):
+    """The "parent" picker: an autocomplete (cms_menu_node/widgets.py) if its url 
+    is available, otherwise a select box with every node"""
+    parent_field = form.fields['parent']
+    autocomplete_url = get_parent_autocomplete_url()
+    if autocomplete_url is None:
+        parent_field.choices = Node.get_admin_parent_choices()
+        return
+    parent_field.widget = ParentAutocompleteWidget(autocomplete_url, exclude_node_id=form.instance.id)
+    parent_field.widget.is_required = parent_field.required
 
 
 
 class NodeAdminForm(forms.ModelForm):
     """Admin Form for a Node
-    - Updates the "parent" choices to include indentations (displayed as a select box)
+    - Updates the "parent" choices to include indentations (displayed as a select box, 
+        or an autocomplete on large trees, see set_parent_field)
     - Some formatting of the "parent" Select box
     - Checks to make sure the "parent"" relationship is not circular
     """
     def __init__(self, *args, **kwargs):
         super(NodeAdminForm, self).__init__(*args, **kwargs)
-        self.fields['parent'].choices = Node.get_admin_parent_choices()
+        set_parent_field(self)
 
     class Meta:
         model = Node
@@ -0,0 +1,62 @@
+import json
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+from cms_menu_node.benchmark import run_benchmarks, compare_results, write_results\
+                    , DEFAULT_DEPTH, DEFAULT_FAN_OUT, DEFAULT_SAMPLES, DEFAULT_SEED, DEFAULT_ADMIN_CHOICES_MAX_NODES
+
+
+class Command(BaseCommand):
+    help = 'Time tree updates, menus and tree queries on synthetic trees, in a SQLite or PostgreSQL test database.  See cms_menu_node/benchmark.py'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--sizes', dest='sizes', default='1000,10000,100000'\
+            , help='Comma separated numbers of nodes'),
+        make_option('--depth', dest='depth', type='int', default=DEFAULT_DEPTH\
+            , help='Menu levels in the tree'),
+        make_option('--fan-out', dest='fan_out', type='int', default=DEFAULT_FAN_OUT\
+            , help='Children per node'),
+        make_option('--samples', dest='samples', type='int', default=DEFAULT_SAMPLES\
+            , help='Selected nodes (runs) for each benchmark'),
+        make_option('--seed', dest='seed', type='int', default=DEFAULT_SEED\
+            , help='Seed for choosing the sample nodes'),
+        make_option('--admin-choices-max-nodes', dest='admin_choices_max_nodes', type='int'\
+            , default=DEFAULT_ADMIN_CHOICES_MAX_NODES\
+            , help='Skip the admin parent choices benchmark on larger trees'),
+        make_option('--without-indexes', dest='with_indexes', action='store_false', default=True\
+            , help='Drop the tree indexes (cms_menu_node/db_indexes.py) first, e.g. to compare'),
+        make_option('--output', dest='output', default=None\
+            , help='Write the results to this JSON file'),
+        make_option('--compare', dest='compare', default=None\
+            , help='JSON file of earlier results to compare with'),
+        )
+
+    def handle(self, *args, **options):
+        try:
+            sizes = map(int, options['sizes'].split(','))
+        except ValueError:
+            raise CommandError('--sizes should be numbers, e.g. 1000,10000')
+
+        try:
+            results = run_benchmarks(sizes=sizes, depth=options['depth'], fan_out=options['fan_out']\
+                                , samples=options['samples'], seed=options['seed']\
+                                , admin_choices_max_nodes=options['admin_choices_max_nodes']\
+                                , with_indexes=options['with_indexes']\
+                                , verbosity=int(options.get('verbosity', 1)))
+        except ValueError, e:
+            raise CommandError(str(e))
+
+        if options['output']:
+            write_results(results, options['output'])
+            self.stdout.write('Results written to: %s\n' % options['output'])
+        else:
+            self.stdout.write(json.dumps(results, indent=2, sort_keys=True) + '\n')
+
+        if options['compare']:
+            fh = open(options['compare'])
+            try:
+                old_results = json.load(fh)
+            finally:
+                fh.close()
+            self.stdout.write('\n'.join(compare_results(old_results, results)) + '\n')
@@ -0,0 +1,24 @@
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+from django.db import DEFAULT_DB_ALIAS
+
+from cms_menu_node.db_indexes import create_tree_indexes, drop_tree_indexes
+
+
+class Command(BaseCommand):
+    help = 'Create the composite indexes for the tree queries (see cms_menu_node/db_indexes.py)'
+    
+    option_list = BaseCommand.option_list + (
+        make_option('--drop', dest='drop', action='store_true', default=False\
+            , help='Drop the indexes instead'),
+        make_option('--database', dest='database', default=DEFAULT_DB_ALIAS\
+            , help='Database alias, defaults to "default"'),
+        )
+        
+    def handle(self, *args, **options):
+        using = options['database']
+        if options['drop']:
+            self.stdout.write('Indexes dropped: %s\n' % ', '.join(drop_tree_indexes(using=using)))
+        else:
+            self.stdout.write('Indexes created: %s\n' % ', '.join(create_tree_indexes(using=using)))
@@ -0,0 +1,18 @@
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+
+from cms_menu_node.node_links import refresh_node_links
+
+
+class Command(BaseCommand):
+    help = 'Recompute the menu links (Node.cached_url, Node.link_target, Node.menu_label), e.g. after the URL conf changes'
+    
+    option_list = BaseCommand.option_list + (
+        make_option('--missing-only', dest='missing_only', action='store_true', default=False\
+            , help='Only nodes without a cached_url'),
+        )
+        
+    def handle(self, *args, **options):
+        num_changed = refresh_node_links(missing_only=options['missing_only'])
+        self.stdout.write('Menu links updated: %s\n' % num_changed)
@@ -0,0 +1,21 @@
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+
+from cms_menu_node.rebuild_queue import run_tree_rebuild_worker, DEFAULT_POLL_SECONDS
+
+
+class Command(BaseCommand):
+    help = 'Rebuild the menu tree when requested.  Use with settings.CMS_TREE_REBUILD_MODE = "background"'
+    
+    option_list = BaseCommand.option_list + (
+        make_option('--poll', dest='poll_seconds', type='float', default=DEFAULT_POLL_SECONDS\
+            , help='Seconds between checks of the rebuild queue'),
+        make_option('--debounce', dest='debounce_seconds', type='float', default=None\
+            , help='Seconds without new requests before rebuilding (default: settings.CMS_TREE_REBUILD_DEBOUNCE_SECONDS)'),
+        )
+        
+    def handle(self, *args, **options):
+        self.stdout.write('Waiting for tree rebuild requests...\n')
+        run_tree_rebuild_worker(poll_seconds=options['poll_seconds']\
+                            , debounce_seconds=options['debounce_seconds'])
@@ -1,3 +1,4 @@
+from django.core.exceptions import ObjectDoesNotExist
 from django.db import models
 from django.template.defaultfilters import slugify
 
@@ -9,6 +10,12 @@ from cms_menu_node.exceptions import ParentRelationshipCircular, RootNodeAlready
 
 BREADCRUMB_SEPARATOR = '->'
 STR_NOT_VISIBLE = '(not visible)'
+STR_NO_NODE_URL = 'Node.get_absolute_url - override this function'     # a Node without a subclass
+
+# attribute names behind get_tree_state() and get_display_state()
+TREE_STATE_ATTNAMES = ('parent_id', 'visible', 'sibling_order')
+DISPLAY_STATE_ATTNAMES = ('name', 'subclass_name', 'cached_url', 'link_target', 'menu_label')
+NOT_LOADED = object()       # a deferred field, e.g. Node.objects.only('name'), in the loaded state
 class Node(models.Model):
     """Base class for a menu item
     Initial use is to use this for a CMS and create subclasses as needed.
@@ -37,7 +44,55 @@ class Node(models.Model):
     # auto-filled by subclasses
     subclass_name = models.CharField(max_length=255, blank=True, default='')
     
+    # menu link, copied from the subclass on save--menus don't need the subclass row
+    #   (see cms_menu_node/node_links.py, "manage.py refresh_node_links" after URL changes)
+    cached_url = models.CharField(max_length=255, blank=True, default='', help_text='(auto-filled on save)')
+    link_target = models.CharField(max_length=20, blank=True, default='', help_text='(auto-filled on save)')
+    menu_label = models.CharField(max_length=255, blank=True, default='', help_text='(auto-filled on save)')
+    
+    # materialized paths, written by the tree updates (see cms_menu_node/node_paths.py)
+    #   e.g. 'food -> fruit -> apple' and '/1/2/7/'
+    breadcrumb_path = models.TextField(blank=True, default='', help_text='(auto-filled on save)')
+    ancestor_ids = models.CharField(max_length=255, blank=True, default='', db_index=True, help_text='(auto-filled on save)')
+    
+    
+    def __init__(self, *args, **kwargs):
+        super(Node, self).__init__(*args, **kwargs)
+        # snapshot of the tree-shaping (and displayed) values, compared on save
+        self._tree_state_loaded = self.get_loaded_values(TREE_STATE_ATTNAMES)
+        self._display_state_loaded = self.get_loaded_values(DISPLAY_STATE_ATTNAMES)
     
+    def get_loaded_values(self, attnames):
+        """Values already loaded, NOT_LOADED for deferred fields: reading one runs a 
+        query that builds another deferred instance--and this __init__ again"""
+        return tuple(map(lambda attname: self.__dict__.get(attname, NOT_LOADED), attnames))
+    
+    def get_tree_state(self):
+        """Values that shape the tree, see TREE_STATE_FIELDS"""
+        return (self.parent_id, self.visible, self.sibling_order)
+        
+    def set_unchanged_tree_state(self, saved_state):
+        """Tree-shaping values not changed since loading take the saved values 
+        (see TREE_STATE_FIELDS): a stale copy, e.g. saved after a rename, 
+        doesn't undo a move made through another copy.  (deferred values are 
+        read from the database when used, they are current)"""
+        loaded_state = self._tree_state_loaded
+        if self.visible == loaded_state[1]:
+            self.visible = saved_state[1]
+        if self.parent_id != loaded_state[0]:
+            return      # moved: the sibling_order goes with the new parent
+        if self.sibling_order == loaded_state[2]:
+            self.sibling_order = saved_state[2]
+        if self.parent_id != saved_state[0]:
+            self.parent_id = saved_state[0]
+            cache_name = self._meta.get_field('parent').get_cache_name()
+            if hasattr(self, cache_name):
+                delattr(self, cache_name)
+        
+    def get_display_state(self):
+        """Values shown in menus, held by the tree snapshot (slug follows the name)"""
+        return (self.name, self.subclass_name, self.cached_url, self.link_target, self.menu_label)
+        
     def show(self):
         attrs = 'id name slug parent visible sibling_order is_root menu_level left_val right_val subclass_name'.split()
         dashes()
@@ -48,24 +103,43 @@ class Node(models.Model):
         return self.name        
     
     def get_subclass_obj(self):
+        """e.g. if subclass_name = 'Page', the Page for this node.  Looked up in the 
+        registry of subclasses (tree_builder.register_node_subclass)"""
         if self.subclass_name is None or self.subclass_name == '':
             return None
         
+        # direct subclass: reverse one-to-one, e.g. self.page
+        accessor = get_node_subclass_accessors(Node).get(self.subclass_name, None)
+        if accessor is not None:
+            try:
+                return getattr(self, accessor)
+            except ObjectDoesNotExist:
+                return None
+        
+        # subclass of a subclass
+        node_subclass = get_node_subclass(self.subclass_name)
+        if node_subclass is None:
+            return None
         try:
-            # e.g. if subclass_name = 'Page', then try eval('self.page')
-            return eval('self.%s' % self.subclass_name.lower() )
-        except:
-            pass
-        return None        
+            return node_subclass.objects.get(id=self.id)
+        except node_subclass.DoesNotExist:
+            return None
         
 
     def get_absolute_url(self):
+        if self.cached_url:
+            return self.cached_url
+            
         # try use the "get_absolute_url" of the subclass such as Page, PageCustomView, PageDirectLink
         subclass_obj = self.get_subclass_obj()
         if subclass_obj is not None and 'get_absolute_url' in dir(subclass_obj):
             return subclass_obj.get_absolute_url()
 
-        return 'Node.get_absolute_url - override this function'
+        return STR_NO_NODE_URL
+        
+    def get_link_target(self):
+        """e.g. '_blank', override in subclasses"""
+        return ''
         
     
     def parent_string_for_admin(self):  
@@ -149,10 +223,22 @@ class Node(models.Model):
         pass
 
     def breadcrumb(self, exclude_leaf_node=False):
-        """Based on the rt/left MPTT values"""
+        """From the stored breadcrumb_path.  If it isn't set yet (e.g. loaded from a fixture), 
+        based on the rt/left MPTT values"""
         if self.is_root:
             return self.name
-            
+
+        if self.breadcrumb_path:
+            if exclude_leaf_node:
+                sep = ' %s ' % BREADCRUMB_SEPARATOR
+                return self.breadcrumb_path.rsplit(sep, 1)[0]
+            return self.breadcrumb_path
+
+        if self.left_val < 1:       # not on the MPTT tree (not visible), use the parent relationships
+            if exclude_leaf_node and self.parent is not None:
+                return self.parent.parent_string_for_admin()
+            return self.parent_string_for_admin()
+
         if exclude_leaf_node:       # lt / gt - exclude leaf
             qs = Node.objects.filter(left_val__lt=self.left_val, right_val__gt=self.right_val).order_by('left_val')
         else:                       # lte / gte - include leaf
@@ -177,6 +263,31 @@ class Node(models.Model):
     def breadcrumb_without_leaf(self):
         return self.breadcrumb(exclude_leaf_node=True)
         
+    def get_ancestor_ids(self):
+        """Ids from the root down to this node, from the stored ancestor_ids.  
+        If they aren't set yet (e.g. loaded from a fixture), from the parent relationships"""
+        if self.ancestor_ids:
+            return parse_ancestor_ids(self.ancestor_ids)
+        
+        ancestor_ids = [self.id]
+        parent_id = self.parent_id
+        while parent_id is not None and parent_id not in ancestor_ids:
+            ancestor_ids.insert(0, parent_id)
+            parent_ids = Node.objects.filter(id=parent_id).values_list('parent', flat=True)
+            if len(parent_ids) == 0:
+                break
+            parent_id = parent_ids[0]
+        return ancestor_ids
+        
+    def get_descendants_by_path(self, include_self=False):
+        """Descendants by the ancestor_ids prefix, including nodes that aren't visible"""
+        if not self.ancestor_ids:
+            return Node.objects.none()
+        qs = Node.objects.filter(ancestor_ids__startswith=self.ancestor_ids)
+        if not include_self:
+            qs = qs.exclude(id=self.id)
+        return qs
+        
     
     def is_left_node(self):
         """A leaf node has no desendants"""
@@ -198,31 +309,69 @@ class Node(models.Model):
         # something is wrong with lft/rt vals -- or they are not set
         return -1
     
+    def move_to(self, target, position='last-child'):
+        """Move this node, with its descendants, relative to "target":
+            'first-child', 'last-child' - first/last child of target
+            'left', 'right' - the sibling just before/after target
+        
+        e.g. get_node('tropical').move_to(get_node('vegetable'), 'first-child')
+        
+        Sets the parent and sibling_order, then saves.  The save shifts the 
+        subtree's left/right values in SQL (tree_builder.move_subtree), as 
+        it does for a parent changed in the admin.
+        Raises InvalidNodeMove or ParentRelationshipCircular"""
+        def move():
+            lock_tree()     # target's left/right values can't change until the move is done
+            new_parent_id, self.sibling_order = get_move_destination(Node, self, target, position)
+            if new_parent_id == target.id:
+                self.parent = target
+            else:
+                self.parent = Node.objects.get(id=new_parent_id)
+            self.save()
+            
+        run_in_transaction(move)
+        
     def delete(self):
         """Before deleting the node, assign a new parent to its children 
-        and clear the parent FK connections"""
-
-        disconnect_node_signals(Node)
+        and clear the parent FK connections.
+        
+        The children are reassigned with one UPDATE and post_delete then shifts 
+        the tree once--in one transaction, with the tree lock held"""
+        run_in_transaction(self.delete_and_promote_children)
+        
+    def delete_and_promote_children(self):
+        lock_tree()
+        
+        # current left/right values, used to shift the tree after the delete
+        if self.id:
+            tree_vals = Node.objects.filter(id=self.id).values_list('left_val', 'right_val', 'is_root', 'parent', 'ancestor_ids')
+            if len(tree_vals) == 1:
+                self.left_val, self.right_val, self.is_root, self.parent_id, self.ancestor_ids = tree_vals[0]
+
+        # reassign the children with UPDATE statements: no saves, no signals
+        #   (the FK connections are cleared as well, the delete won't cascade to the children)
+        children = Node.objects.filter(parent=self.id)
+        if self.is_root:            # is this the root mode
+            # new parent is 1st child; awkward but preserves family:)
+            first_child_ids = children.order_by('left_val', 'sibling_order', 'id').values_list('id', flat=True)[:1]
+            if len(first_child_ids) == 1:
+                new_root_id = first_child_ids[0]
+                Node.objects.filter(id=new_root_id).update(parent=None, is_root=True)    # makes 1st child the new root
+                children.update(parent=new_root_id)
+        else:
+            children.update(parent=self.parent_id)      # new parent is grandparent
+        
+        # children now belong to the parent; post_delete can shift the tree instead of rebuilding
+        #   for a subclass, e.g. Page, post_delete is sent with the Node parent object
+        nodes_to_flag = [self]
+        node_ptr_field = self._meta.get_ancestor_link(Node)
+        if node_ptr_field is not None:
+            nodes_to_flag.append(getattr(self, node_ptr_field.name))
+        for n in nodes_to_flag:
+            n.left_val, n.right_val, n.is_root = self.left_val, self.right_val, self.is_root
+            n.ancestor_ids = self.ancestor_ids
+            n._tree_children_promoted = True
 
-        children = self.node_set.all()
-        if children.count() > 0:        # does the node have children
-            if self.is_root:            # is this the root mode
-                new_parent = children[0]    # new parent is 1st child; awkward but preserves family:)
-                new_parent.parent = None    # makes parent the new root
-                new_parent.save()
-            else:
-                new_parent = self.parent    # new parent is grandparent
-
-            for c in children:
-                if c.id == new_parent.id:
-                    pass    # if self is a root node, pass, new root will be this child
-                else:
-                    c.parent = new_parent                    
-                    c.save()
-                        
-        self.node_set.clear()   # clear the FK connections
-
-        connect_node_signals(Node)                                
         super(Node, self).delete()
         #rebuild_tree_after_node_saved()
      
@@ -237,7 +386,21 @@ class Node(models.Model):
         - kwargs used so unit tests run correctly
 
         """
-        if Node.is_parent_relationship_circular(self, self.parent):
+        # The MPTT values and paths belong to the tree builder:
+        #   - keep the saved values, an older copy in memory may be out of date
+        #   - remember the tree-shaping values last saved, used for incremental tree updates
+        self._tree_state_before_save = None
+        if self.id:
+            saved_vals = Node.objects.filter(id=self.id).values_list('left_val', 'right_val', 'menu_level'\
+                                                    , 'breadcrumb_path', 'ancestor_ids', *TREE_STATE_FIELDS)
+            if len(saved_vals) == 1:
+                self.left_val, self.right_val, self.menu_level, self.breadcrumb_path, self.ancestor_ids = saved_vals[0][:5]
+                self._tree_state_before_save = tuple(saved_vals[0][5:])
+                self.set_unchanged_tree_state(self._tree_state_before_save)
+        
+        # an unchanged parent was checked when it was saved
+        if self._tree_state_before_save is not None and self.parent_id != self._tree_state_before_save[0]\
+                and Node.is_parent_relationship_circular(self, self.parent):
             # this is handled in the cms_menu_node.forms
             # will throw Exception if actually reached here via cmd line or something
             raise ParentRelationshipCircular(self)
@@ -257,7 +420,24 @@ class Node(models.Model):
 
         self.slug = slugify(self.name)
         
+        is_new_node = self.id is None
+        set_node_link(self)
+        
+        # Did the parent, visible or sibling_order change from the saved values?  If not, skip the tree update
+        self._tree_state_changed = self._tree_state_before_save is None\
+                                    or self.get_tree_state() != self._tree_state_before_save
+        self._display_state_changed = self.get_display_state() != self._display_state_loaded
+        
+        self._tree_save_id = get_next_save_id()
         super(Node, self).save(kwargs)
+        
+        # a new node may need its id for the URL (e.g. PageCustomView)
+        if is_new_node and not self.cached_url and set_node_link(self):
+            Node.objects.filter(id=self.id).update(cached_url=self.cached_url, link_target=self.link_target\
+                                                , menu_label=self.menu_label)
+        
+        self._tree_state_loaded = self.get_tree_state()
+        self._display_state_loaded = self.get_display_state()
     
     class Meta:
         ordering = ('left_val', )
@@ -269,9 +449,10 @@ class Node(models.Model):
         # Used in the admin for display of the "parent" attribute--to show its menu level
         #
         #   usual: __unicode__(self)
-        #   replacement: __parent_string_for_admin__(self)
+        #   replacement: the breadcrumb, e.g. "food -> fruit"
         #
-        choices = map(lambda x: (x.id, x.parent_string_for_admin()), Node.objects.filter(visible=True))
+        # from the stored breadcrumb_path, one query, reloaded when the tree version changes
+        choices = list(get_admin_parent_choices(Node))
         if len(choices) == 0:
             return [('', '----------')]
         else:
@@ -304,33 +485,99 @@ class Node(models.Model):
             ex 2/   food <- fruit <- yellow <- banana
                     banana <- food
             etc.            
+
+            Uses the left/right values when they're current, otherwise a recursive query
         """
-        if new_parent and instance:
-            if instance.id == new_parent.id:
-                return True
-                
-        # This will be a new root
-        if instance and new_parent is None:           
-            return False
+        if instance is None or new_parent is None:
+            return False        # This will be a new root
 
         # case: p1 -> p1    
-        if instance == new_parent or instance == instance.parent:
+        if instance is new_parent or (instance.id is not None and instance.id == new_parent.id):
             return True
-
-        parent = new_parent
-        plist = [instance]
-        while parent:
-            if parent in plist:
+        
+        # a new node (or parent) has nothing below it
+        if instance.id is None or new_parent.id is None:
+            return False
+        
+        # One query.  While the left/right values are current: 
+        #   - both on the tree: is new_parent inside instance's left/right range?
+        #   - only new_parent on the tree: instance is hidden, its descendants are off the tree too
+        if are_tree_values_current():
+            tree_vals = dict(map(lambda x: (x[0], x[1:]), Node.objects.filter(id__in=[instance.id, new_parent.id])\
+                                                .values_list('id', 'left_val', 'right_val').order_by()))
+            if len(tree_vals) == 2 and tree_vals[new_parent.id][0] > 0:
+                left_val, right_val = tree_vals[instance.id]
+                return left_val > 0 and left_val < tree_vals[new_parent.id][0] < right_val
+                    
+        # Otherwise follow the saved parents up from new_parent
+        is_circular = is_descendant_in_db(Node, new_parent.id, instance.id)
+        if is_circular is not None:
+            return is_circular
+            
+        # no recursive queries: one query per level
+        parent_id = new_parent.id
+        seen_ids = set()
+        while parent_id is not None and parent_id not in seen_ids:
+            if parent_id == instance.id:
                 return True
-            plist.append(parent)
-            parent = parent.parent     
+            seen_ids.add(parent_id)
+            parent_ids = Node.objects.filter(id=parent_id).values_list('parent', flat=True)
+            parent_id = parent_ids[0] if len(parent_ids) > 0 else None
         
         return False
 
+
+class TreeVersion(models.Model):
+    """A single row holding the tree generation.
+    Incremented each time the left/right values are rewritten, so readers 
+    (menus, caches) know when the new values are live"""
+    version = models.IntegerField(default=0)
+    modified = models.DateTimeField(auto_now=True)
+    
+    def __unicode__(self):
+        return '%s' % self.version
+        
+        
+class TreeRebuildRequest(models.Model):
+    """Queue for the background tree rebuild.  
+    Used when settings.CMS_TREE_REBUILD_MODE = 'background'"""
+    requested = models.DateTimeField(auto_now_add=True)
+    
+    def __unicode__(self):
+        return '%s' % self.requested
+        
+    class Meta:
+        ordering = ('id', )
+        
+
 # ------------------------------------------
 # SIGNALS for saving a node
 # ------------------------------------------
 
-from cms_menu_node.tree_builder import connect_node_signals, disconnect_node_signals, rebuild_tree_after_node_saved
-
-connect_node_signals(Node)  # connect signals to rebuild tree and ensure one root 
+from django.db.models.signals import class_prepared
+from cms_menu_node.tree_builder import connect_node_signals, rebuild_tree_after_node_saved, TREE_STATE_FIELDS\
+                    , register_node_subclass, get_next_save_id, run_in_transaction, lock_tree\
+                    , get_move_destination, are_tree_values_current, is_descendant_in_db\
+                    , get_node_subclass, get_node_subclass_accessors, register_deferred_node_class
+from cms_menu_node.node_links import set_node_link
+from cms_menu_node.node_paths import parse_ancestor_ids, get_admin_parent_choices
+
+connect_node_signals(Node)  # connect signals to rebuild tree and ensure one root
+
+def connect_node_subclass_signals(sender, **kwargs):
+    """Page, PageDirectLink, etc: connect the post_save signal for each Node subclass.
+    Also for the deferred classes, e.g. Node.objects.only('name'), saved with the deferred class as sender"""
+    if not issubclass(sender, Node) or sender is Node:
+        return
+    if getattr(sender, '_deferred', False):
+        register_deferred_node_class(sender)
+    else:
+        register_node_subclass(sender)
+
+class_prepared.connect(connect_node_subclass_signals) 
+
+# composite indexes for the tree queries, see cms_menu_node/db_indexes.py
+from django.db.models.signals import post_syncdb
+from cms_menu_node.db_indexes import create_tree_indexes_after_syncdb
+
+post_syncdb.connect(create_tree_indexes_after_syncdb, dispatch_uid='cms_menu_node_tree_indexes')
@@ -0,0 +1,85 @@
+"""
+Menu links copied onto the Node row: cached_url, link_target and menu_label.
+
+A menu link needs the URL and label (e.g. the Page title) of the subclass (Page,
+PageDirectLink, etc).  They are computed when the node is saved, so menus and 
+breadcrumbs can be built from Node rows alone.
+
+After a URL conf change, refresh the stored links:
+
+    manage.py refresh_node_links
+
+A full tree rebuild (tree_builder.rebuild_tree_full) fills in missing links.
+"""
+from django.core.urlresolvers import NoReverseMatch
+
+from cms_common.msg_util import *
+
+REFRESH_BATCH_SIZE = 500
+
+NODE_LINK_FIELDS = ('cached_url', 'link_target', 'menu_label')
+
+CACHED_URL_MAX_LENGTH = 255
+LINK_TARGET_MAX_LENGTH = 20
+MENU_LABEL_MAX_LENGTH = 255
+
+
+def get_node_link(node):
+    """(url, target, label) for a Node or subclass instance.  The url and label 
+    are '' if the node has no subclass; the url is '' if it can't be reversed"""
+    node_obj = node
+    if node.subclass_name and node.__class__.__name__ != node.subclass_name:
+        node_obj = node.get_subclass_obj()      # e.g. the Page of a Node
+        if node_obj is None:
+            return ('', '', '')
+        node_obj.name, node_obj.slug = node.name, node.slug     # the node may be renamed
+    elif not node.subclass_name:
+        return ('', node.get_link_target(), '')
+
+    try:
+        url = node_obj.get_absolute_url() or ''
+    except NoReverseMatch:
+        url = ''
+    return (url[:CACHED_URL_MAX_LENGTH], node_obj.get_link_target()[:LINK_TARGET_MAX_LENGTH]\
+            , unicode(node_obj)[:MENU_LABEL_MAX_LENGTH])     # e.g. a Page shows its title
+
+
+def get_stored_node_link(node):
+    return tuple(map(lambda field_name: getattr(node, field_name), NODE_LINK_FIELDS))
+
+
+def set_node_link(node):
+    """Set node.cached_url, node.link_target and node.menu_label.  Returns True if any changed"""
+    link = get_node_link(node)
+    if link == get_stored_node_link(node):
+        return False
+    node.cached_url, node.link_target, node.menu_label = link
+    return True
+
+
+def refresh_node_links(missing_only=False, batch_size=REFRESH_BATCH_SIZE):
+    """Recompute the links of the subclassed nodes (all, or those without a cached_url)
+    and write the changed ones.  Returns the number of nodes changed"""
+    from cms_menu_node.models import Node
+    from cms_menu_node.tree_builder import run_tree_update, get_node_subclass_accessors, bulk_update_node_values
+
+    qs = Node.objects.exclude(subclass_name='')
+    if missing_only:
+        qs = qs.filter(cached_url='')
+    node_ids = list(qs.values_list('id', flat=True))
+    if not node_ids:
+        return 0
+
+    def write_node_links():
+        subclass_accessors = get_node_subclass_accessors(Node)
+        changed_links = {}      # { node id : (cached_url, link_target, menu_label) }
+        for idx in range(0, len(node_ids), batch_size):
+            # each node joined to its subclass row, one query per batch
+            for nd in Node.objects.select_related(*subclass_accessors.values()).filter(id__in=node_ids[idx:idx+batch_size]):
+                link = get_node_link(nd)
+                if link != get_stored_node_link(nd):
+                    changed_links[nd.id] = link
+        bulk_update_node_values(Node, NODE_LINK_FIELDS, changed_links)
+        return len(changed_links) or None       # None: no tree version change
+
+    return run_tree_update(write_node_links) or 0
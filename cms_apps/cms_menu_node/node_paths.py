@@ -0,0 +1,174 @@
+"""
+Materialized paths on each Node, kept up to date by the tree updates (tree_builder):
+
+    breadcrumb_path - e.g. 'food -> fruit -> apple', the same string as Node.breadcrumb()
+    ancestor_ids    - e.g. '/1/2/7/', ids from the root down to the node itself
+
+Descendants share the ancestor_ids prefix of a node, so they can be found with
+an indexed prefix match:
+
+    Node.objects.filter(ancestor_ids__startswith=node.ancestor_ids)
+
+Paths follow the parent relationships, so nodes that aren't visible have them too.
+
+The admin parent choices are the stored breadcrumbs, cached per tree version:
+
+    get_admin_parent_choices(Node)
+"""
+import threading
+
+from cms_common.msg_util import *
+
+# one query for the values used to compute the paths
+PATH_ROW_FIELDS = ('id', 'parent', 'name', 'visible', 'is_root', 'breadcrumb_path', 'ancestor_ids')
+PATH_FIELDS = ('breadcrumb_path', 'ancestor_ids')
+
+ANCESTOR_ID_SEPARATOR = '/'
+
+
+def get_ancestor_ids_string(parent_ancestor_ids, node_id):
+    """e.g. ('/1/2/', 7) -> '/1/2/7/'"""
+    if not parent_ancestor_ids:
+        parent_ancestor_ids = ANCESTOR_ID_SEPARATOR
+    return '%s%s%s' % (parent_ancestor_ids, node_id, ANCESTOR_ID_SEPARATOR)
+
+
+def parse_ancestor_ids(ancestor_ids):
+    """e.g. '/1/2/7/' -> [1, 2, 7]"""
+    if not ancestor_ids:
+        return []
+    return map(int, filter(None, ancestor_ids.split(ANCESTOR_ID_SEPARATOR)))
+
+
+def get_breadcrumb_string(parent_breadcrumb, name, visible, is_top):
+    """Same rules as Node.parent_string_for_admin()"""
+    from cms_menu_node.models import BREADCRUMB_SEPARATOR, STR_NOT_VISIBLE
+
+    if is_top:
+        return name
+    if visible:
+        return '%s %s %s' % (parent_breadcrumb, BREADCRUMB_SEPARATOR, name)
+    return '%s %s %s (%s)' % (parent_breadcrumb, BREADCRUMB_SEPARATOR, name, STR_NOT_VISIBLE)
+
+
+def compute_node_paths(rows, parent_paths=None):
+    """rows: PATH_ROW_FIELDS values of the nodes to compute
+    parent_paths: { node id : (breadcrumb_path, ancestor_ids) } for parents not in rows
+
+    Returns { node id : (breadcrumb_path, ancestor_ids) } for the rows"""
+    row_lu = dict(map(lambda row: (row[0], row), rows))
+    known_paths = dict(parent_paths or {})
+    node_paths = {}
+
+    for node_id in row_lu.keys():
+        if node_id in node_paths:
+            continue
+        # walk up to a node with a known path (or the top), then compute on the way down
+        chain = []
+        current_id = node_id
+        while current_id in row_lu and current_id not in node_paths and current_id not in chain:
+            chain.append(current_id)
+            current_id = row_lu[current_id][1]
+
+        for chain_id in reversed(chain):
+            chain_id, parent_id, name, visible, is_root = row_lu[chain_id][:5]
+            parent_path = node_paths.get(parent_id, None) or known_paths.get(parent_id, None)
+            is_top = is_root or parent_id is None or parent_path is None
+            if is_top:
+                parent_path = ('', '')
+            node_paths[chain_id] = (get_breadcrumb_string(parent_path[0], name, visible, is_top)\
+                                    , get_ancestor_ids_string(parent_path[1], chain_id))
+    return node_paths
+
+
+def write_node_paths(NODE_CLASS, rows, node_paths):
+    """Write the paths that changed"""
+    from cms_menu_node.tree_builder import bulk_update_node_values
+
+    stored_paths = dict(map(lambda row: (row[0], tuple(row[5:7])), rows))
+    changed_paths = {}
+    for node_id, paths in node_paths.iteritems():
+        if stored_paths.get(node_id) != paths:
+            changed_paths[node_id] = paths
+    bulk_update_node_values(NODE_CLASS, PATH_FIELDS, changed_paths)
+
+
+def refresh_all_node_paths(NODE_CLASS):
+    """Recompute every path, e.g. after a full tree rebuild.  Call with the tree lock held"""
+    rows = list(NODE_CLASS.objects.values_list(*PATH_ROW_FIELDS).order_by())
+    node_paths = compute_node_paths(rows)
+    write_node_paths(NODE_CLASS, rows, node_paths)
+    return node_paths
+
+
+def refresh_node_paths(NODE_CLASS, node_ids, old_ancestor_ids=None):
+    """Recompute the paths of node_ids and of the nodes under old_ancestor_ids
+    (their descendants, before a move or rename).  Call with the tree lock held.
+
+    Returns { node id : (breadcrumb_path, ancestor_ids) }"""
+    from django.db.models import Q
+
+    node_filter = Q(id__in=list(node_ids))
+    if old_ancestor_ids:
+        node_filter = node_filter | Q(ancestor_ids__startswith=old_ancestor_ids)
+    rows = list(NODE_CLASS.objects.filter(node_filter).values_list(*PATH_ROW_FIELDS).order_by())
+
+    row_ids = set(map(lambda row: row[0], rows))
+    outside_parent_ids = set(filter(lambda parent_id: parent_id is not None and parent_id not in row_ids\
+                                , map(lambda row: row[1], rows)))
+    parent_paths = {}
+    if outside_parent_ids:
+        for parent_id, breadcrumb_path, ancestor_ids in NODE_CLASS.objects.filter(id__in=outside_parent_ids)\
+                                                .values_list('id', *PATH_FIELDS):
+            if not ancestor_ids:
+                return refresh_all_node_paths(NODE_CLASS)   # paths never computed, e.g. loaded from a fixture
+            parent_paths[parent_id] = (breadcrumb_path, ancestor_ids)
+
+    node_paths = compute_node_paths(rows, parent_paths)
+    write_node_paths(NODE_CLASS, rows, node_paths)
+    return node_paths
+
+
+def set_node_paths(node, node_paths):
+    """Copy computed paths onto an in-memory node"""
+    if node is None or node.id not in node_paths:
+        return
+    node.breadcrumb_path, node.ancestor_ids = node_paths[node.id]
+
+
+# ------------------------------------------
+# Admin parent choices, one list per process, reloaded when the tree version changes
+# ------------------------------------------
+_admin_choices_lock = threading.Lock()
+_admin_choices = None       # (version key, choices)
+
+def load_admin_parent_choices(NODE_CLASS):
+    """[(node id, breadcrumb), ...] for the visible nodes, in left_val order.  One query"""
+    rows = list(NODE_CLASS.objects.filter(visible=True).order_by('left_val', 'id').values_list('id', 'breadcrumb_path'))
+    if filter(lambda row: not row[1], rows):
+        # paths not stored yet, e.g. loaded from a fixture: compute them, without writing
+        node_paths = compute_node_paths(NODE_CLASS.objects.values_list(*PATH_ROW_FIELDS).order_by())
+        rows = map(lambda row: (row[0], node_paths[row[0]][0]), rows)
+    return rows
+
+
+def get_admin_parent_choices(NODE_CLASS):
+    """The choices for the current tree version.  One query to check the
+    version, plus one to load the choices after it changes"""
+    global _admin_choices
+    from cms_menu_node.tree_builder import get_tree_version_key
+
+    version_key = get_tree_version_key()    # read before the rows: a newer tree only causes an extra reload
+    cached = _admin_choices
+    if cached is not None and cached[0] == version_key:
+        return cached[1]
+
+    with _admin_choices_lock:
+        if _admin_choices is None or _admin_choices[0] != version_key:
+            _admin_choices = (version_key, load_admin_parent_choices(NODE_CLASS))
+        return _admin_choices[1]
+
+
+def clear_admin_parent_choices():
+    global _admin_choices
+    _admin_choices = None
@@ -0,0 +1,117 @@
+"""
+Optional background rebuild of the menu tree.
+
+In settings.py:
+
+    CMS_TREE_REBUILD_MODE = 'background'    # default is 'immediate'
+    CMS_TREE_REBUILD_DEBOUNCE_SECONDS = 2   # wait for edits to stop before rebuilding
+    CMS_TREE_REBUILD_WORKER = 'thread'      # or 'process': run "manage.py run_tree_rebuild_worker"
+
+Saving a Node adds a row to the TreeRebuildRequest table.  The worker waits until
+no new requests arrive for the debounce period, rebuilds the tree once and
+increments the tree version (cms_menu_node.tree_builder.get_tree_version())
+"""
+import threading
+import time
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import connection
+from django.utils import timezone
+
+from cms_common.msg_util import *
+
+REBUILD_MODE_IMMEDIATE = 'immediate'
+REBUILD_MODE_BACKGROUND = 'background'
+
+WORKER_THREAD = 'thread'
+WORKER_PROCESS = 'process'
+
+DEFAULT_DEBOUNCE_SECONDS = 2
+DEFAULT_POLL_SECONDS = 1
+
+
+def is_background_rebuild():
+    return getattr(settings, 'CMS_TREE_REBUILD_MODE', REBUILD_MODE_IMMEDIATE) == REBUILD_MODE_BACKGROUND
+
+def get_debounce_seconds():
+    return getattr(settings, 'CMS_TREE_REBUILD_DEBOUNCE_SECONDS', DEFAULT_DEBOUNCE_SECONDS)
+
+
+def enqueue_tree_rebuild():
+    """Mark the tree as dirty.  Starts the worker thread, if needed"""
+    from cms_menu_node.models import TreeRebuildRequest
+    
+    TreeRebuildRequest.objects.create()
+    
+    if getattr(settings, 'CMS_TREE_REBUILD_WORKER', WORKER_THREAD) == WORKER_THREAD:
+        start_tree_rebuild_worker()
+        
+
+def process_rebuild_queue(debounce_seconds=None):
+    """Rebuild the tree if there are requests and none arrived during the debounce period
+    Returns True if the tree was rebuilt"""
+    from cms_menu_node.models import Node, TreeRebuildRequest
+    from cms_menu_node.tree_builder import rebuild_tree_full
+    
+    if debounce_seconds is None:
+        debounce_seconds = get_debounce_seconds()
+        
+    latest_requests = TreeRebuildRequest.objects.order_by('-id').values_list('id', 'requested')[:1]
+    if len(latest_requests) == 0:
+        return False        # nothing to do
+    
+    latest_id, latest_requested = latest_requests[0]
+    if latest_requested > timezone.now() - timedelta(seconds=debounce_seconds):
+        return False        # edits still arriving
+    
+    rebuild_tree_full(Node)     # waits for the tree lock if a save is updating the tree
+    
+    # requests that arrived during the rebuild stay in the queue
+    TreeRebuildRequest.objects.filter(id__lte=latest_id).delete()
+    return True
+        
+        
+class TreeRebuildWorker(threading.Thread):
+    """Polls the TreeRebuildRequest table and rebuilds the tree"""
+    
+    def __init__(self, poll_seconds=DEFAULT_POLL_SECONDS, debounce_seconds=None):
+        super(TreeRebuildWorker, self).__init__(name='TreeRebuildWorker')
+        self.daemon = True
+        self.poll_seconds = poll_seconds
+        self.debounce_seconds = debounce_seconds
+        self.stop_event = threading.Event()
+        
+    def run(self):
+        while not self.stop_event.is_set():
+            try:
+                process_rebuild_queue(self.debounce_seconds)
+            except Exception, e:
+                msg('TreeRebuildWorker error: %s' % e)
+            finally:
+                connection.close()      # the thread has its own connection
+            self.stop_event.wait(self.poll_seconds)
+
+    def stop(self):
+        self.stop_event.set()
+        
+
+_worker_lock = threading.Lock()
+_worker = None
+
+def start_tree_rebuild_worker(**kwargs):
+    """Start one worker thread per process"""
+    global _worker
+    with _worker_lock:
+        if _worker is None or not _worker.is_alive():
+            _worker = TreeRebuildWorker(**kwargs)
+            _worker.start()
+    return _worker
+    
+    
+def run_tree_rebuild_worker(poll_seconds=DEFAULT_POLL_SECONDS, debounce_seconds=None):
+    """Run in the foreground, e.g. from "manage.py run_tree_rebuild_worker" """
+    while True:
+        process_rebuild_queue(debounce_seconds)
+        connection.close()
+        time.sleep(poll_seconds)
@@ -0,0 +1,61 @@
+import unittest
+from django.test import TestCase
+from cms_common.msg_util import *
+from cms_menu_node.models import Node
+from cms_menu_node.tree_builder import suspend_tree_updates
+from cms_menu_node.benchmark import get_tree_rows, create_tree, time_runs
+from cms_menu_node.db_indexes import get_tree_index_names, get_existing_index_names, create_tree_indexes\
+                    , get_create_index_sql, create_tree_indexes_after_syncdb
+
+class BenchmarkTreeTest(TestCase):
+    """Synthetic trees for the benchmarks (manage.py benchmark_tree)"""
+
+    def runTest(self):
+        #--------------------------------------------
+        msgt('Tree shape: depth and fan-out')
+        rows = get_tree_rows(15, 3, 4)
+        self.assertEqual(len(rows), 15)
+        self.assertEqual(rows[:3], [(1, None, 1), (2, 1, 1), (3, 1, 2)])
+        self.assertEqual(len(filter(lambda row: row[1] == 2, rows)), 4)
+        self.assertRaises(ValueError, get_tree_rows, 30, 3, 4)      # at most 1 + 4 + 16 nodes
+        msg('ok')
+
+        #--------------------------------------------
+        msgt('Created tree has MPTT values')
+        with suspend_tree_updates():
+            Node.objects.all().delete()     # the benchmarks start with an empty table
+        create_tree(40, 4, 3)
+        self.assertEqual(Node.objects.count(), 40)
+        root = Node.objects.get(is_root=True)
+        self.assertEqual((root.left_val, root.right_val), (1, 80))
+        self.assertEqual(Node.objects.filter(left_val__lt=1).count(), 0)
+        self.assertEqual(Node.objects.get(id=40).menu_level, 4)
+        msg('ok')
+
+        #--------------------------------------------
+        msgt('Time and queries per run')
+        stats = time_runs(lambda node_id: Node.objects.get(id=node_id).breadcrumb(), [(5,), (20,)])
+        self.assertEqual(stats['runs'], 2)
+        self.assertEqual(stats['queries_per_run'], 1)     # the get; the breadcrumb is stored on the row
+        self.assertEqual(stats['min_ms'] <= stats['mean_ms'] <= stats['max_ms'], True)
+        msg('ok')
+
+        #--------------------------------------------
+        msgt('Tree indexes, created after syncdb')
+        # (no EXPLAIN or DROP INDEX here: SQLite commits before them, the test couldn't roll back)
+        index_names = get_tree_index_names()
+        self.assertEqual(set(index_names) <= get_existing_index_names(Node), True)
+        self.assertEqual(create_tree_indexes(), [])         # nothing missing
+        self.assertEqual(get_create_index_sql(Node, 'cms_menu_node_node_root_visible', ('is_root', 'visible'))\
+                        , 'CREATE INDEX "cms_menu_node_node_root_visible" ON "cms_menu_node_node" ("is_root", "visible")')
+        msg('ok')
+
+        #--------------------------------------------
+        msgt('Tree indexes use the syncdb database alias')
+        from django.db.utils import ConnectionDoesNotExist
+        self.assertEqual(create_tree_indexes(using='default'), [])
+        self.assertEqual(create_tree_indexes_after_syncdb(None, created_models=[Node], db='default'), None)
+        self.assertRaises(ConnectionDoesNotExist, create_tree_indexes_after_syncdb\
+                        , None, created_models=[Node], db='no-such-database')
+        create_tree_indexes_after_syncdb(None, created_models=[], db='no-such-database')     # Node not created there
+        msg('ok')
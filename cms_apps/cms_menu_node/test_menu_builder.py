@@ -125,4 +125,207 @@ class MenuBuilderTest(TestCase):
         self.assertEqual(menu_builder.get_num_menu_items(), 1)
         menu_builder.show_menu_items()
         
-        
\ No newline at end of file
+        
+
+MENU_ITEM_FLAGS = ('active_path', 'active_branch', 'selected_node', 'is_node_first_sibling', 'is_node_last_sibling')
+
+def get_menu_item_values(menu_items):
+    """id, level, label, URL and flags of each menu item--to compare the query and snapshot menus"""
+    return map(lambda x: (x.id, x.menu_level, unicode(x), x.get_absolute_url())\
+                    + tuple(map(lambda f: bool(getattr(x, f, False)), MENU_ITEM_FLAGS))\
+                , menu_items)
+
+
+class MenuBuilderSnapshotTest(TestCase):
+    """MenuBuilder built from the tree snapshot matches the MenuBuilder queries"""
+    fixtures = ['cms_menu_node_test_data.json']
+    urls = 'cms_page.tests'     # Page URLs
+
+    def check_menus_match(self):
+        from cms_menu_node.tree_snapshot import get_tree_snapshot
+        snapshot = get_tree_snapshot()
+        
+        menu_kwargs = [ {}, { 'is_left_menu' : True }, { 'build_full_tree_to_level3' : True } ]
+        selected_nodes = [None] + list(Node.objects.filter(visible=True, left_val__gt=0))
+        num_checked = 0
+        for selected_node in selected_nodes:
+            for kwargs in menu_kwargs:
+                for include_root_node in (True, False):
+                    for exclude_selected in (False, True):
+                        kwargs.update({ 'selected_node' : selected_node\
+                                    , 'include_root_node' : include_root_node\
+                                    , 'breadcrumb_exclude_selected_node' : exclude_selected })
+                        mb_query = MenuBuilder(**kwargs)
+                        with self.assertNumQueries(0):
+                            mb_snapshot = MenuBuilder(tree_snapshot=snapshot, **kwargs)
+                        
+                        self.assertEqual(get_menu_item_values(mb_snapshot.get_menu_items())\
+                                        , get_menu_item_values(mb_query.get_menu_items()))
+                        self.assertEqual(get_menu_item_values(mb_snapshot.get_breadcrumb_nodes())\
+                                        , get_menu_item_values(mb_query.get_breadcrumb_nodes()))
+                        self.assertEqual(map(lambda x: x.breadcrumb(), mb_snapshot.get_breadcrumb_nodes())\
+                                        , map(lambda x: x.breadcrumb(), mb_query.get_breadcrumb_nodes()))
+                        self.assertEqual(mb_snapshot.active_path_ids, mb_query.active_path_ids)
+                        for level in (2, 3):
+                            item_query = mb_query.get_menu_item_on_active_path(level)
+                            item_snapshot = mb_snapshot.get_menu_item_on_active_path(level)
+                            self.assertEqual(getattr(item_snapshot, 'id', None), getattr(item_query, 'id', None))
+                        num_checked += 1
+        return num_checked
+
+    def runTest(self):
+        from django.contrib.auth.models import User
+        from cms_menu_node.tree_snapshot import clear_tree_snapshot
+        clear_tree_snapshot()
+
+        # a Page shows its title, not its name
+        author = User.objects.create(username='author')
+        Page(name='lamb', title='Lamb Recipes', content='lamb', author=author, parent=get_node('meat')).save()
+        Page(name='fig', title='Fig Recipes', content='fig', author=author, parent=get_node('local')).save()
+
+        #--------------------------------------------
+        msgt('Snapshot menus match the query menus: every node selected, every menu type')
+        msg('menus checked: %s' % self.check_menus_match())
+        
+        #--------------------------------------------
+        msgt('Move "tropical" under "beef", delete "root", then check again')
+        get_node('tropical').move_to(get_node('beef'), 'first-child')
+        get_node('root').delete()
+        msg('menus checked: %s' % self.check_menus_match())
+        
+        #--------------------------------------------
+        msgt('Hide "vegetable" and "beef": their visible descendants are off the tree, in neither menu')
+        for name in ('vegetable', 'beef'):
+            node = get_node(name)
+            node.visible = False
+            node.save()
+        self.assertEqual(get_node('tomato').left_val, -1)
+        self.assertEqual(get_node('papaya').left_val, -1)
+        msg('menus checked: %s' % self.check_menus_match())
+        mb = MenuBuilder(build_full_tree_to_level3=True)
+        self.assertEqual(filter(lambda x: x.left_val < 1, mb.get_menu_items()), [])
+        
+        #--------------------------------------------
+        msgt('URL of a snapshot menu item comes from the subclass')
+        mb = MenuBuilder(use_tree_snapshot=True)
+        self.assertEqual(mb.get_menu_items()[0].get_absolute_url(), Node.objects.get(id=mb.get_menu_items()[0].id).get_absolute_url())
+        msg('ok')
+
+
+class MenuBuilderQueryCountTest(TestCase):
+    """One query for the ancestor chain (breadcrumbs, active path, level-N items) plus one for the menu"""
+    fixtures = ['cms_menu_node_test_data.json']
+
+    def runTest(self):
+        msgt('Query count for each node and menu type')
+        for node in Node.objects.filter(visible=True):
+            for kwargs in ({}, { 'is_left_menu' : True }, { 'build_full_tree_to_level3' : True }\
+                          , { 'breadcrumb_exclude_selected_node' : True }):
+                with self.assertNumQueries(2):
+                    mb = MenuBuilder(selected_node=node, count_queries=True, **kwargs)
+                self.assertEqual(mb.num_queries, 2)
+
+                ancestor_ids = list(Node.objects.filter(visible=True, left_val__lte=node.left_val\
+                                , right_val__gte=node.right_val).order_by('left_val').values_list('id', flat=True))
+                self.assertEqual(mb.active_path_ids, ancestor_ids)
+                breadcrumb_ids = map(lambda x: x.id, mb.get_breadcrumb_nodes())
+                if kwargs.get('breadcrumb_exclude_selected_node', False):
+                    self.assertEqual(breadcrumb_ids, ancestor_ids[:-1])
+                else:
+                    self.assertEqual(breadcrumb_ids, ancestor_ids)
+
+                with self.assertNumQueries(0):
+                    for item_num in range(1, len(ancestor_ids) + 1):
+                        self.assertEqual(mb.get_menu_item_on_active_path(item_num).id, ancestor_ids[item_num-1])
+                    self.assertEqual(mb.get_menu_item_on_active_path(len(ancestor_ids) + 1), None)
+
+        mb = MenuBuilder(count_queries=True)
+        self.assertEqual(mb.num_queries, 1)
+        self.assertEqual(MenuBuilder().num_queries, None)
+        msg('ok')
+
+
+class MenuBuilderDetachedNodeTest(TestCase):
+    """Breadcrumbs of a node that isn't on the MPTT tree (under a hidden parent) follow its parents"""
+    fixtures = ['cms_menu_node_test_data.json']
+
+    def get_breadcrumb_names(self, node):
+        return map(lambda x: x.name, MenuBuilder(selected_node=node).get_breadcrumb_nodes())
+
+    def runTest(self):
+        msgt('Hide "tropical" and "root": "papaya" breadcrumbs are food|fruit|papaya')
+        for name in ('tropical', 'root'):
+            node = get_node(name)
+            node.visible = False
+            node.save()
+        papaya = get_node('papaya')
+        self.assertEqual(papaya.left_val, -1)
+        self.assertEqual(self.get_breadcrumb_names(papaya), ['food', 'fruit', 'papaya'])
+        self.assertEqual(self.get_breadcrumb_names(get_node('yam')), ['food', 'vegetable', 'yam'])
+        msg('ok')
+
+        msgt('... the same without stored ancestor ids (from the parent relationships)')
+        Node.objects.update(ancestor_ids='', breadcrumb_path='')
+        self.assertEqual(self.get_breadcrumb_names(get_node('papaya')), ['food', 'fruit', 'papaya'])
+        msg('ok')
+
+        msgt('MenuItem breadcrumb of a detached node')
+        papaya = get_node('papaya')
+        self.assertEqual(MenuItem(papaya).breadcrumb(), papaya.breadcrumb())
+        self.assertEqual(MenuItem(papaya).breadcrumb_without_leaf(), papaya.breadcrumb_without_leaf())
+        self.assertEqual('yam' in MenuItem(papaya).breadcrumb(), False)
+        msg('ok')
+
+
+class MenuBuilderStatsTest(TestCase):
+    """Queries, rows and time of each build phase, the stats hook and the Server-Timing header"""
+    fixtures = ['cms_menu_node_test_data.json']
+
+    def runTest(self):
+        from django.http import HttpResponse
+        from cms_menu_builder.menu_stats import MENU_BUILD_PHASES, register_menu_stats_hook, unregister_menu_stats_hook
+        from cms_menu_builder.middleware import MenuServerTimingMiddleware
+
+        msgt('Stats are off by default')
+        self.assertEqual(MenuBuilder(selected_node=get_node('papaya')).stats, None)
+        msg('ok')
+
+        msgt('Stats for each phase')
+        papaya = get_node('papaya')
+        for kwargs in ({}, { 'is_left_menu' : True }, { 'build_full_tree_to_level3' : True }):
+            mb = MenuBuilder(selected_node=papaya, collect_stats=True, count_queries=True, **kwargs)
+            phases = mb.stats.phases
+            self.assertEqual(phases.keys(), list(MENU_BUILD_PHASES))
+            self.assertEqual(mb.stats.get_total_queries(), mb.num_queries)
+            self.assertEqual((phases['breadcrumb']['queries'], phases['breadcrumb']['rows']), (1, len(mb.active_path_ids)))
+            self.assertEqual((phases['menu_query']['queries'], phases['menu_query']['rows']), (1, len(mb.get_menu_items())))
+            self.assertEqual(phases['active_path']['queries'] + phases['subclasses']['queries'] + phases['flags']['queries'], 0)
+            self.assertEqual(mb.stats.get_total_ms() >= 0, True)
+
+        mb = MenuBuilder(selected_node=papaya, collect_stats=True, use_tree_snapshot=True)
+        self.assertEqual(mb.stats.get_total_queries(), 0)
+        self.assertEqual(mb.stats.phases['menu_query']['rows'], len(mb.get_menu_items()))
+        msg('ok')
+
+        msgt('Stats hook')
+        received_stats = []
+        register_menu_stats_hook(received_stats.append)
+        try:
+            mb = MenuBuilder(selected_node=papaya, collect_stats=True, is_left_menu=True)
+            MenuBuilder(selected_node=papaya)
+        finally:
+            unregister_menu_stats_hook(received_stats.append)
+        self.assertEqual(received_stats, [mb.stats])
+        self.assertEqual(mb.stats.menu_name, 'left')
+        msg('ok')
+
+        msgt('Server-Timing header, stats on for the request only')
+        middleware = MenuServerTimingMiddleware()
+        middleware.process_request(None)
+        mb = MenuBuilder(selected_node=papaya)
+        response = middleware.process_response(None, HttpResponse())
+        self.assertEqual(mb.stats is None, False)
+        self.assertEqual(response['Server-Timing'].startswith('menu-breadcrumb;dur='), True)
+        self.assertEqual('menu-menu_query;' in response['Server-Timing'], True)
+        self.assertEqual(MenuBuilder(selected_node=papaya).stats, None)
+        msg('ok')
@@ -264,3 +264,542 @@ def suite():
     #suite.addTest(TreeRearrangement('runTest'))
     #suite.addTest(NodeTestCase('test_root'))
     return suite        
+
+
+class TreeRebuildTest(TestCase):
+    """Rebuild computes the tree in memory and only writes changed rows"""
+    fixtures = ['cms_menu_node_test_data.json']
+    
+    def runTest(self):
+        from cms_menu_node.tree_builder import rebuild_tree
+        
+        #--------------------------------------------
+        msgt('Rebuilding an unchanged tree: 1 query to load, nothing written')
+        food = get_node('food')
+        with self.assertNumQueries(1):
+            rebuild_tree(food)
+        self.assertEqual(get_node('food').right_val, 44)
+        self.assertEqual(get_node('papaya').menu_level, 4)
+        msg('ok')
+        
+        #--------------------------------------------
+        msgt('Hide "vegetable": it and its children leave the MPTT tree')
+        vegetable = get_node('vegetable')
+        vegetable.visible = False
+        vegetable.save()
+        for n in Node.objects.filter(name__in=('vegetable', 'root', 'yam')):
+            self.assertEqual((n.left_val, n.right_val), (-1, -1))
+        self.assertEqual(get_node('food').right_val, 28)
+        self.assertEqual(get_node('yam').menu_level, 4)
+        self.assertGreaterEqual(get_node('yam').breadcrumb().find(STR_NOT_VISIBLE), 0)
+        msg('ok')
+        
+        #--------------------------------------------
+        msgt('Show "vegetable" again')
+        vegetable.visible = True
+        vegetable.save()
+        self.assertEqual(get_node('food').right_val, 44)
+        sep = ' %s ' % BREADCRUMB_SEPARATOR
+        self.assertEqual(get_node('yam').breadcrumb(), sep.join('food vegetable root yam'.split()))
+        msg('ok')
+
+
+class DeferredRebuildTest(TestCase):
+    """Saves inside deferred_rebuild() are rebuilt once, on exit"""
+    fixtures = ['cms_menu_node_test_data.json']
+    
+    def runTest(self):
+        from cms_menu_node.tree_builder import deferred_rebuild, is_rebuild_deferred
+        
+        #--------------------------------------------
+        msgt('Add 3 nodes in nested deferred_rebuild() blocks')
+        with deferred_rebuild():
+            Node.objects.create(name='kiwi', parent=get_node('tropical'))
+            with deferred_rebuild():
+                Node.objects.create(name='mango', parent=get_node('tropical'))
+            self.assertEqual(is_rebuild_deferred(), True)
+            Node.objects.create(name='lamb', parent=get_node('meat'))
+            # not yet on the tree
+            self.assertEqual(get_node('kiwi').left_val, -1)
+            self.assertEqual(get_node('food').right_val, 44)
+        
+        self.assertEqual(is_rebuild_deferred(), False)
+        self.assertEqual(get_node('food').right_val, 50)
+        self.assertEqual(get_node('mango').menu_level, 4)
+        sep = ' %s ' % BREADCRUMB_SEPARATOR
+        self.assertEqual(get_node('lamb').breadcrumb(), sep.join('food meat lamb'.split()))
+        msg('ok')
+        
+        #--------------------------------------------
+        msgt('Nothing saved, nothing rebuilt')
+        with self.assertNumQueries(0):
+            with deferred_rebuild():
+                pass
+        msg('ok')
+        
+        #--------------------------------------------
+        msgt('An exception in the block: the saves before it are rebuilt, the exception is raised')
+        from cms_menu_node.tree_builder import get_tree_version
+        version = get_tree_version()
+        def add_node_then_fail():
+            with deferred_rebuild():
+                with deferred_rebuild():
+                    Node.objects.create(name='guava', parent=get_node('tropical'))
+                    raise ValueError('bad data')
+        self.assertRaises(ValueError, add_node_then_fail)
+        self.assertEqual(is_rebuild_deferred(), False)
+        self.assertEqual(get_node('guava').left_val > 0, True)
+        self.assertEqual(get_node('food').right_val, 52)
+        self.assertEqual(get_tree_version() > version, True)
+        msg('ok')
+        
+        #--------------------------------------------
+        msgt('Signals disconnected by the caller stay disconnected; no rebuild on KeyboardInterrupt')
+        from cms_menu_node.tree_builder import connect_node_signals, disconnect_node_signals, are_node_signals_connected
+        disconnect_node_signals(Node)
+        try:
+            with deferred_rebuild():
+                self.assertEqual(are_node_signals_connected(), True)
+                Node.objects.create(name='lime', parent=get_node('local'))
+            self.assertEqual(are_node_signals_connected(), False)
+            self.assertEqual(get_node('lime').left_val > 0, True)
+            Node.objects.create(name='lemon', parent=get_node('local'))
+            self.assertEqual(get_node('lemon').left_val, -1)     # no tree update
+        finally:
+            connect_node_signals(Node)
+        
+        def interrupt_block():
+            with deferred_rebuild():
+                Node.objects.create(name='quince', parent=get_node('local'))
+                raise KeyboardInterrupt()
+        self.assertRaises(KeyboardInterrupt, interrupt_block)
+        self.assertEqual(is_rebuild_deferred(), False)
+        self.assertEqual(get_node('quince').left_val, -1)
+        msg('ok')
+
+
+class SkipTreeUpdateTest(TestCase):
+    """Saves that don't change parent/visible/sibling_order leave the tree alone"""
+    fixtures = ['cms_menu_node_test_data.json']
+    
+    def runTest(self):
+        from cms_menu_node.tree_builder import get_tree_update_stats, reset_tree_update_stats
+        reset_tree_update_stats()
+        
+        #--------------------------------------------
+        msgt('Rename "yam": skipped')
+        yam = get_node('yam')
+        yam.name = 'yams'
+        yam.save()
+        self.assertEqual(get_tree_update_stats(), { 'skipped' : 1, 'incremental' : 0, 'full' : 0 })
+        msg('ok')
+        
+        #--------------------------------------------
+        msgt('Move "yams" after "yucca": tree updated, then another rename is skipped')
+        yam.sibling_order = 999
+        yam.save()
+        self.assertEqual(get_node('yams').left_val > get_node('yucca').left_val, True)
+        yam.name = 'yam'
+        yam.save()
+        stats = get_tree_update_stats()
+        self.assertEqual(stats['skipped'], 2)
+        self.assertEqual(stats['incremental'] + stats['full'], 1)
+        msg('ok')
+
+
+class StaleInstanceTest(TestCase):
+    """Saving an out of date copy of a node compares with the saved values, not the copy's"""
+    fixtures = ['cms_menu_node_test_data.json']
+    
+    def get_tree_values(self):
+        return list(Node.objects.order_by('id').values_list('id', 'parent', 'left_val', 'right_val', 'menu_level'))
+        
+    def check_tree_matches_rebuild(self):
+        from cms_menu_node.tree_builder import rebuild_tree_full
+        tree_values = self.get_tree_values()
+        rebuild_tree_full(Node)
+        self.assertEqual(self.get_tree_values(), tree_values)
+        
+    def runTest(self):
+        #--------------------------------------------
+        msgt('Move "papaya" with one copy, rename it with another: the move stays')
+        papaya_1, papaya_2 = get_node('papaya'), get_node('papaya')
+        papaya_1.parent = get_node('meat')
+        papaya_1.save()
+        
+        papaya_2.name = 'papayas'
+        papaya_2.save()
+        papaya = get_node('papayas')
+        self.assertEqual(papaya.parent, get_node('meat'))
+        self.assertEqual(papaya_2.parent, get_node('meat'))
+        self.check_tree_matches_rebuild()
+        msg('ok')
+        
+        #--------------------------------------------
+        msgt('A stale copy given a new parent: the tree is updated')
+        pineapple_1, pineapple_2 = get_node('pineapple'), get_node('pineapple')
+        pineapple_1.parent = get_node('beef')
+        pineapple_1.save()
+        
+        pineapple_2.parent = get_node('local')
+        pineapple_2.save()
+        self.assertEqual(get_node('pineapple').parent, get_node('local'))
+        self.check_tree_matches_rebuild()
+        msg('ok')
+
+
+class DeferredFieldsTest(TestCase):
+    """Nodes loaded with .only()/.defer(): no tree-state fields are read while loading"""
+    fixtures = ['cms_menu_node_test_data.json']
+    
+    def runTest(self):
+        from django.contrib.auth.models import User
+        from cms_page.models import Page
+        
+        #--------------------------------------------
+        msgt('Iterate .only() and .defer() querysets, save a renamed and a moved node')
+        self.assertEqual(len(list(Node.objects.only('id', 'name'))), 22)
+        self.assertEqual(len(list(Node.objects.defer('parent', 'menu_label'))), 22)
+        
+        papaya = Node.objects.only('id', 'name').get(name='papaya')
+        papaya.name = 'papayas'
+        papaya.save()
+        self.assertEqual(get_node('papayas').parent, get_node('tropical'))
+        
+        pineapple = Node.objects.only('id', 'name').get(name='pineapple')
+        pineapple.parent = get_node('meat')
+        pineapple.save()
+        pineapple, meat = get_node('pineapple'), get_node('meat')
+        self.assertEqual((pineapple.parent, pineapple.menu_level), (meat, 3))
+        self.assertEqual(meat.left_val < pineapple.left_val < meat.right_val, True)
+        
+        Node.objects.only('id', 'name').get(name='root').delete()
+        self.assertEqual((get_node('yam').parent, get_node('yam').menu_level), (get_node('vegetable'), 3))
+        self.assertEqual(get_node('food').right_val, 42)
+        msg('ok')
+        
+        #--------------------------------------------
+        msgt('... and a Page')
+        author = User.objects.create(username='author')
+        Page(name='lamb', title='Lamb Recipes', content='lamb', author=author, parent=get_node('meat')).save()
+        lamb = Page.objects.only('id', 'title').get(name='lamb')
+        lamb.title = 'Lamb Stew'
+        lamb.save()
+        self.assertEqual(Node.objects.get(name='lamb').menu_label, 'Lamb Stew')
+        self.assertEqual(get_node('lamb').parent, get_node('meat'))
+        msg('ok')
+
+
+class TreeVersionTest(TestCase):
+    """Each tree update increments the tree version once, with the tree lock held"""
+    fixtures = ['cms_menu_node_test_data.json']
+    
+    def runTest(self):
+        from cms_menu_node.tree_builder import get_tree_version, suspend_tree_updates, rebuild_tree_full
+        
+        #--------------------------------------------
+        msgt('Move "yam" after "yucca": version + 1')
+        version = get_tree_version()
+        yam = get_node('yam')
+        yam.sibling_order = 999
+        yam.save()
+        self.assertEqual(get_tree_version(), version + 1)
+        self.assertEqual(get_node('yam').left_val > get_node('yucca').left_val, True)
+        msg('ok')
+        
+        #--------------------------------------------
+        msgt('Rename "yam": tree unchanged, version + 1 (names are in the tree snapshot)')
+        yam.name = 'yams'
+        yam.save()
+        self.assertEqual(get_tree_version(), version + 2)
+        
+        yam.save()
+        self.assertEqual(get_tree_version(), version + 2)
+        msg('ok')
+        
+        #--------------------------------------------
+        msgt('Save inside suspend_tree_updates(): tree unchanged until rebuilt')
+        vegetable = get_node('vegetable')
+        with suspend_tree_updates():
+            Node(name='kale', parent=vegetable).save()
+        self.assertEqual(get_node('kale').left_val, -1)
+        self.assertEqual(get_tree_version(), version + 2)
+        
+        rebuild_tree_full(Node)
+        self.assertEqual(get_node('kale').left_val > get_node('vegetable').left_val, True)
+        self.assertEqual(get_node('food').right_val, 46)
+        self.assertEqual(get_tree_version(), version + 3)
+        msg('ok')
+
+
+class DeleteNodeTest(TestCase):
+    """Deleting a node reassigns its children with one UPDATE and shifts the tree once"""
+    fixtures = ['cms_menu_node_test_data.json']
+    
+    def runTest(self):
+        from cms_menu_node.tree_builder import get_tree_update_stats, reset_tree_update_stats
+        
+        #--------------------------------------------
+        msgt('Delete "fruit": children move up to "food"')
+        fruit = get_node('fruit')
+        child_names = [c.name for c in fruit.node_set.all()]
+        self.assertEqual(len(child_names) > 1, True)
+        
+        reset_tree_update_stats()
+        fruit.delete()
+        self.assertEqual(get_tree_update_stats(), { 'skipped' : 0, 'incremental' : 1, 'full' : 0 })
+        
+        food = get_node('food')
+        self.assertEqual(food.right_val, 42)
+        for name in child_names:
+            child = get_node(name)
+            self.assertEqual(child.parent, food)
+            self.assertEqual(child.menu_level, 2)
+        msg('ok')
+
+        #--------------------------------------------
+        msgt('Delete the root "food": its first child is the new root')
+        first_child = food.node_set.all().order_by('left_val')[0]
+        food.delete()
+        new_root = Node.objects.get(id=first_child.id)
+        self.assertEqual(new_root.is_root, True)
+        self.assertEqual(new_root.parent, None)
+        self.assertEqual(new_root.left_val, 1)
+        self.assertEqual(new_root.right_val, 2 * Node.objects.filter(left_val__gt=0).count())
+        self.assertEqual(Node.objects.filter(parent__isnull=True).count(), 1)
+        msg('ok')
+
+
+class MoveNodeTest(TestCase):
+    """Node.move_to() shifts the subtree's left/right values instead of rebuilding the tree"""
+    fixtures = ['cms_menu_node_test_data.json']
+    
+    def check_position(self, name, parent_name, previous_name=None):
+        node = get_node(name)
+        self.assertEqual(node.parent, get_node(parent_name))
+        self.assertEqual(node.menu_level, node.parent.menu_level + 1)
+        if previous_name is None:
+            self.assertEqual(node.left_val, node.parent.left_val + 1)
+        else:
+            self.assertEqual(node.left_val, get_node(previous_name).right_val + 1)
+        
+    def runTest(self):
+        from cms_menu_node.tree_builder import get_tree_update_stats, reset_tree_update_stats
+        from cms_menu_node.exceptions import InvalidNodeMove
+        
+        reset_tree_update_stats()
+        
+        #--------------------------------------------
+        msgt('Move "tropical" (with papaya, pineapple): first child of "vegetable"')
+        tropical = get_node('tropical')
+        num_descendants = tropical.get_num_descendants()
+        tropical.move_to(get_node('vegetable'), 'first-child')
+        self.check_position('tropical', 'vegetable')
+        self.check_position('papaya', 'tropical')
+        self.assertEqual(get_node('tropical').get_num_descendants(), num_descendants)
+        self.assertEqual(get_node('food').right_val, 44)
+        msg('ok')
+        
+        #--------------------------------------------
+        msgt('Move "tropical": last child of "fruit", then left/right of "meat"')
+        tropical.move_to(get_node('fruit'), 'last-child')
+        last_fruit = get_node('fruit').node_set.exclude(id=tropical.id).order_by('-left_val')[0]
+        self.check_position('tropical', 'fruit', last_fruit.name)
+        
+        tropical.move_to(get_node('meat'), 'left')
+        self.check_position('tropical', 'food', 'fruit')
+        
+        tropical.move_to(get_node('meat'), 'right')
+        self.check_position('tropical', 'food', 'meat')
+        self.assertEqual(get_node('papaya').menu_level, 3)
+        msg('ok')
+        
+        self.assertEqual(get_tree_update_stats(), { 'skipped' : 0, 'incremental' : 4, 'full' : 0 })
+        
+        #--------------------------------------------
+        msgt('Invalid moves')
+        self.assertRaises(ParentRelationshipCircular, tropical.move_to, get_node('papaya'))
+        self.assertRaises(ParentRelationshipCircular, tropical.move_to, get_node('pineapple'), 'right')
+        self.assertRaises(InvalidNodeMove, get_node('food').move_to, tropical)
+        self.assertRaises(InvalidNodeMove, tropical.move_to, get_node('food'), 'left')
+        self.assertRaises(InvalidNodeMove, tropical.move_to, get_node('meat'), 'above')
+        self.assertEqual(get_node('food').right_val, 44)
+        msg('ok')
+        
+        #--------------------------------------------
+        msgt('Hide "tropical", move "fruit" under "beef": the hidden nodes move down two levels')
+        tropical = get_node('tropical')
+        tropical.visible = False
+        tropical.save()
+        tropical.move_to(get_node('fruit'), 'last-child')
+        self.assertEqual(map(lambda name: get_node(name).menu_level, ('tropical', 'papaya', 'pineapple')), [3, 4, 4])
+        reset_tree_update_stats()
+        get_node('fruit').move_to(get_node('beef'), 'first-child')
+        self.assertEqual(map(lambda name: get_node(name).menu_level, ('tropical', 'papaya', 'pineapple')), [5, 6, 6])
+        
+        msgt('... delete "beef": they move up one level')
+        get_node('beef').delete()
+        self.assertEqual(map(lambda name: get_node(name).menu_level, ('tropical', 'papaya', 'pineapple')), [4, 5, 5])
+        self.assertEqual(get_tree_update_stats(), { 'skipped' : 0, 'incremental' : 2, 'full' : 0 })
+        
+        tree_values = list(Node.objects.order_by('id').values_list('id', 'left_val', 'right_val', 'menu_level'))
+        from cms_menu_node.tree_builder import rebuild_tree_full
+        rebuild_tree_full(Node)
+        self.assertEqual(list(Node.objects.order_by('id').values_list('id', 'left_val', 'right_val', 'menu_level')), tree_values)
+        msg('ok')
+
+
+class CircularParentTest(TestCase):
+    """is_parent_relationship_circular() uses one query, however deep the tree"""
+    fixtures = ['cms_menu_node_test_data.json']
+    
+    def runTest(self):
+        from cms_menu_node.tree_builder import deferred_rebuild
+        
+        food, fruit, tropical, papaya, meat = map(get_node, ('food', 'fruit', 'tropical', 'papaya', 'meat'))
+        
+        #--------------------------------------------
+        msgt('On the tree: left/right containment')
+        with self.assertNumQueries(1):
+            self.assertEqual(Node.is_parent_relationship_circular(food, papaya), True)
+        with self.assertNumQueries(1):
+            self.assertEqual(Node.is_parent_relationship_circular(papaya, food), False)
+        with self.assertNumQueries(1):
+            self.assertEqual(Node.is_parent_relationship_circular(fruit, meat), False)
+        with self.assertNumQueries(0):
+            self.assertEqual(Node.is_parent_relationship_circular(fruit, fruit), True)
+            self.assertEqual(Node.is_parent_relationship_circular(fruit, None), False)
+        msg('ok')
+        
+        #--------------------------------------------
+        msgt('Hide "tropical": its subtree is off the tree, a recursive query is used')
+        tropical.visible = False
+        tropical.save()
+        with self.assertNumQueries(2):
+            self.assertEqual(Node.is_parent_relationship_circular(fruit, papaya), True)
+        with self.assertNumQueries(2):
+            self.assertEqual(Node.is_parent_relationship_circular(meat, papaya), False)
+        with self.assertNumQueries(1):
+            self.assertEqual(Node.is_parent_relationship_circular(tropical, meat), False)
+        msg('ok')
+        
+        #--------------------------------------------
+        msgt('Left/right values not current (deferred rebuild): recursive query only')
+        with deferred_rebuild():
+            with self.assertNumQueries(1):
+                self.assertEqual(Node.is_parent_relationship_circular(food, papaya), True)
+            with self.assertNumQueries(1):
+                self.assertEqual(Node.is_parent_relationship_circular(papaya, food), False)
+        msg('ok')
+        
+        #--------------------------------------------
+        msgt('Without WITH RECURSIVE (e.g. after a failed statement): one query per level')
+        from cms_menu_node import tree_builder
+        tree_builder._recursive_query_state['supported'] = False
+        try:
+            with deferred_rebuild():
+                with self.assertNumQueries(3):
+                    self.assertEqual(Node.is_parent_relationship_circular(food, papaya), True)
+                self.assertEqual(Node.is_parent_relationship_circular(papaya, food), False)
+        finally:
+            tree_builder._recursive_query_state['supported'] = None
+        msg('ok')
+
+
+class NodePathTest(TestCase):
+    """breadcrumb_path and ancestor_ids are kept up to date by the tree updates"""
+    fixtures = ['cms_menu_node_test_data.json']
+    
+    def check_paths(self):
+        """Compare the stored paths with the parent relationships"""
+        for node in Node.objects.all():
+            self.assertEqual(node.breadcrumb_path, node.parent_string_for_admin())
+            ancestor_ids = []
+            ancestor = node
+            while ancestor is not None:
+                ancestor_ids.insert(0, ancestor.id)
+                ancestor = ancestor.parent
+            self.assertEqual(node.get_ancestor_ids(), ancestor_ids)
+        
+    def runTest(self):
+        from cms_menu_node.tree_builder import rebuild_tree_full
+        
+        #--------------------------------------------
+        msgt('Full rebuild: paths for every node')
+        Node.objects.update(breadcrumb_path='', ancestor_ids='')
+        rebuild_tree_full(Node)
+        self.check_paths()
+        papaya = get_node('papaya')
+        self.assertEqual(papaya.ancestor_ids, '/1/2/18/19/')
+        with self.assertNumQueries(0):
+            self.assertEqual(papaya.breadcrumb(), 'food -> fruit -> tropical -> papaya')
+            self.assertEqual(papaya.breadcrumb_without_leaf(), 'food -> fruit -> tropical')
+        self.assertEqual(map(lambda x: x.name, get_node('tropical').get_descendants_by_path().order_by('id'))\
+                        , ['papaya', 'pineapple'])
+        msg('ok')
+        
+        #--------------------------------------------
+        msgt('Insert, rename, move and hide')
+        kiwi = Node(name='kiwi', parent=get_node('tropical'))
+        kiwi.save()
+        self.assertEqual(kiwi.ancestor_ids, '/1/2/18/%s/' % kiwi.id)
+        
+        tropical = get_node('tropical')
+        tropical.name = 'exotic'
+        tropical.save()
+        self.assertEqual(get_node('kiwi').breadcrumb(), 'food -> fruit -> exotic -> kiwi')
+        
+        tropical.move_to(get_node('vegetable'), 'first-child')
+        self.assertEqual(get_node('papaya').ancestor_ids, '/1/10/18/19/')
+        self.check_paths()
+        
+        tropical = get_node('exotic')
+        tropical.visible = False
+        tropical.save()
+        self.assertEqual(get_node('kiwi').breadcrumb(), 'food -> vegetable -> exotic (%s) -> kiwi' % STR_NOT_VISIBLE)
+        self.check_paths()
+        msg('ok')
+        
+        #--------------------------------------------
+        msgt('Delete: the children move up')
+        get_node('fruit').delete()
+        self.assertEqual(get_node('cherry').ancestor_ids, '/1/3/4/')
+        self.check_paths()
+        msg('ok')
+
+
+class AdminParentChoicesTest(TestCase):
+    """Node.get_admin_parent_choices(): one query, cached per tree version"""
+    fixtures = ['cms_menu_node_test_data.json']
+    
+    def setUp(self):
+        from cms_menu_node.node_paths import clear_admin_parent_choices
+        clear_admin_parent_choices()    # the database is rolled back between tests, version numbers repeat
+    
+    def check_choices(self):
+        expected = map(lambda x: (x.id, x.parent_string_for_admin()), Node.objects.filter(visible=True).order_by('left_val', 'id'))
+        self.assertEqual(Node.get_admin_parent_choices(), expected)
+        
+    def runTest(self):
+        #--------------------------------------------
+        msgt('Load the choices, then reuse them')
+        with self.assertNumQueries(2):
+            choices = Node.get_admin_parent_choices()
+        with self.assertNumQueries(1):
+            self.assertEqual(Node.get_admin_parent_choices(), choices)
+        self.assertEqual(choices[0], (get_node('food').id, 'food'))
+        self.check_choices()
+        msg('ok')
+        
+        #--------------------------------------------
+        msgt('Renamed and hidden nodes: new choices')
+        fruit = get_node('fruit')
+        fruit.name = 'fruits'
+        fruit.save()
+        self.assertEqual(dict(Node.get_admin_parent_choices())[get_node('papaya').id], 'food -> fruits -> tropical -> papaya')
+        
+        tropical = get_node('tropical')
+        tropical.visible = False
+        tropical.save()
+        self.check_choices()
+        msg('ok')
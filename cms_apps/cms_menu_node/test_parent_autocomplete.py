@@ -0,0 +1,71 @@
+from django.contrib.auth.models import User
+from django.core.urlresolvers import reverse
+from django.test import TestCase
+from django.utils import simplejson
+from cms_common.msg_util import *
+from cms_menu_node.models import Node
+from cms_menu_node.forms import NodeAdminForm
+from cms_menu_node.tree_builder import rebuild_tree_full
+from cms_menu_node.views import search_parent_choices
+from cms_menu_node.widgets import ParentAutocompleteWidget
+from test_mptt_tree import get_node
+
+class ParentAutocompleteTest(TestCase):
+    """The admin parent picker: a JSON search endpoint and a widget that doesn't list every node"""
+    fixtures = ['cms_menu_node_test_data.json']
+    urls = 'cms_menu_node.urls'
+    
+    def get_results(self, **params):
+        response = self.client.get(reverse('view_node_parent_autocomplete'), params)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Type'], 'application/json')
+        return simplejson.loads(response.content)
+        
+    def runTest(self):
+        rebuild_tree_full(Node)
+        
+        #--------------------------------------------
+        msgt('Search by name or breadcrumb, in tree order')
+        choices, has_more = search_parent_choices('trop')
+        self.assertEqual(choices, [(get_node('tropical').id, 'food -> fruit -> tropical')\
+                                , (get_node('papaya').id, 'food -> fruit -> tropical -> papaya')\
+                                , (get_node('pineapple').id, 'food -> fruit -> tropical -> pineapple')])
+        self.assertEqual(has_more, False)
+        
+        choices, has_more = search_parent_choices('', page=2, page_size=5)
+        self.assertEqual(map(lambda x: x[0], choices)\
+                        , list(Node.objects.filter(visible=True).order_by('left_val').values_list('id', flat=True)[5:10]))
+        self.assertEqual(has_more, True)
+        
+        # the node itself and its descendants can't be its parent
+        choices, has_more = search_parent_choices('trop', exclude_node_id=get_node('tropical').id)
+        self.assertEqual(choices, [])
+        msg('ok')
+        
+        #--------------------------------------------
+        msgt('JSON endpoint, staff only')
+        response = self.client.get(reverse('view_node_parent_autocomplete'), { 'q' : 'apple' })
+        self.assertNotEqual(response.get('Content-Type', ''), 'application/json')
+        
+        User.objects.create_user('staff', 'staff@example.com', 'pw')
+        User.objects.filter(username='staff').update(is_staff=True)
+        self.assertEqual(self.client.login(username='staff', password='pw'), True)
+        
+        d = self.get_results(q='apple', page_size=1)
+        self.assertEqual(d['results'], [{ 'id' : get_node('pineapple').id, 'text' : 'food -> fruit -> tropical -> pineapple' }])
+        self.assertEqual((d['page'], d['has_more']), (1, True))
+        d = self.get_results(q='apple', page=2, page_size=1)
+        self.assertEqual(d['results'][0]['id'], get_node('apple').id)
+        self.assertEqual(d['has_more'], False)
+        msg('ok')
+        
+        #--------------------------------------------
+        msgt('Admin form: the widget renders the selected parent only')
+        papaya = get_node('papaya')
+        form = NodeAdminForm(instance=papaya)
+        self.assertEqual(isinstance(form.fields['parent'].widget, ParentAutocompleteWidget), True)
+        with self.assertNumQueries(1):
+            html = unicode(form['parent'])
+        self.assertEqual('food -&gt; fruit -&gt; tropical' in html, True)
+        self.assertEqual('<option value' in html, False)
+        msg('ok')
@@ -0,0 +1,67 @@
+import unittest
+from django.test import TestCase
+from cms_common.msg_util import *
+from cms_menu_node.models import Node
+from cms_menu_node.tree_snapshot import get_tree_snapshot, clear_tree_snapshot
+from test_mptt_tree import get_node
+
+class TreeSnapshotTest(TestCase):
+    """The snapshot matches the Node table and is reloaded when the tree version changes"""
+    fixtures = ['cms_menu_node_test_data.json']
+
+    def setUp(self):
+        clear_tree_snapshot()   # the database is rolled back between tests, version numbers repeat
+
+    def runTest(self):
+        #--------------------------------------------
+        msgt('Load the snapshot, then reuse it')
+        with self.assertNumQueries(2):
+            snapshot = get_tree_snapshot()
+        with self.assertNumQueries(1):
+            self.assertEqual(get_tree_snapshot() is snapshot, True)
+
+        live_nodes = Node.objects.filter(visible=True, left_val__gt=0)
+        self.assertEqual(len(snapshot), live_nodes.count())
+        msg('ok')
+
+        #--------------------------------------------
+        msgt('Ancestors, descendants, children and siblings match the Node table')
+        for node in live_nodes:
+            idx = snapshot.get_index(node.id)
+            self.assertEqual(snapshot.names[idx], node.name)
+            self.assertEqual(snapshot.slugs[idx], node.slug)
+            self.assertEqual(snapshot.get_index_by_left_val(node.left_val), idx)
+            self.assertEqual(snapshot.menu_levels[idx], node.menu_level)
+
+            self.assertEqual(len(snapshot.get_descendants(idx)), node.get_num_descendants())
+            self.assertEqual([snapshot.ids[i] for i in snapshot.get_children(idx)]\
+                    , list(node.node_set.filter(left_val__gt=0).order_by('left_val').values_list('id', flat=True)))
+
+            ancestor_ids = []
+            parent = node.parent
+            while parent:
+                ancestor_ids.insert(0, parent.id)
+                parent = parent.parent
+            self.assertEqual([snapshot.ids[i] for i in snapshot.get_ancestors(idx)], ancestor_ids)
+            if node.parent:
+                self.assertEqual(snapshot.ids[snapshot.get_parent(idx)], node.parent.id)
+                self.assertEqual(snapshot.is_descendant(idx, snapshot.get_parent(idx)), True)
+                self.assertEqual(idx in snapshot.get_siblings(idx), True)
+        msg('ok')
+
+        #--------------------------------------------
+        msgt('Hidden and renamed nodes: new snapshot')
+        tropical = get_node('tropical')
+        tropical.visible = False
+        tropical.save()
+        snapshot = get_tree_snapshot()
+        self.assertEqual(snapshot.get_index(tropical.id), None)
+        self.assertEqual(snapshot.get_index(get_node('papaya').id), None)
+
+        meat = get_node('meat')
+        meat.name = 'meats'
+        meat.save()
+        snapshot = get_tree_snapshot()
+        self.assertEqual(snapshot.names[snapshot.get_index(meat.id)], 'meats')
+        self.assertEqual(snapshot.slugs[snapshot.get_index(meat.id)], 'meats')
+        msg('ok')
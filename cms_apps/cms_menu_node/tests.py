@@ -1,10 +1,34 @@
 import unittest
-from test_mptt_tree import TreeRearrangement, NodeTestCase      
-from test_menu_builder import MenuBuilderTest
+from test_mptt_tree import TreeRearrangement, NodeTestCase, TreeRebuildTest, DeferredRebuildTest, SkipTreeUpdateTest\
+                    , TreeVersionTest, DeleteNodeTest, MoveNodeTest, CircularParentTest, NodePathTest, StaleInstanceTest, DeferredFieldsTest\
+                    , AdminParentChoicesTest
+from test_menu_builder import MenuBuilderTest, MenuBuilderSnapshotTest, MenuBuilderQueryCountTest\
+                    , MenuBuilderDetachedNodeTest, MenuBuilderStatsTest
+from test_tree_snapshot import TreeSnapshotTest
+from test_benchmark import BenchmarkTreeTest
+from test_parent_autocomplete import ParentAutocompleteTest
 
 def suite():
     suite = unittest.TestSuite()
     #suite.addTest(TreeRearrangement('runTest'))
     #suite.addTest(NodeTestCase('test_root'))
     suite.addTest(MenuBuilderTest('runTest'))
+    suite.addTest(MenuBuilderSnapshotTest('runTest'))
+    suite.addTest(MenuBuilderQueryCountTest('runTest'))
+    suite.addTest(MenuBuilderDetachedNodeTest('runTest'))
+    suite.addTest(MenuBuilderStatsTest('runTest'))
+    suite.addTest(TreeRebuildTest('runTest'))
+    suite.addTest(DeferredRebuildTest('runTest'))
+    suite.addTest(SkipTreeUpdateTest('runTest'))
+    suite.addTest(StaleInstanceTest('runTest'))
+    suite.addTest(DeferredFieldsTest('runTest'))
+    suite.addTest(TreeVersionTest('runTest'))
+    suite.addTest(DeleteNodeTest('runTest'))
+    suite.addTest(MoveNodeTest('runTest'))
+    suite.addTest(CircularParentTest('runTest'))
+    suite.addTest(NodePathTest('runTest'))
+    suite.addTest(AdminParentChoicesTest('runTest'))
+    suite.addTest(TreeSnapshotTest('runTest'))
+    suite.addTest(BenchmarkTreeTest('runTest'))
+    suite.addTest(ParentAutocompleteTest('runTest'))
     return suite        
@@ -1,15 +1,50 @@
+import itertools
+import sys
+import threading
+from contextlib import contextmanager
+
 from cms_common.msg_util import *
+from cms_menu_node.rebuild_queue import is_background_rebuild, enqueue_tree_rebuild
+from cms_menu_node.exceptions import ParentRelationshipCircular, InvalidNodeMove
+from cms_menu_node.node_paths import refresh_node_paths, refresh_all_node_paths, set_node_paths
+from django.db import connection, transaction, IntegrityError, DatabaseError
+from django.db.models import Q, F, Min, Max
 from django.db.models.signals import pre_save, post_save, post_delete     
+from django.utils import timezone
 #from cms_menu_node.models import Node
 
+# Attributes computed by the tree rebuild, in the order used by compute_tree_values()
+TREE_VALUE_FIELDS = ('left_val', 'right_val', 'menu_level', 'parent_node_id', 'sibling_order')
+
+
+# Node attributes which shape the tree, saved by Node.save() before writing
+#   same order as Node.get_tree_state()
+TREE_STATE_FIELDS = ('parent', 'visible', 'sibling_order')
+
+# How saves were handled: 
+#   skipped - no tree-shaping value changed, incremental - left/right ranges shifted, full - entire tree rebuilt
+tree_update_stats = { 'skipped' : 0, 'incremental' : 0, 'full' : 0 }
+
+def get_tree_update_stats():
+    return dict(tree_update_stats)
+    
+def reset_tree_update_stats():
+    for k in tree_update_stats.keys():
+        tree_update_stats[k] = 0
+
+
 
 def rebuild_tree_after_node_saved(sender, **kwargs):
-    """Rebuild the tree each time a Node is saved.
+    """Update the tree each time a Node is saved.
     This includes:
         - making sure a root exists
         - setting the left_val/right_val for Modified Preorder Tree Traversal (MPTT)
         - resetting sibling orders based on relative MPTT vals
         - setting the node.menu_level val  (this is menu depth)
+        
+    Inserts, moves and hiding a node are handled incrementally by shifting 
+    left/right ranges.  Anything else (root changes, a node becoming visible, 
+    fixture loading) falls back to a full rebuild.
     - sender is a Node object"""    
     #msgt('kwargs: %s' % kwargs)
     
@@ -17,80 +52,622 @@ def rebuild_tree_after_node_saved(sender, **kwargs):
     if not calling_node:
         return
 
+    if are_tree_updates_suspended():
+        return
+
     NODE_CLASS = get_to_node_class(sender)
 
-    # to avoid infinite loop, disconnect the post-save signal
+    if is_save_already_handled(calling_node):
+        return
+    
+    # only content changed, e.g. a typo fixed in a Page -- the tree is unchanged
+    if not (kwargs.get('created', False) or kwargs.get('raw', False))\
+            and not getattr(calling_node, '_tree_state_changed', True):
+        tree_update_stats['skipped'] += 1
+        #msg('tree update skipped: %s' % tree_update_stats)
+        if getattr(calling_node, '_display_state_changed', False):
+            # e.g. renamed: a new version, so the tree snapshot is reloaded
+            with suspend_tree_updates():
+                run_tree_update(update_paths_after_display_change, NODE_CLASS, calling_node)
+        return
+    
+    # inside "with deferred_rebuild():" -- rebuild once at the end
+    if is_rebuild_deferred():
+        mark_tree_dirty(NODE_CLASS)
+        return
+    
+    # background mode -- a worker rebuilds the tree
+    if is_background_rebuild():
+        enqueue_tree_rebuild()
+        return
+        
+    # the tree writes below don't save nodes; the guard is a safety net against 
+    # a nested rebuild.  (unlike disconnecting the signals, it doesn't 
+    # affect saves running in other threads)
     #--------------------------
-    disconnect_node_signals(NODE_CLASS)
+    with suspend_tree_updates():
+        update_type = run_tree_update(update_tree_after_save, NODE_CLASS, calling_node\
+                                , kwargs.get('created', False), kwargs.get('raw', False))
     #--------------------------
-        
-    # get the root node -- assume there is only one!
-    root_node = None
-    try:
-        root_node = NODE_CLASS.objects.get(is_root=True, visible=True)
-    except NODE_CLASS.DoesNotExist:
-        # No root node or more than one - Fix it!
-        #msg('Root does not Exist!')
-        check_for_single_root(calling_node)
-    except NODE_CLASS.MultipleObjectsReturned:
-        check_for_single_root(calling_node)
+    if update_type is not None:
+        tree_update_stats[update_type] += 1
     
-    if root_node is None:
-        try:
-            root_node = NODE_CLASS.objects.get(is_root=True, visible=True)
-        except NODE_CLASS.DoesNotExist:
-            connect_node_signals(NODE_CLASS)
-            #msg('Root Fix failed!')
-            return
 
+def update_tree_after_save(NODE_CLASS, node, created=False, raw=False):
+    """Update the tree incrementally if possible, otherwise rebuild it.
+    Call through run_tree_update() so the tree lock is held.
+    Returns 'incremental', 'full' or None if there is no root"""
+    if not raw and update_tree_for_saved_node(NODE_CLASS, node, created):
+        # the node and its descendants, found by the ancestor ids saved before the move
+        set_node_paths(node, refresh_node_paths(NODE_CLASS, [node.id], node.ancestor_ids))
+        return 'incremental'
+    
+    if rebuild_tree_with_root_check(NODE_CLASS, node) is None:
+        return None
+    return 'full'
+
+
+def update_paths_after_display_change(NODE_CLASS, node):
+    """A renamed node changes the breadcrumb_path of its descendants.  
+    Call through run_tree_update().  Returns True: the tree version changes"""
+    loaded_name = getattr(node, '_display_state_loaded', (node.name,))[0]
+    if loaded_name != node.name:
+        set_node_paths(node, refresh_node_paths(NODE_CLASS, [node.id], node.ancestor_ids))
+    return True
+    
 
-    # (1) rebuild the left/right values
-    rebuild_tree(root_node)
+def rebuild_tree_full(NODE_CLASS, calling_node=None):
+    """Rebuild the entire tree from the parent relationships.  
+    Also used to repair the tree if the left/right values are out of sync.
+        To run: rebuild_tree_full(Node)
+        
+    One query loads the tree.  The root check and the new MPTT values are 
+    computed in memory and written in one transaction, with the tree lock held.
+    """
+    NODE_CLASS = get_to_node_class(NODE_CLASS)
     
-    # (2) set the menu level attribute (menu depth) and the sibling order
-    for n in NODE_CLASS.objects.all():
-        n.set_menu_level()
-        n.set_parent_node_id()
-        n.sibling_order = n.left_val
-        n.save()
+    with suspend_tree_updates():
+        tree_values = run_tree_update(rebuild_tree_with_root_check, NODE_CLASS, calling_node)
+    if tree_values is None:
+        #msg('Root Fix failed!')
+        return
     
+    tree_update_stats['full'] += 1
     
-    # re-connect the post-save signal
-    #--------------------------
-    connect_node_signals(NODE_CLASS)
-    #--------------------------
+    # menu links missing, e.g. nodes loaded from a fixture
+    from cms_menu_node.node_links import refresh_node_links
+    refresh_node_links(missing_only=True)
     
     
+def rebuild_tree_with_root_check(NODE_CLASS, calling_node=None):
+    """Make sure there is a single root, then rebuild the tree from it
+    Returns the tree values, or None if there is no root"""
+    rows = load_tree_rows(NODE_CLASS)
     
-def rebuild_tree(parent_node, left_val=1):
-    """Recursive function to rebuild right/left tree values based on parent relationships.
+    calling_node_id = None
+    if calling_node is not None:
+        calling_node_id = calling_node.id
+    
+    root_id, root_fixes = find_single_root(rows, calling_node_id)
+    if root_fixes:
+        rows = apply_root_fixes(rows, root_fixes)
+        bulk_update_node_values(NODE_CLASS, ROOT_FIX_FIELDS, root_fixes)
+        set_node_root_fixes(calling_node, root_fixes)
+    
+    if root_id is None:
+        return None
+    tree_values = write_tree_values(NODE_CLASS, rows, compute_tree_values(rows, root_id))
+    node_paths = refresh_all_node_paths(NODE_CLASS)
+    
+    # keep the calling node in sync with what was written
+    set_node_tree_values(calling_node, tree_values)
+    set_node_paths(calling_node, node_paths)
+    return tree_values
+    
+    
+# (id, parent_id, visible, is_root, left_val, right_val, menu_level, parent_node_id, sibling_order)
+TREE_ROW_FIELDS = ('id', 'parent', 'visible', 'is_root') + TREE_VALUE_FIELDS
+
+def load_tree_rows(NODE_CLASS):
+    """One query for the whole tree, see TREE_ROW_FIELDS"""
+    return list(NODE_CLASS.objects.values_list(*TREE_ROW_FIELDS).order_by())
+
+
+def write_tree_values(NODE_CLASS, rows, tree_values):
+    """Only write back rows that changed"""
+    current_values = dict(map(lambda x: (x[0], tuple(x[4:])), rows))
+    changed_values = {}
+    for node_id, vals in tree_values.iteritems():
+        if current_values.get(node_id) != vals:
+            changed_values[node_id] = vals
+    
+    bulk_update_node_values(NODE_CLASS, TREE_VALUE_FIELDS, changed_values)
+    return tree_values
+    
+    
+def rebuild_tree(root_node, left_val=1):
+    """Rebuild right/left tree values based on parent relationships.
     Purpose is to create a Modified Preorder Tree Traversal (MPTT)
     Modified from PHP example here: http://blogs.sitepoint.com/hierarchical-data-database-2/
         To run: rebuild_tree(root_node)
+        
+    The whole tree is loaded with one query and the new values are computed in memory.
+    Only rows whose values changed are written back.
+    
+    Returns { node id : (left_val, right_val, menu_level, parent_node_id, sibling_order) }
+    """
+    if root_node is None:
+        return {}
+    
+    NODE_CLASS = get_to_node_class(root_node.__class__)
+    
+    rows = load_tree_rows(NODE_CLASS)
+    tree_values = compute_tree_values(rows, root_node.id, left_val)
+    run_in_transaction(write_tree_values, NODE_CLASS, rows, tree_values)
+    
+    set_node_tree_values(root_node, tree_values)
+    return tree_values
+
+
+def compute_tree_values(rows, root_id, left_val=1):
+    """Compute the MPTT values for every node in a single traversal
+    
+    rows: see TREE_ROW_FIELDS
+    
+    - Visible nodes reachable from the root receive left/right values.  Children are 
+        ordered by (sibling_order, id) and sibling_order is reset to the left value 
+    - Nodes not reachable from the root (not visible or below a node that is not visible)
+        are detached: left/right are set to -1 and the menu level follows the parent chain
+    
+    Returns { node id : (left_val, right_val, menu_level, parent_node_id, sibling_order) }
+    """
+    parent_lu = {}          # { node id : parent id }
+    sibling_order_lu = {}   # { node id : sibling_order }
+    children_lu = {}        # { parent id : [ (sibling_order, child id), ...] }  -- visible only
+    for row in rows:
+        node_id, parent_id, visible = row[:3]
+        sibling_order = row[-1]
+        parent_lu[node_id] = parent_id
+        sibling_order_lu[node_id] = sibling_order
+        if visible and parent_id is not None:
+            children_lu.setdefault(parent_id, []).append((sibling_order, node_id))
+    
+    for child_list in children_lu.values():
+        child_list.sort()
+    
+    tree_values = {}
+    if root_id not in parent_lu:
+        return tree_values
+    
+    # iterative preorder traversal -- no recursion limit on deep trees
+    #   stack holds [node id, menu level, left val, index of next child]
+    counter = left_val
+    stack = [[root_id, 1, counter, 0]]
+    while stack:
+        frame = stack[-1]
+        node_id, menu_level, node_left, child_idx = frame
+        child_list = children_lu.get(node_id, [])
+        if child_idx < len(child_list):
+            frame[3] += 1
+            child_id = child_list[child_idx][1]
+            if child_id in tree_values:
+                continue    # already placed; guards against circular parent data
+            counter += 1
+            tree_values[child_id] = None    # placeholder, filled in on the way back up
+            stack.append([child_id, menu_level + 1, counter, 0])
+        else:
+            counter += 1
+            stack.pop()
+            tree_values[node_id] = (node_left, counter, menu_level\
+                                    , parent_lu.get(node_id) or -1, node_left)
+    
+    # detached nodes: no left/right, menu level based on the parent chain
+    level_lu = dict(map(lambda x: (x[0], x[1][2]), tree_values.items()))
+    for node_id in parent_lu.keys():
+        if node_id in tree_values:
+            continue
+        tree_values[node_id] = (-1, -1, get_menu_level_from_parents(node_id, parent_lu, level_lu)\
+                                , parent_lu.get(node_id) or -1, sibling_order_lu[node_id])
+    
+    return tree_values
+
+
+def get_menu_level_from_parents(node_id, parent_lu, level_lu):
+    """Menu level for a node outside the MPTT tree, found by walking up parent_lu.
+    Levels found along the way are stored in level_lu"""
+    path = []
+    current_id = node_id
+    while current_id is not None and current_id not in level_lu:
+        if current_id in path:
+            break       # circular parent data
+        path.append(current_id)
+        current_id = parent_lu.get(current_id)
+    
+    menu_level = level_lu.get(current_id, 0)
+    for path_id in reversed(path):
+        menu_level += 1
+        level_lu[path_id] = menu_level
+    return level_lu[node_id]
+    
+    
+def set_node_tree_values(node, tree_values):
+    """Copy computed tree values onto an in-memory node"""
+    if node is None or node.id not in tree_values:
+        return
+    for attr, val in zip(TREE_VALUE_FIELDS, tree_values[node.id]):
+        setattr(node, attr, val)
+
+
+def run_in_transaction(func, *args, **kwargs):
+    """Run func in a transaction.  If a transaction is already being managed,
+    e.g. the admin's commit_on_success, run inside of it"""
+    if transaction.is_managed():
+        return func(*args, **kwargs)
+    
+    with transaction.commit_on_success():
+        return func(*args, **kwargs)
+
+
+BULK_UPDATE_MAX_PARAMS = 900    # stay under SQLite's 999 variable limit
+
+def bulk_update_node_values(NODE_CLASS, field_names, changed_values):
+    """Write many rows with a few UPDATE statements, using CASE on the primary key
+    
+    changed_values: { node id : (value for field_names[0], value for field_names[1], ...) }
     """
-    if parent_node is None:
+    if not changed_values:
         return
     
-    NODE_CLASS = parent_node.__class__
-       
-    #msg('rebuild tree: [%s][%s]' % (parent_node, left_val))
-    right_val = left_val + 1
+    qn = connection.ops.quote_name
+    opts = NODE_CLASS._meta
+    pk_column = qn(opts.pk.column)
+    columns = map(lambda x: qn(opts.get_field(x).column), field_names)
+    
+    node_ids = sorted(changed_values.keys())
+    chunk_size = max(1, BULK_UPDATE_MAX_PARAMS / (2 * len(columns) + 1))
+    
+    cursor = connection.cursor()
+    for idx in range(0, len(node_ids), chunk_size):
+        chunk_ids = node_ids[idx:idx+chunk_size]
+        
+        set_clauses = []
+        params = []
+        for col_idx, column in enumerate(columns):
+            when_clauses = []
+            for node_id in chunk_ids:
+                when_clauses.append('WHEN %s THEN %s')
+                params += [node_id, changed_values[node_id][col_idx]]
+            set_clauses.append('%s = CASE %s %s END' % (column, pk_column, ' '.join(when_clauses)))
+        params += chunk_ids
+        
+        sql = 'UPDATE %s SET %s WHERE %s IN (%s)' % (qn(opts.db_table)\
+                            , ', '.join(set_clauses)\
+                            , pk_column\
+                            , ', '.join(['%s'] * len(chunk_ids)))
+        cursor.execute(sql, params)
+    
+    transaction.set_dirty()
+    
+
+# ------------------------------------------
+# Incremental updates
+#   Shift left/right ranges with a few UPDATE statements instead of 
+#   rebuilding the whole tree.  Each function returns False if the 
+#   change can't be handled incrementally--caller does a full rebuild
+# ------------------------------------------
+
+def update_tree_for_saved_node(NODE_CLASS, node, created=False):
+    """Update the MPTT values after "node" was saved.  
+    Uses "node._tree_state_before_save", set in Node.save()"""
+    if node is None or node.id is None:
+        return False
+    
+    old_state = getattr(node, '_tree_state_before_save', None)
+    if not created and old_state is None:
+        return False        # don't know what changed
+    
+    new_state = (node.parent_id, node.visible, node.sibling_order)
+    
+    # root changes go through check_for_single_root
+    if node.parent_id is None or (old_state and old_state[0] is None):
+        return False
+    
+    if created:
+        if node.visible:
+            return insert_node_interval(NODE_CLASS, node)
+        return detach_new_node(NODE_CLASS, node)
+    
+    if old_state == new_state:
+        return True         # nothing that shapes the tree changed
+        
+    old_parent_id, old_visible, old_sibling_order = old_state
+    if node.visible and not old_visible:
+        return False        # node (and its children) are added back to the tree
+    
+    node_vals = get_tree_values_from_db(NODE_CLASS, [node.id]).get(node.id)
+    if node_vals is None:
+        return False
+    left_val, right_val, menu_level = node_vals
+    
+    if left_val < 1:
+        # node is not on the MPTT tree.  
+        # Only ok if still off the tree at the same level
+        return old_parent_id == node.parent_id
+    
+    if not node.visible:
+        if old_parent_id != node.parent_id:
+            return False
+        return detach_subtree(NODE_CLASS, node)
+    
+    return move_subtree(NODE_CLASS, node, node.parent_id)
+
+
+def are_tree_values_current():
+    """Do the saved left/right values match the parent relationships?  
+    Not while tree updates are deferred, queued for a background worker or suspended"""
+    return not (is_rebuild_deferred() or is_background_rebuild() or are_tree_updates_suspended())
+    
+
+_recursive_query_state = { 'supported' : None }     # WITH RECURSIVE, None until tried
+
+def is_descendant_in_db(NODE_CLASS, node_id, ancestor_id):
+    """Is node_id the same as, or below, ancestor_id?  Follows the saved parent 
+    relationships up from node_id with one recursive query--left/right values aren't used.
+    (UNION stops at a node already seen, even if the saved parents are circular)
+    
+    Returns None if the database doesn't support WITH RECURSIVE (e.g. MySQL before 8.0).
+    The statement runs in a savepoint: on PostgreSQL a failed statement would abort 
+    the transaction, and every later query of the save with it"""
+    if _recursive_query_state['supported'] is False:
+        return None
+    sql = """WITH RECURSIVE ancestors(node_id, parent_id) AS (
+                    SELECT {id}, {parent} FROM {table} WHERE {id} = %s
+                UNION
+                    SELECT t.{id}, t.{parent} FROM {table} t INNER JOIN ancestors a ON t.{id} = a.parent_id
+            )
+            SELECT COUNT(*) FROM ancestors WHERE node_id = %s"""
+    cursor = connection.cursor()
+    sid = transaction.savepoint()
+    try:
+        cursor.execute(sql.format(**get_tree_sql_names(NODE_CLASS)), [node_id, ancestor_id])
+        is_descendant = cursor.fetchone()[0] > 0
+    except DatabaseError:
+        transaction.savepoint_rollback(sid)
+        _recursive_query_state['supported'] = False      # not tried again in this process
+        return None
+    transaction.savepoint_commit(sid)
+    _recursive_query_state['supported'] = True
+    return is_descendant
+    
+    
+def get_tree_values_from_db(NODE_CLASS, node_ids):
+    """Returns { node id : (left_val, right_val, menu_level) }"""
+    qs = NODE_CLASS.objects.filter(id__in=node_ids).values_list('id', 'left_val', 'right_val', 'menu_level').order_by()
+    return dict(map(lambda x: (x[0], x[1:]), qs))
+
+
+def get_tree_sql_names(NODE_CLASS):
+    """Quoted table/column names for use in str.format()"""
+    qn = connection.ops.quote_name
+    opts = NODE_CLASS._meta
+    name_lu = { 'table' : qn(opts.db_table), 'id' : qn(opts.pk.column) }
+    for key, field_name in (('left', 'left_val'), ('right', 'right_val'), ('level', 'menu_level')\
+                            , ('order', 'sibling_order'), ('parent', 'parent'), ('parent_node_id', 'parent_node_id')):
+        name_lu[key] = qn(opts.get_field(field_name).column)
+    return name_lu
+
+
+def execute_tree_sql(NODE_CLASS, sql, params):
+    """sql uses {table}, {left}, {right}, etc for names and %s for params
+    Note: sibling_order is set before left_val in each statement; MySQL applies SET clauses in order"""
+    cursor = connection.cursor()
+    cursor.execute(sql.format(**get_tree_sql_names(NODE_CLASS)), params)
+    transaction.set_dirty()
+    
+    
+def open_tree_gap(NODE_CLASS, gap_left, width):
+    """Make room for "width" values starting at gap_left"""
+    execute_tree_sql(NODE_CLASS, 'UPDATE {table} SET {order} = {left} + %s, {left} = {left} + %s WHERE {left} >= %s', [width, width, gap_left])
+    execute_tree_sql(NODE_CLASS, 'UPDATE {table} SET {right} = {right} + %s WHERE {right} >= %s', [width, gap_left])
+
+
+def close_tree_gap(NODE_CLASS, gap_right, width):
+    """Remove "width" values ending at gap_right"""
+    execute_tree_sql(NODE_CLASS, 'UPDATE {table} SET {order} = {left} - %s, {left} = {left} - %s WHERE {left} > %s', [width, width, gap_right])
+    execute_tree_sql(NODE_CLASS, 'UPDATE {table} SET {right} = {right} - %s WHERE {right} > %s', [width, gap_right])
+
+
+def get_insert_position(NODE_CLASS, node, parent_id):
+    """Where should "node" go among the visible children of parent_id, ordered by (sibling_order, id)?
+    Returns the id of the sibling that will follow the node, or None to add it as the last child"""
+    next_sibling_ids = NODE_CLASS.objects.filter(parent=parent_id, visible=True, left_val__gt=0)\
+                            .exclude(id=node.id)\
+                            .filter(Q(sibling_order__gt=node.sibling_order) | Q(sibling_order=node.sibling_order, id__gt=node.id))\
+                            .order_by('sibling_order', 'id').values_list('id', flat=True)[:1]
+    if len(next_sibling_ids) == 0:
+        return None
+    return next_sibling_ids[0]
     
-    # get children of this node
-    for child_node in NODE_CLASS.objects.filter(parent=parent_node, visible=True).order_by('sibling_order'):
-        # for each child of this node "right_val" is the current right value,
-        # which is incremented by the rebuild_tree function   
-        right_val = rebuild_tree(child_node, right_val)
 
-    # we've got the left value, and now that we've processed   
-    # the children of this node we also know the right value   
-    parent_node.left_val = left_val
-    parent_node.right_val = right_val
-    parent_node.save()
+def get_gap_left(NODE_CLASS, parent_id, next_sibling_id):
+    """left_val for a node placed before next_sibling_id--or as the last child of parent_id"""
+    if next_sibling_id is None:
+        parent_vals = get_tree_values_from_db(NODE_CLASS, [parent_id]).get(parent_id)
+        return parent_vals[1]          # parent's right_val
+    return get_tree_values_from_db(NODE_CLASS, [next_sibling_id])[next_sibling_id][0]
+        
+            
+def insert_node_interval(NODE_CLASS, node):
+    """Add a new leaf node to the tree"""
+    parent_vals = get_tree_values_from_db(NODE_CLASS, [node.parent_id]).get(node.parent_id)
+    if parent_vals is None or parent_vals[0] < 1:
+        return False        # parent isn't on the tree
+    
+    next_sibling_id = get_insert_position(NODE_CLASS, node, node.parent_id)
+    gap_left = get_gap_left(NODE_CLASS, node.parent_id, next_sibling_id)
+    open_tree_gap(NODE_CLASS, gap_left, 2)
+    
+    tree_values = { node.id : (gap_left, gap_left+1, parent_vals[2]+1, node.parent_id, gap_left) }
+    bulk_update_node_values(NODE_CLASS, TREE_VALUE_FIELDS, tree_values)
+    set_node_tree_values(node, tree_values)
+    return True
+
+
+def detach_new_node(NODE_CLASS, node):
+    """A new node that is not visible: no left/right values"""
+    parent_vals = get_tree_values_from_db(NODE_CLASS, [node.parent_id]).get(node.parent_id)
+    if parent_vals is None:
+        return False
+    
+    tree_values = { node.id : (-1, -1, parent_vals[2]+1, node.parent_id, node.sibling_order) }
+    bulk_update_node_values(NODE_CLASS, TREE_VALUE_FIELDS, tree_values)
+    set_node_tree_values(node, tree_values)
+    return True
+    
     
-    return right_val + 1
+def detach_subtree(NODE_CLASS, node):
+    """Take a node and its descendants off the tree, e.g. when the node is hidden"""
+    left_val, right_val, menu_level = get_tree_values_from_db(NODE_CLASS, [node.id])[node.id]
     
+    execute_tree_sql(NODE_CLASS, 'UPDATE {table} SET {left} = -1, {right} = -1 WHERE {left} >= %s AND {left} <= %s', [left_val, right_val])
+    close_tree_gap(NODE_CLASS, right_val, right_val - left_val + 1)
+    
+    node.left_val = -1
+    node.right_val = -1
+    return True
+    
+    
+def can_shift_detached_levels(NODE_CLASS, node):
+    """Can the detached descendants of "node" be found (see shift_detached_levels)?
+    Yes with the stored ancestor ids--or if no node is off the tree"""
+    return bool(node.ancestor_ids) or not NODE_CLASS.objects.filter(left_val__lt=1).exists()
+
 
+def shift_detached_levels(NODE_CLASS, node, level_offset):
+    """Descendants of "node" that are off the tree (not visible, or below a node that 
+    is not visible) have no left/right values to shift: change their menu level by 
+    level_offset, found by the ancestor_ids prefix saved before the move"""
+    if level_offset == 0 or not node.ancestor_ids:
+        return
+    NODE_CLASS.objects.filter(ancestor_ids__startswith=node.ancestor_ids, left_val__lt=1).exclude(id=node.id)\
+                    .update(menu_level=F('menu_level') + level_offset)
+
+
+def move_subtree(NODE_CLASS, node, new_parent_id, next_sibling_id=False):
+    """Move a node and its descendants under new_parent_id. 
+    Position among the new siblings follows node.sibling_order, unless next_sibling_id is given 
+    (None means last child)"""
+    tree_vals = get_tree_values_from_db(NODE_CLASS, [node.id, new_parent_id])
+    if not (node.id in tree_vals and new_parent_id in tree_vals):
+        return False
+    left_val, right_val, menu_level = tree_vals[node.id]
+    new_parent_left, new_parent_right, new_parent_level = tree_vals[new_parent_id]
+    if left_val < 1 or new_parent_left < 1:
+        return False        # not on the tree
+    if left_val <= new_parent_left and new_parent_right <= right_val:
+        return False        # circular
+    if not can_shift_detached_levels(NODE_CLASS, node):
+        return False
+    
+    if next_sibling_id is False:
+        next_sibling_id = get_insert_position(NODE_CLASS, node, new_parent_id)
+    width = right_val - left_val + 1
+    
+    # (1) set the subtree aside by negating its values
+    execute_tree_sql(NODE_CLASS, 'UPDATE {table} SET {left} = 0 - {left}, {right} = 0 - {right} WHERE {left} >= %s AND {left} <= %s', [left_val, right_val])
+    
+    # (2) close the gap it left, (3) open a gap at the new position 
+    close_tree_gap(NODE_CLASS, right_val, width)
+    gap_left = get_gap_left(NODE_CLASS, new_parent_id, next_sibling_id)
+    open_tree_gap(NODE_CLASS, gap_left, width)
+    
+    # (4) put the subtree into the gap 
+    offset = gap_left - left_val
+    level_offset = (new_parent_level + 1) - menu_level
+    execute_tree_sql(NODE_CLASS, """UPDATE {table} SET {order} = %s - {left}, {left} = %s - {left}, {right} = %s - {right}, {level} = {level} + %s
+                                    WHERE {left} <= %s AND {left} >= %s""", [offset, offset, offset, level_offset, -left_val, -right_val])
+    shift_detached_levels(NODE_CLASS, node, level_offset)
+    
+    NODE_CLASS.objects.filter(id=node.id).update(parent_node_id=new_parent_id)
+    set_node_tree_values(node, { node.id : (gap_left, gap_left + width - 1, new_parent_level + 1, new_parent_id, gap_left) })
+    return True
+
+
+NODE_MOVE_POSITIONS = ('first-child', 'last-child', 'left', 'right')
+
+def get_move_destination(NODE_CLASS, node, target, position):
+    """Used by Node.move_to().  Returns (new parent id, sibling_order) placing 
+    "node" at "position" relative to "target".
+    
+    On the tree, sibling_order == left_val, so the new sibling_order falls 
+    between the new neighbors and the save moves the subtree straight there:
+        first-child: target left_val        last-child: target right_val
+        left: target left_val - 1           right: target left_val + 1
+    
+    Circular moves are found by left/right containment.
+    Raises InvalidNodeMove or ParentRelationshipCircular"""
+    if position not in NODE_MOVE_POSITIONS:
+        raise InvalidNodeMove(node, 'position must be one of %s' % ', '.join(NODE_MOVE_POSITIONS))
+    if node.id is None or target.id is None:
+        raise InvalidNodeMove(node, 'save both nodes first')
+    if node.id == target.id:
+        raise InvalidNodeMove(node, 'a node can not be moved next to itself')
+    
+    # (parent id, left_val, right_val, sibling_order), as saved
+    vals = NODE_CLASS.objects.filter(id__in=[node.id, target.id])\
+                        .values_list('id', 'parent', 'left_val', 'right_val', 'sibling_order').order_by()
+    vals = dict(map(lambda x: (x[0], x[1:]), vals))
+    node_parent_id, left_val, right_val = vals[node.id][:3]
+    target_parent_id, target_left, target_right, target_order = vals[target.id]
+    
+    if node_parent_id is None:
+        raise InvalidNodeMove(node, 'the root node can not be moved')
+    
+    if position in ('left', 'right'):
+        if target_parent_id is None:
+            raise InvalidNodeMove(node, 'the root node can not have siblings')
+        new_parent_id = target_parent_id
+    else:
+        new_parent_id = target.id
+    
+    # Circular?  The target is inside the node's subtree
+    #   (nodes off the tree are checked by walking the parents in Node.save())
+    if left_val > 0 and target_left > 0 and left_val < target_left < right_val:
+        raise ParentRelationshipCircular(node)
+    
+    if target_left > 0:
+        sibling_order = { 'first-child' : target_left, 'last-child' : target_right\
+                        , 'left' : target_left - 1, 'right' : target_left + 1 }[position]
+    elif position in ('left', 'right'):
+        # target is off the tree (hidden): ties are ordered by id 
+        sibling_order = target_order + { 'left' : -1, 'right' : 1 }[position]
+    else:
+        child_orders = NODE_CLASS.objects.filter(parent=target.id).exclude(id=node.id)\
+                        .aggregate(Min('sibling_order'), Max('sibling_order'))
+        if position == 'first-child':
+            sibling_order = (child_orders['sibling_order__min'] or 1) - 1
+        else:
+            sibling_order = (child_orders['sibling_order__max'] or 0) + 1
+        
+    return new_parent_id, sibling_order
+    
+
+def remove_node_interval(NODE_CLASS, node):
+    """After a node is deleted, its children (already reassigned to the node's parent) 
+    move up one level into its place"""
+    left_val, right_val = node.left_val, node.right_val
+    if node.is_root or left_val < 1 or right_val <= left_val:
+        return False
+    if not can_shift_detached_levels(NODE_CLASS, node):
+        return False
+    
+    execute_tree_sql(NODE_CLASS, 'UPDATE {table} SET {order} = {left} - 1, {left} = {left} - 1, {right} = {right} - 1, {level} = {level} - 1 WHERE {left} > %s AND {left} < %s', [left_val, right_val])
+    shift_detached_levels(NODE_CLASS, node, -1)
+    close_tree_gap(NODE_CLASS, right_val, 2)
+    execute_tree_sql(NODE_CLASS, 'UPDATE {table} SET {parent_node_id} = {parent} WHERE {parent_node_id} = %s', [node.id])
+    return True
+    
+    
 def rebuild_tree_after_node_deleted(sender, **kwargs):
     """Called after node deletion.  In most cases, rebuild the tree after deletion.
 
@@ -100,6 +677,17 @@ def rebuild_tree_after_node_deleted(sender, **kwargs):
     if not node_to_delete:
         return
 
+    if are_tree_updates_suspended():
+        return
+
+    if is_rebuild_deferred():
+        mark_tree_dirty(sender)
+        return
+    
+    if is_background_rebuild():
+        enqueue_tree_rebuild()
+        return
+
     NODE_CLASS =sender
     """
     Is this the last visible noded being deleted?  Then don't rebuild the tree
@@ -114,99 +702,171 @@ def rebuild_tree_after_node_deleted(sender, **kwargs):
         """
         return
 
-    rebuild_tree_after_node_saved(sender, **kwargs)
-
+    NODE_CLASS = get_to_node_class(sender)
+    
+    with suspend_tree_updates():
+        update_type = run_tree_update(update_tree_after_delete, NODE_CLASS, node_to_delete)
+    if update_type is not None:
+        tree_update_stats[update_type] += 1
 
-def check_for_single_root(node_to_be_saved):            #sender=None, **kwargs):
-    """There should always be 1 and only 1 root node.
-    Check for this each time a Node object is saved
 
-    NTS = Node to Save
+def update_tree_after_delete(NODE_CLASS, node):
+    """Node.delete() reassigns the children before deleting--a simple shift.
+    Otherwise rebuild the tree.  Call through run_tree_update()"""
+    if getattr(node, '_tree_children_promoted', False) \
+            and remove_node_interval(NODE_CLASS, node):
+        # the promoted descendants: their ancestor ids still include the deleted node
+        if node.ancestor_ids:
+            refresh_node_paths(NODE_CLASS, [], node.ancestor_ids)
+        else:
+            refresh_all_node_paths(NODE_CLASS)
+        return 'incremental'
 
-    possibilities:
-    (1) node_to_be_saved is the only visible node -> make it the root  (May be first Node added to system)
-    (2) more than one root node
-    (3) new root?
-    
-    (4) root has been deleted
-    """    
-    if node_to_be_saved is None:
-        return
-        
-    NODE_CLASS = node_to_be_saved.__class__
-    
-    #msgt('node_to_be_saved: [obj:%s] [name:%s]' % ( node_to_be_saved, node_to_be_saved.name))
-    #msg('id: %s' % node_to_be_saved.id)
-
-    # If it doesn't have one, give the node to be saved an id
-    if node_to_be_saved.id is None:
-        node_to_be_saved.save()         # save it so that it can be parent of old root
-        
-    # check (1)
-    #
-    #msg('(1) Only visible node -> make it the root')
-    if node_to_be_saved and NODE_CLASS.objects.filter(visible=True).exclude(pk=node_to_be_saved.id).count() == 0:    
-        node_to_be_saved.parent = None
-        node_to_be_saved.visible = True # make sure it is visible
-        node_to_be_saved.save()
-        #msg('ok')
-        return
-
-    #msg('(2) Multiple root nodes  (multiple nodes with no parent)')
-    #
-    root_nodes = NODE_CLASS.objects.filter(parent=None, visible=True).order_by('left_val', 'sibling_order')
-    if root_nodes.count() > 1:
-        #   Make the 1st node the root and the rest its children
-        new_root_node = None
-        for idx, rn in enumerate(root_nodes):
-            if idx==0:
-                new_root_node = rn
-            else:
-                rn.parent = new_root_node
-                rn.parent.is_root = False
-                rn.save()
-        #msg('ok')
-        return
+    if rebuild_tree_with_root_check(NODE_CLASS, node) is None:
+        return None
+    return 'full'
         
-            
-    #
-    #
-    #msg('(3) node_to_be_saved is not a root node, there is already 1 root node')
-    if node_to_be_saved and node_to_be_saved.parent is not None and NODE_CLASS.objects.filter(is_root=True, visible=True).exclude(pk=node_to_be_saved.id).count() ==1:
-        #msg('ok')
-        return
 
+# ------------------------------------------
+# Root check
+# ------------------------------------------
+ROOT_FIX_FIELDS = ('parent', 'visible', 'is_root')
 
-    #msg('(4) node_to_be_saved is a new root node, make the NTS parent of current root')
-    if node_to_be_saved and node_to_be_saved.parent is None and NODE_CLASS.objects.filter(visible=True).count() > 1:
-        #msg('-> yes')
-        node_to_be_saved.visible = True # make sure it is visible
-        node_to_be_saved.save()         # check This!
+def check_for_single_root(node_to_be_saved):
+    """There should always be 1 and only 1 root node.
+    Fix the parent/visible values if needed, see find_single_root()
+    Returns the root id"""
+    if node_to_be_saved is None or node_to_be_saved.id is None:
+        return None
         
-        for rn in NODE_CLASS.objects.filter(parent=None, visible=True).exclude(pk=node_to_be_saved.id):
-            if rn.id == node_to_be_saved.id or rn == node_to_be_saved:     # this is the new root, skip it
-                pass
-            else:
-                rn.parent = node_to_be_saved    # set new parent for old root
-                rn.save()
-        return
+    NODE_CLASS = get_to_node_class(node_to_be_saved.__class__)
+    
+    root_id, root_fixes = find_single_root(load_tree_rows(NODE_CLASS), node_to_be_saved.id)
+    run_in_transaction(bulk_update_node_values, NODE_CLASS, ROOT_FIX_FIELDS, root_fixes)
+    set_node_root_fixes(node_to_be_saved, root_fixes)
+    return root_id
+    
+    
+def find_single_root(rows, node_id=None):
+    """There should always be 1 and only 1 root node.  Computed from the tree rows, no queries.
+
+    NTS = Node to Save, node_id
+    
+    possibilities:
+    (0) one visible root -> ok
+    (1) NTS is the only visible node -> make it the root  (May be first Node added to system)
+    (2) more than one root node -> first by (left_val, sibling_order) is the root, the others its children
+    (3) NTS is not a root node, there is already 1 root node
+    (4) NTS is a new root node -> make the NTS parent of current root
+    (5) root has been deleted or hidden -> follow the parents of NTS to the top, make it visible
+    
+    rows: see TREE_ROW_FIELDS
+    Returns (root id or None, { node id : (parent_id, visible, is_root) } for nodes to fix)
+    """
+    node_lu = {}        # { node id : [parent_id, visible, is_root] }
+    sort_lu = {}        # { node id : (left_val, sibling_order, id) }
+    for row in rows:
+        node_lu[row[0]] = [row[1], bool(row[2]), bool(row[3])]
+        sort_lu[row[0]] = (row[4], row[-1], row[0])
+    
+    fixes = {}
+    def set_parent(fix_id, parent_id):
+        node_lu[fix_id][0] = parent_id
+        node_lu[fix_id][2] = parent_id is None
+        fixes[fix_id] = tuple(node_lu[fix_id])
+    
+    def set_visible(fix_id):
+        node_lu[fix_id][1] = True
+        fixes[fix_id] = tuple(node_lu[fix_id])
         
-    #msg('(5) There are no root nodes! Make a new root node by following the parent of current node')
-    if node_to_be_saved is None:
-        visible_nodes = NODE_CLASS.objects.filter(visible=True).order_by('left_val', 'sibling_order')
-        if visible_nodes.count() > 0:
-            not_to_be_saved = visible_nodes[0]
-        else:
-            return 
-            
-    potential_root = node_to_be_saved
-    level_cnt = 0
-    while potential_root.parent is not None:          
-        level_cnt +=1
-        potential_root = potential_root.parent        # iterate to top of tree for this node
-        if level_cnt == 100: break              # something seriously wrong
-    potential_root.visible=True
-    potential_root.save()
+    def get_ids(**kwargs):
+        """ids by (parent_id=None, visible=True, is_root=True), ordered"""
+        ids = node_lu.keys()
+        for attr_idx, attr in enumerate(('parent_id', 'visible', 'is_root')):
+            if attr in kwargs:
+                ids = filter(lambda x: node_lu[x][attr_idx] == kwargs[attr], ids)
+        ids.sort(key=lambda x: sort_lu[x])
+        return ids
+        
+    if node_id not in node_lu:
+        node_id = None      # e.g. deleted
+    
+    # (0) one visible root
+    root_ids = get_ids(visible=True, is_root=True)
+    if len(root_ids) == 1:
+        return (root_ids[0], fixes)
+    
+    visible_ids = get_ids(visible=True)
+    
+    # (1) NTS is the only visible node -> make it the root
+    if node_id is not None and len(filter(lambda x: x != node_id, visible_ids)) == 0:
+        set_parent(node_id, None)
+        set_visible(node_id)
+        return (node_id, fixes)
+    
+    # (2) more than one root node (multiple nodes with no parent)
+    root_ids = get_ids(parent_id=None, visible=True)
+    if len(root_ids) > 1:
+        for other_root_id in root_ids[1:]:
+            set_parent(other_root_id, root_ids[0])
+        return (root_ids[0], fixes)
+    
+    # (3) NTS is not a root node, there is already 1 root node
+    other_root_ids = filter(lambda x: x != node_id, get_ids(visible=True, is_root=True))
+    if node_id is not None and node_lu[node_id][0] is not None and len(other_root_ids) == 1:
+        return (other_root_ids[0], fixes)
+    
+    # (4) NTS is a new root node, make it the parent of the current root
+    if node_id is not None and node_lu[node_id][0] is None and len(visible_ids) > 1:
+        set_visible(node_id)
+        for other_root_id in filter(lambda x: x != node_id, root_ids):
+            set_parent(other_root_id, node_id)
+        return (node_id, fixes)
+    
+    # (5) There are no root nodes! Make a new root node by following the parent of current node
+    if node_id is None:
+        if len(visible_ids) == 0:
+            return (None, fixes)
+        node_id = visible_ids[0]
+    
+    potential_root_id = node_id
+    seen_ids = set([potential_root_id])
+    while node_lu[potential_root_id][0] is not None:
+        parent_id = node_lu[potential_root_id][0]
+        if parent_id in seen_ids or parent_id not in node_lu:
+            set_parent(potential_root_id, None)     # something seriously wrong
+            break
+        seen_ids.add(parent_id)
+        potential_root_id = parent_id
+    set_visible(potential_root_id)
+    
+    root_ids = get_ids(visible=True, is_root=True)
+    if len(root_ids) == 0:
+        return (None, fixes)
+    return (root_ids[0], fixes)
+    
+
+def apply_root_fixes(rows, root_fixes):
+    """rows with the (parent_id, visible, is_root) fixes applied"""
+    fixed_rows = []
+    for row in rows:
+        fix = root_fixes.get(row[0])
+        if fix is not None:
+            row = (row[0],) + tuple(fix) + tuple(row[4:])
+        fixed_rows.append(row)
+    return fixed_rows
+    
+    
+def set_node_root_fixes(node, root_fixes):
+    """Copy root fixes onto an in-memory node"""
+    if node is None or node.id not in root_fixes:
+        return
+    parent_id, node.visible, node.is_root = root_fixes[node.id]
+    if parent_id is None:
+        node.parent = None
+    elif parent_id != node.parent_id:
+        node.parent_id = parent_id
+        node.__dict__.pop('_parent_cache', None)
     
 
 def get_to_node_class(sender):
@@ -214,13 +874,9 @@ def get_to_node_class(sender):
         # log a critical err
         msgx('FAIL:  NODE_CLASS is None')
         
-    # get to the Node class
+    # get to the Node class, e.g. from Page or a deferred Page class
     NODE_CLASS_NAME = 'Node'
-    if sender.__name__ == NODE_CLASS_NAME:
-        return sender
-    
-    # only checking depth of one level
-    for bc in sender.__bases__: 
+    for bc in sender.__mro__: 
         if bc.__name__ == NODE_CLASS_NAME:
             return bc
                 
@@ -228,16 +884,268 @@ def get_to_node_class(sender):
     msgx('FAIL:  NODE_CLASS is None')
 
 
+# ------------------------------------------
+# Signal registration
+#   post_save is sent with the class being saved, e.g. Page, so the handler is 
+#   connected for Node and each subclass.  post_delete is also sent for the 
+#   Node parent object of a subclass, so it is only connected for Node.
+#   Instances loaded with .only()/.defer() are sent with their deferred class, 
+#   e.g. Node_Deferred_name, which is connected as it is created.
+# ------------------------------------------
+TREE_SIGNAL_UID = 'cms_menu_node.tree_builder'
+
+node_subclasses = {}    # { subclass name : model class }  e.g. { 'Page' : Page }
+deferred_node_classes = []      # deferred classes of Node and its subclasses
+
+def register_node_subclass(node_subclass):
+    """Called as each Node subclass is prepared, see cms_menu_node.models"""
+    node_subclasses[node_subclass.__name__] = node_subclass
+    post_save.connect(rebuild_tree_after_node_saved, sender=node_subclass, dispatch_uid=TREE_SIGNAL_UID)
+    
+def register_deferred_node_class(deferred_class):
+    """Called as each deferred class of Node, or a subclass, is prepared"""
+    deferred_node_classes.append(deferred_class)
+    post_save.connect(rebuild_tree_after_node_saved, sender=deferred_class, dispatch_uid=TREE_SIGNAL_UID)
+    if is_deferred_node(deferred_class):
+        post_delete.connect(rebuild_tree_after_node_deleted, sender=deferred_class, dispatch_uid=TREE_SIGNAL_UID)
+    
+def is_deferred_node(deferred_class):
+    """A deferred Node, not a subclass: post_delete of a deferred Page is also sent for its Node"""
+    return deferred_class._meta.proxy_for_model is get_to_node_class(deferred_class)
+    
+def get_node_subclass(subclass_name):
+    """e.g. get_node_subclass('Page') -> Page, or None if not registered.  (in place of eval)"""
+    return node_subclasses.get(subclass_name, None)
+
+def get_node_subclass_accessors(node_obj_class):
+    """{ subclass name : reverse one-to-one name } for the direct subclasses, 
+    e.g. { 'Page' : 'page', 'PageDirectLink' : 'pagedirectlink' }.
+    Used with select_related() to fetch the nodes and their subclasses in one query"""
+    node_obj_class = get_to_node_class(node_obj_class)
+    accessors = {}
+    for subclass_name, node_subclass in node_subclasses.items():
+        parent_link = node_subclass._meta.parents.get(node_obj_class, None)
+        if parent_link is not None:
+            accessors[subclass_name] = parent_link.related.get_accessor_name()
+    return accessors
+    
+def get_node_signal_senders(node_obj_class):
+    return [node_obj_class] + node_subclasses.values() + deferred_node_classes
+
+def get_node_delete_signal_senders(node_obj_class):
+    return [node_obj_class] + filter(is_deferred_node, deferred_node_classes)
+
+
+_signal_state = { 'connected' : False }     # set by connect_node_signals/disconnect_node_signals
+
+def are_node_signals_connected():
+    return _signal_state['connected']
+
 def disconnect_node_signals(node_obj_class):
     node_obj_class = get_to_node_class(node_obj_class)  # in case sender is a child of Node
-    """For Node: disconnect the post-save and pre-save signals"""
+    """For Node and its subclasses: disconnect the post-save and post-delete signals"""
+    _signal_state['connected'] = False
     #pre_save.disconnect(check_for_single_root, sender=Node)    
-    post_save.disconnect(rebuild_tree_after_node_saved, sender=node_obj_class)    
-    post_delete.disconnect(rebuild_tree_after_node_deleted, sender=node_obj_class)    
+    for sender in get_node_signal_senders(node_obj_class):
+        post_save.disconnect(rebuild_tree_after_node_saved, sender=sender, dispatch_uid=TREE_SIGNAL_UID)    
+    for sender in get_node_delete_signal_senders(node_obj_class):
+        post_delete.disconnect(rebuild_tree_after_node_deleted, sender=sender, dispatch_uid=TREE_SIGNAL_UID)    
 
 def connect_node_signals(node_obj_class):
     node_obj_class = get_to_node_class(node_obj_class)  # in case sender is a child of Node
-    """For Node: re-connect the post-save and pre-save signals"""
+    """For Node and its subclasses: re-connect the post-save and post-delete signals.
+    Connecting more than once has no effect"""
+    _signal_state['connected'] = True
     #pre_save.connect(check_for_single_root, sender=Node)    
-    post_save.connect(rebuild_tree_after_node_saved, sender=node_obj_class)    
-    post_delete.connect(rebuild_tree_after_node_deleted, sender=node_obj_class)    
+    for sender in get_node_signal_senders(node_obj_class):
+        post_save.connect(rebuild_tree_after_node_saved, sender=sender, dispatch_uid=TREE_SIGNAL_UID)    
+    for sender in get_node_delete_signal_senders(node_obj_class):
+        post_delete.connect(rebuild_tree_after_node_deleted, sender=sender, dispatch_uid=TREE_SIGNAL_UID)    
+
+
+# one tree update per save, even if the handler is connected more than once
+_save_ids = itertools.count(1)
+
+def get_next_save_id():
+    """Called by Node.save(), the post_save handler uses it to ignore repeats"""
+    return _save_ids.next()
+
+def is_save_already_handled(node):
+    save_id = getattr(node, '_tree_save_id', None)
+    if save_id is None:
+        return False        # e.g. raw save from loaddata
+    if getattr(node, '_tree_handled_save_id', None) == save_id:
+        return True
+    node._tree_handled_save_id = save_id
+    return False
+    
+
+# ------------------------------------------
+# Tree version and lock
+#   "generation" number, incremented each time new tree values are written.
+#   The version row is also the lock that serializes tree updates across
+#   processes, e.g. several gunicorn workers
+# ------------------------------------------
+TREE_VERSION_ID = 1
+
+def get_tree_version():
+    from cms_menu_node.models import TreeVersion
+    
+    versions = TreeVersion.objects.filter(id=TREE_VERSION_ID).values_list('version', flat=True)
+    if len(versions) == 0:
+        return 0
+    return versions[0]
+    
+
+def get_tree_version_key():
+    """(version, modified) -- for caches kept across requests.  
+    If a tree update is rolled back, the next update reuses its version number, 
+    but not its timestamp"""
+    from cms_menu_node.models import TreeVersion
+    
+    version_keys = TreeVersion.objects.filter(id=TREE_VERSION_ID).values_list('version', 'modified')
+    if len(version_keys) == 0:
+        return (0, None)
+    return tuple(version_keys[0])
+    
+
+def bump_tree_version():
+    from cms_menu_node.models import TreeVersion
+    
+    if TreeVersion.objects.filter(id=TREE_VERSION_ID).update(version=F('version') + 1, modified=timezone.now()) == 0:
+        TreeVersion.objects.create(id=TREE_VERSION_ID, version=1)
+        
+
+def lock_tree():
+    """Lock the tree version row until the current transaction ends.
+    A second process updating the tree waits here, then reads the tree 
+    as the first one left it.
+    
+    Backends without SELECT ... FOR UPDATE (sqlite) take their write lock 
+    with a no-op UPDATE instead"""
+    from cms_menu_node.models import TreeVersion
+    
+    version_rows = TreeVersion.objects.filter(id=TREE_VERSION_ID)
+    if not connection.features.has_select_for_update:
+        if version_rows.update(version=F('version')) > 0:
+            return
+    elif len(version_rows.select_for_update().values_list('id', flat=True)) > 0:
+        return
+    
+    # first tree update: create the row.  If another process got there 
+    # first, wait for its lock instead
+    sid = transaction.savepoint()
+    try:
+        TreeVersion.objects.create(id=TREE_VERSION_ID, version=0)
+        transaction.savepoint_commit(sid)
+    except IntegrityError:
+        transaction.savepoint_rollback(sid)
+        list(version_rows.select_for_update().values_list('id', flat=True))
+
+
+def run_tree_update(func, *args, **kwargs):
+    """Run a tree update in one transaction, with the tree lock held.
+    If func returns something other than None/False, the tree version is 
+    incremented in the same transaction--readers never see new left/right 
+    values with an old version (or the reverse)"""
+    def locked_tree_update():
+        lock_tree()
+        result = func(*args, **kwargs)
+        if result is not None and result is not False:
+            bump_tree_version()
+        return result
+        
+    return run_in_transaction(locked_tree_update)
+    
+
+# ------------------------------------------
+# Suspending tree updates
+#   Per thread, unlike disconnect_node_signals(), which would also make 
+#   saves in other threads of the process skip their tree update
+# ------------------------------------------
+_suspend_state = threading.local()
+
+def are_tree_updates_suspended():
+    return getattr(_suspend_state, 'depth', 0) > 0
+
+@contextmanager
+def suspend_tree_updates():
+    """Saves and deletes in this thread don't update the tree inside the block, e.g.:
+    
+        with suspend_tree_updates():
+            child.parent = new_parent
+            child.save()
+        rebuild_tree_full(Node)
+    """
+    _suspend_state.depth = getattr(_suspend_state, 'depth', 0) + 1
+    try:
+        yield
+    finally:
+        _suspend_state.depth -= 1
+
+
+# ------------------------------------------
+# Deferred rebuilds
+#   Coalesce the tree updates for many saves into one rebuild
+# ------------------------------------------
+_deferred_state = threading.local()     # per thread: depth, node class to rebuild
+
+def is_rebuild_deferred():
+    return getattr(_deferred_state, 'depth', 0) > 0
+
+def mark_tree_dirty(node_obj_class):
+    """Record that the tree needs a rebuild when the outermost deferred_rebuild() block exits"""
+    _deferred_state.dirty_node_class = get_to_node_class(node_obj_class)
+
+
+@contextmanager
+def deferred_rebuild():
+    """Saves and deletes inside the block only mark the tree as changed.
+    When the outermost block exits, the tree is rebuilt once--if anything changed.
+
+    Also covers raw saves, e.g.:
+    
+        with deferred_rebuild():
+            call_command('loaddata', 'cms_pages.json')
+    
+    Blocks may be nested.  If the block raises an exception, the saves made 
+    before it are still rebuilt (and the tree version bumped), then the exception 
+    is raised.  If that rebuild fails too, call rebuild_tree_full(Node) once the 
+    data is fixed.  (not for KeyboardInterrupt or SystemExit: no rebuild)
+    
+    The signals are connected inside the block; if they were disconnected 
+    (disconnect_node_signals), they are disconnected again on exit.
+    """
+    from cms_menu_node.models import Node
+    
+    if not is_rebuild_deferred():
+        _deferred_state.dirty_node_class = None
+        _deferred_state.signals_were_connected = are_node_signals_connected()
+        connect_node_signals(Node)      # saves need to reach mark_tree_dirty()
+    
+    _deferred_state.depth = getattr(_deferred_state, 'depth', 0) + 1
+    exc_info = None
+    NODE_CLASS = None
+    try:
+        yield
+    except Exception:
+        exc_info = sys.exc_info()
+    finally:
+        _deferred_state.depth -= 1
+        if _deferred_state.depth == 0:      # a nested block leaves the rebuild to the outermost one
+            NODE_CLASS = _deferred_state.dirty_node_class
+            _deferred_state.dirty_node_class = None
+            if not _deferred_state.signals_were_connected:
+                disconnect_node_signals(Node)
+    
+    if NODE_CLASS is not None:
+        if exc_info is None:
+            rebuild_tree_full(NODE_CLASS)
+        else:
+            try:
+                rebuild_tree_full(NODE_CLASS)
+            except Exception:
+                pass        # the block's exception is the one to raise
+    
+    if exc_info is not None:
+        raise exc_info[0], exc_info[1], exc_info[2]
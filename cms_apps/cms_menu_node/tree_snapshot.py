@@ -0,0 +1,187 @@
+"""
+A read-only copy of the visible tree, shared by all requests in a process.
+
+    snapshot = get_tree_snapshot()
+    idx = snapshot.get_index(node_id)
+    for i in snapshot.get_ancestors(idx):
+        print snapshot.names[i]
+
+The nodes are held in parallel arrays, in left_val order.  A node is
+referred to by its position ("index") in the arrays.  Lookups use bisect
+on the sorted left_vals:
+    - descendants of index i: positions i+1 up to the first left_val > right_vals[i]
+    - children: the descendants, skipping over each child's own descendants
+    - ancestors: follow parent_indexes up to the root
+
+The snapshot is reloaded when the tree version changes (see tree_builder.get_tree_version_key)
+"""
+import threading
+from array import array
+from bisect import bisect_left
+
+from cms_menu_node.tree_builder import get_tree_version_key
+
+SNAPSHOT_FIELDS = ('id', 'parent', 'left_val', 'right_val', 'menu_level', 'subclass_name', 'slug', 'name'\
+                , 'cached_url', 'link_target', 'menu_label')
+
+class TreeSnapshot(object):
+    """The visible nodes (left_val > 0) in parallel arrays, ordered by left_val"""
+
+    def __init__(self, rows, version_key=(0, None)):
+        """rows: SNAPSHOT_FIELDS values, ordered by left_val"""
+        self.version_key = version_key
+        self.version = version_key[0]
+
+        self.ids = array('l')
+        self.parent_indexes = array('l')        # -1 for the root
+        self.left_vals = array('l')
+        self.right_vals = array('l')
+        self.menu_levels = array('l')
+        self.subclass_codes = array('h')        # position in self.subclass_names
+        self.subclass_names = []                # e.g. ['', 'Page', 'PageDirectLink']
+        self.slugs = []
+        self.names = []
+        self.cached_urls = []                   # '' if not known, see cms_menu_node/node_links.py
+        self.link_targets = []
+        self.menu_labels = []                   # e.g. the Page title, '' for a Node
+
+        index_lookup = {}       # { node id : index }, only while loading
+        subclass_lookup = {}
+        for node_id, parent_id, left_val, right_val, menu_level, subclass_name, slug, name, cached_url, link_target, menu_label in rows:
+            index_lookup[node_id] = len(self.ids)
+            self.ids.append(node_id)
+            self.parent_indexes.append(index_lookup.get(parent_id, -1))    # parents come first in left_val order
+            self.left_vals.append(left_val)
+            self.right_vals.append(right_val)
+            self.menu_levels.append(menu_level)
+            if subclass_name not in subclass_lookup:
+                subclass_lookup[subclass_name] = len(self.subclass_names)
+                self.subclass_names.append(subclass_name)
+            self.subclass_codes.append(subclass_lookup[subclass_name])
+            self.slugs.append(slug)
+            self.names.append(name)
+            self.cached_urls.append(cached_url)
+            self.link_targets.append(link_target)
+            self.menu_labels.append(menu_label)
+
+        # node id -> index, by bisect on the sorted ids
+        id_order = sorted(range(len(self.ids)), key=self.ids.__getitem__)
+        self.sorted_ids = array('l', [self.ids[i] for i in id_order])
+        self.sorted_id_indexes = array('l', id_order)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def get_index(self, node_id):
+        """Index of the node, or None if it isn't visible"""
+        pos = bisect_left(self.sorted_ids, node_id)
+        if pos < len(self.sorted_ids) and self.sorted_ids[pos] == node_id:
+            return self.sorted_id_indexes[pos]
+        return None
+
+    def get_index_by_left_val(self, left_val):
+        pos = bisect_left(self.left_vals, left_val)
+        if pos < len(self.left_vals) and self.left_vals[pos] == left_val:
+            return pos
+        return None
+
+    def get_subclass_name(self, idx):
+        return self.subclass_names[self.subclass_codes[idx]]
+
+    def get_parent(self, idx):
+        """Index of the parent, or None for the root"""
+        parent_idx = self.parent_indexes[idx]
+        if parent_idx < 0:
+            return None
+        return parent_idx
+
+    def get_ancestors(self, idx, include_self=False):
+        """Indexes from the root down to the node's parent (or the node)"""
+        ancestors = []
+        if include_self:
+            ancestors.append(idx)
+        parent_idx = self.parent_indexes[idx]
+        while parent_idx >= 0:
+            ancestors.append(parent_idx)
+            parent_idx = self.parent_indexes[parent_idx]
+        ancestors.reverse()
+        return ancestors
+
+    def get_descendant_range(self, idx):
+        """(start, stop) indexes of the descendants, for use with range()"""
+        return idx + 1, bisect_left(self.left_vals, self.right_vals[idx], idx + 1)
+
+    def get_descendants(self, idx):
+        return range(*self.get_descendant_range(idx))
+
+    def get_indexes_to_level(self, max_menu_level, start=0, stop=None):
+        """Indexes with menu_level <= max_menu_level, in left_val order, 
+        optionally limited to positions start..stop (e.g. a descendant range)"""
+        if stop is None:
+            stop = len(self.ids)
+        indexes = []
+        idx = start
+        while idx < stop:
+            if self.menu_levels[idx] <= max_menu_level:
+                indexes.append(idx)
+                idx += 1
+            else:
+                idx = self.get_descendant_range(idx)[1]     # its descendants are deeper still
+        return indexes
+
+    def is_descendant(self, idx, ancestor_idx):
+        return self.left_vals[ancestor_idx] < self.left_vals[idx] < self.right_vals[ancestor_idx]
+
+    def get_children(self, idx):
+        """Indexes of the children, in sibling order"""
+        children = []
+        child_idx, stop = self.get_descendant_range(idx)
+        while child_idx < stop:
+            children.append(child_idx)
+            child_idx = self.get_descendant_range(child_idx)[1]    # skip the child's descendants
+        return children
+
+    def get_siblings(self, idx, include_self=True):
+        """Indexes of the nodes with the same parent, in sibling order"""
+        parent_idx = self.get_parent(idx)
+        if parent_idx is None:
+            siblings = [idx]
+        else:
+            siblings = self.get_children(parent_idx)
+        if not include_self:
+            siblings.remove(idx)
+        return siblings
+
+
+# ------------------------------------------
+# One snapshot per process, reloaded when the tree version changes
+# ------------------------------------------
+_snapshot_lock = threading.Lock()
+_current_snapshot = None
+
+def load_tree_snapshot(version_key=(0, None)):
+    from cms_menu_node.models import Node
+
+    rows = Node.objects.filter(visible=True, left_val__gt=0).order_by('left_val').values_list(*SNAPSHOT_FIELDS)
+    return TreeSnapshot(rows, version_key)
+
+
+def get_tree_snapshot():
+    """The snapshot for the current tree version.  One query to check the
+    version, plus one to load the tree after it changes"""
+    global _current_snapshot
+
+    version_key = get_tree_version_key()    # read before the rows: a newer tree only causes an extra reload
+    snapshot = _current_snapshot
+    if snapshot is not None and snapshot.version_key == version_key:
+        return snapshot
+
+    with _snapshot_lock:
+        if _current_snapshot is None or _current_snapshot.version_key != version_key:
+            _current_snapshot = load_tree_snapshot(version_key)
+        return _current_snapshot
+
+
+def clear_tree_snapshot():
+    global _current_snapshot
+    _current_snapshot = None
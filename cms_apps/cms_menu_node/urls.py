@@ -0,0 +1,10 @@
+from django.conf.urls.defaults import *
+
+
+urlpatterns = patterns(
+    'cms_menu_node.views'
+    
+,    url(r'^parent-autocomplete/$', 'view_parent_autocomplete', name='view_node_parent_autocomplete')
+,
+    
+)
@@ -1 +1,61 @@
-# Create your views here.
+from django.contrib.admin.views.decorators import staff_member_required
+from django.db.models import Q
+from django.http import HttpResponse
+from django.utils import simplejson
+
+from cms_menu_node.models import Node
+
+AUTOCOMPLETE_PAGE_SIZE = 20
+AUTOCOMPLETE_MAX_PAGE_SIZE = 100
+
+
+def get_int_param(request, name, default, min_val=1, max_val=None):
+    try:
+        val = int(request.GET.get(name, default))
+    except ValueError:
+        val = default
+    val = max(val, min_val)
+    if max_val is not None:
+        val = min(val, max_val)
+    return val
+
+
+def search_parent_choices(query='', page=1, page_size=AUTOCOMPLETE_PAGE_SIZE, exclude_node_id=None):
+    """Visible nodes whose name or breadcrumb contains query, in tree order.
+    Excludes exclude_node_id and its descendants (they can't be its parent).
+    Returns ([(node id, breadcrumb), ...], has_more)"""
+    qs = Node.objects.filter(visible=True)
+    query = query.strip()
+    if query:
+        qs = qs.filter(Q(name__icontains=query) | Q(breadcrumb_path__icontains=query))
+
+    if exclude_node_id:
+        ancestor_ids = Node.objects.filter(id=exclude_node_id).values_list('ancestor_ids', flat=True)
+        if len(ancestor_ids) == 1 and ancestor_ids[0]:
+            qs = qs.exclude(ancestor_ids__startswith=ancestor_ids[0])
+        else:
+            qs = qs.exclude(id=exclude_node_id)
+
+    start = (page - 1) * page_size
+    rows = list(qs.order_by('left_val', 'id').values_list('id', 'name', 'breadcrumb_path')[start:start + page_size + 1])
+    choices = map(lambda (node_id, name, breadcrumb_path): (node_id, breadcrumb_path or name), rows[:page_size])
+    return choices, len(rows) > page_size
+
+
+@staff_member_required
+def view_parent_autocomplete(request):
+    """JSON for the admin parent picker (cms_menu_node/widgets.py)
+
+    GET params: q - text in the name or breadcrumb, page - from 1, page_size, exclude - node id
+    Returns: { "results" : [ { "id" : 7, "text" : "food -> fruit -> apple" }, ...], "page" : 1, "has_more" : false }
+    """
+    page = get_int_param(request, 'page', 1)
+    page_size = get_int_param(request, 'page_size', AUTOCOMPLETE_PAGE_SIZE, max_val=AUTOCOMPLETE_MAX_PAGE_SIZE)
+    exclude_node_id = get_int_param(request, 'exclude', 0, min_val=0)
+
+    choices, has_more = search_parent_choices(request.GET.get('q', ''), page, page_size, exclude_node_id)
+
+    d = { 'results' : map(lambda (node_id, text): { 'id' : node_id, 'text' : text }, choices)\
+        , 'page' : page\
+        , 'has_more' : has_more }
+    return HttpResponse(simplejson.dumps(d), mimetype='application/json')
@@ -0,0 +1,94 @@
+"""
+Autocomplete picker for the "parent" of a Node, used by the admin forms.
+
+The change form holds the selected parent only; matching nodes are fetched
+page by page from cms_menu_node.views.view_parent_autocomplete.
+
+In the project's urls.py:
+
+    (r'^cms-menu-node/', include('cms_menu_node.urls')),
+
+Without that url (or with settings.CMS_ADMIN_PARENT_AUTOCOMPLETE = False), the
+admin forms keep the select box with every node.
+"""
+from django import forms
+from django.conf import settings
+from django.core.urlresolvers import reverse, NoReverseMatch
+from django.forms.util import flatatt
+from django.utils.html import escape, escapejs
+from django.utils.safestring import mark_safe
+
+AUTOCOMPLETE_URL_NAME = 'view_node_parent_autocomplete'
+
+AUTOCOMPLETE_SCRIPT = """<script type="text/javascript">
+(function($) {
+    var hidden = $('#%(id)s'), search = $('#%(id)s_search'), results = $('#%(id)s_results'), more = $('#%(id)s_more');
+    var page = 1, timer = null;
+    function load(append) {
+        $.getJSON('%(url)s', { q : search.val(), page : page, exclude : '%(exclude)s' }, function(data) {
+            if (!append) { results.empty(); }
+            $.each(data.results, function(i, r) { results.append($('<option></option>').val(r.id).text(r.text)); });
+            results.toggle(results.children().length > 0);
+            more.toggle(data.has_more);
+        });
+    }
+    search.bind('keyup', function() {
+        if (search.val() == '') { hidden.val(''); }
+        clearTimeout(timer);
+        timer = setTimeout(function() { page = 1; load(false); }, 250);
+    });
+    results.bind('change', function() {
+        hidden.val(results.val());
+        search.val(results.find('option:selected').text());
+    });
+    more.bind('click', function() { page += 1; load(true); return false; });
+})(django.jQuery);
+</script>"""
+
+
+def get_parent_autocomplete_url():
+    """The autocomplete url, or None if it's turned off or not in the urls"""
+    if not getattr(settings, 'CMS_ADMIN_PARENT_AUTOCOMPLETE', True):
+        return None
+    try:
+        return reverse(AUTOCOMPLETE_URL_NAME)
+    except NoReverseMatch:
+        return None
+
+
+class ParentAutocompleteWidget(forms.Widget):
+    """A hidden input with the parent id, a search box showing its breadcrumb
+    and a select box for the matches.  Renders with one query, whatever the tree size"""
+
+    def __init__(self, url, exclude_node_id=None, attrs=None):
+        super(ParentAutocompleteWidget, self).__init__(attrs)
+        self.url = url
+        self.exclude_node_id = exclude_node_id      # the node being edited
+
+    def get_label(self, value):
+        from cms_menu_node.models import Node
+
+        if value in (None, ''):
+            return ''
+        rows = Node.objects.filter(id=value).values_list('name', 'breadcrumb_path')
+        if len(rows) == 0:
+            return ''
+        name, breadcrumb_path = rows[0]
+        return breadcrumb_path or name
+
+    def render(self, name, value, attrs=None):
+        if value is None:
+            value = ''
+        final_attrs = self.build_attrs(attrs, type='hidden', name=name, value=value)
+        field_id = final_attrs.get('id', 'id_%s' % name)
+        final_attrs['id'] = field_id
+
+        html = [u'<input%s />' % flatatt(final_attrs)\
+            , u'<input type="text" id="%s_search" value="%s" size="60" autocomplete="off" />' % (field_id, escape(self.get_label(value)))\
+            , u'<br /><select id="%s_results" size="10" style="display:none;"></select>' % field_id\
+            , u'<a href="#" id="%s_more" style="display:none;">more</a>' % field_id\
+            , AUTOCOMPLETE_SCRIPT % { 'id' : field_id\
+                                    , 'url' : escapejs(self.url)\
+                                    , 'exclude' : escapejs(self.exclude_node_id or '') }\
+            ]
+        return mark_safe(u'\n'.join(html))
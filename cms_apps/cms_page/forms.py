@@ -1,6 +1,7 @@
 from django import forms
 from cms_page.models import Page, PageDirectLink, PageCustomView, PagePlaceHolder
 from cms_menu_node.models import Node
+from cms_menu_node.forms import set_parent_field
 
 from ckeditor.fields import CKEditorWidget
 
@@ -9,13 +10,13 @@ from verify_page_custom_views import get_list_of_all_urls
 
 class PageAdminForm(forms.ModelForm):
     """Admin Form for a Node
-    - Updates the parent choices to include indentations (displayed as a select box)
+    - Updates the parent choices to include indentations (displayed as a select box, or an autocomplete)
     - Checks to make sure the parent relationship is not circular
     - Some formatting of the parent Select box, and teaser TextBox
     """
     def __init__(self, *args, **kwargs):
         super(PageAdminForm, self).__init__(*args, **kwargs)
-        self.fields['parent'].choices = Node.get_admin_parent_choices()
+        set_parent_field(self)
         
         # If the root already exist, don't let people accidentally change it
         # This is for "regular" users once this thing is in production.
@@ -45,13 +46,13 @@ class PageAdminForm(forms.ModelForm):
 
 class PageCustomViewAdminForm(forms.ModelForm):
     """Admin Form for a Node
-    - Updates the parent choices to include indentations (displayed as a select box)
+    - Updates the parent choices to include indentations (displayed as a select box, or an autocomplete)
     - Checks to make sure the parent relationship is not circular
     - Some formatting of the parent Select box
     """
     def __init__(self, *args, **kwargs):
         super(PageCustomViewAdminForm, self).__init__(*args, **kwargs)
-        self.fields['parent'].choices = Node.get_admin_parent_choices()
+        set_parent_field(self)
 
 
     class Meta:
@@ -81,13 +82,13 @@ class PageCustomViewAdminForm(forms.ModelForm):
 
 class PageDirectLinkAdminForm(forms.ModelForm):
     """Admin Form for a Node
-    - Updates the parent choices to include indentations (displayed as a select box)
+    - Updates the parent choices to include indentations (displayed as a select box, or an autocomplete)
     - Checks to make sure the parent relationship is not circular
     - Some formatting of the parent Select box
     """
     def __init__(self, *args, **kwargs):
         super(PageDirectLinkAdminForm, self).__init__(*args, **kwargs)
-        self.fields['parent'].choices = Node.get_admin_parent_choices()
+        set_parent_field(self)
 
 
     class Meta:
@@ -110,13 +111,13 @@ class PageDirectLinkAdminForm(forms.ModelForm):
 
 class PagePlaceHolderAdminForm(forms.ModelForm):
     """Admin Form for a Node
-    - Updates the parent choices to include indentations (displayed as a select box)
+    - Updates the parent choices to include indentations (displayed as a select box, or an autocomplete)
     - Checks to make sure the parent relationship is not circular
     - Some formatting of the parent Select box
     """
     def __init__(self, *args, **kwargs):
         super(PagePlaceHolderAdminForm, self).__init__(*args, **kwargs)
-        self.fields['parent'].choices = Node.get_admin_parent_choices()
+        set_parent_field(self)
 
 
     class Meta:
@@ -4,14 +4,12 @@ from django.db import models
 from django.contrib.auth.models import User
 from django.core.urlresolvers import reverse
 from django.template.defaultfilters import slugify
-from django.db.models.signals import post_save     
 
 from django.conf import settings
 
 from cms_common.msg_util import *
 
-from cms_menu_node.models import Node
-from cms_menu_node.tree_builder import rebuild_tree_after_node_saved
+from cms_menu_node.models import Node     # post_save for each subclass is connected in cms_menu_node.models
 
 #from ckeditor.fields import RichTextField
 from django.contrib.sites.models import Site
@@ -123,6 +121,10 @@ class PageDirectLink(Node):
 
     def get_absolute_url(self):
         return self.direct_url
+        
+    def get_link_target(self):
+        """off site: open in a new window"""
+        return '_blank'
 
     def save(self, **kwargs):
         """For children, set the subclass_name here!"""      
@@ -189,7 +191,3 @@ class PageImage(models.Model):
         ordering = ('nickname', 'entry_time')
 
 
-post_save.connect(rebuild_tree_after_node_saved, sender=Page)
-post_save.connect(rebuild_tree_after_node_saved, sender=PageCustomView)
-post_save.connect(rebuild_tree_after_node_saved, sender=PageDirectLink)
-
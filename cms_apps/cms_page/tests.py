@@ -6,6 +6,16 @@ Replace these with more appropriate tests for your application.
 """
 
 from django.test import TestCase
+from django.conf.urls.defaults import patterns, url
+
+# URLs for Page.get_absolute_url(), used with "urls = 'cms_page.tests'"
+def page_view_for_tests(request, **kwargs):
+    pass
+    
+urlpatterns = patterns(''
+,    url(r'p/(?P<page_id>\d{1,7})/$', page_view_for_tests, name='view_page_by_id')
+,    url(r'p/(?P<page_slug>(-|\w|_){1,150})/$', page_view_for_tests, name='view_page_by_slug')
+)
 
 class SimpleTest(TestCase):
     def test_basic_addition(self):
@@ -14,6 +24,370 @@ class SimpleTest(TestCase):
         """
         self.failUnlessEqual(1 + 1, 2)
 
+
+class NodeSubclassSignalTest(TestCase):
+    """Saving any Node subclass updates the tree exactly once"""
+    fixtures = ['cms_menu_node_test_data.json']
+    
+    def setUp(self):
+        # count the tree updates the post_save handler actually runs
+        from cms_menu_node import tree_builder
+        self.tree_update_calls = []
+        self.original_update_tree_after_save = tree_builder.update_tree_after_save
+        
+        def counting_update_tree_after_save(NODE_CLASS, node, created=False, raw=False):
+            self.tree_update_calls.append(node.name)
+            return self.original_update_tree_after_save(NODE_CLASS, node, created, raw)
+        tree_builder.update_tree_after_save = counting_update_tree_after_save
+    
+    def tearDown(self):
+        from cms_menu_node import tree_builder
+        tree_builder.update_tree_after_save = self.original_update_tree_after_save
+    
+    def runTest(self):
+        from django.db.models.signals import post_save
+        from django.contrib.auth.models import User
+        from cms_menu_node.models import Node
+        from cms_page.models import Page, PageDirectLink, PagePlaceHolder
+        from cms_menu_node.tree_builder import connect_node_signals, rebuild_tree_after_node_saved, get_tree_update_stats
+        
+        connect_node_signals(Node)      # connecting again should not add a handler
+        # a second registration under another dispatch_uid: the handler runs twice per save
+        for sender in (Node, Page, PageDirectLink, PagePlaceHolder):
+            post_save.connect(rebuild_tree_after_node_saved, sender=sender, dispatch_uid='test-duplicate-tree-handler')
+        try:
+            meat = Node.objects.get(name='meat')
+            author = User.objects.create(username='author')
+            
+            for new_node in (Page(name='lamb', title='lamb', content='lamb', author=author, parent=meat)\
+                            , PageDirectLink(name='goat', direct_url='http://www.google.com', parent=meat)\
+                            , PagePlaceHolder(name='game', parent=meat)):
+                self.tree_update_calls = []
+                new_node.save()
+                self.assertEqual(self.tree_update_calls, [new_node.name])
+                self.assertEqual(Node.objects.get(name=new_node.name).menu_level, 3)
+            
+            # save again, nothing changed: the handler skips the tree update, once
+            self.tree_update_calls = []
+            num_skipped = get_tree_update_stats()['skipped']
+            Page.objects.get(name='lamb').save()
+            self.assertEqual(self.tree_update_calls, [])
+            self.assertEqual(get_tree_update_stats()['skipped'], num_skipped + 1)
+        finally:
+            for sender in (Node, Page, PageDirectLink, PagePlaceHolder):
+                post_save.disconnect(rebuild_tree_after_node_saved, sender=sender, dispatch_uid='test-duplicate-tree-handler')
+
+        self.assertEqual(Node.objects.get(name='meat').right_val - Node.objects.get(name='meat').left_val, 11)
+
+
+class MenuSubclassTest(TestCase):
+    """Menu items are replaced by their subclass (Page, PageDirectLink, etc) without extra queries"""
+    fixtures = ['cms_menu_node_test_data.json']
+    
+    def runTest(self):
+        from django.contrib.auth.models import User
+        from cms_menu_node.models import Node
+        from cms_page.models import Page, PageDirectLink, PagePlaceHolder
+        from cms_menu_builder.menu_builder import NodeProcessor, MenuBuilder
+        
+        meat = Node.objects.get(name='meat')
+        author = User.objects.create(username='author')
+        Page(name='lamb', title='lamb', content='lamb', author=author, parent=meat).save()
+        PageDirectLink(name='goat', direct_url='http://www.google.com', parent=meat).save()
+        PagePlaceHolder(name='game', parent=meat).save()
+        
+        # nodes and subclasses in one query
+        with self.assertNumQueries(1):
+            menu_items = NodeProcessor.add_node_subclasses(Node.objects.filter(visible=True).order_by('left_val'))
+        self.assertEqual(len(menu_items), Node.objects.filter(visible=True).count())
+        
+        subclass_lu = dict(map(lambda x: (x.name, x.__class__.__name__), menu_items))
+        self.assertEqual(subclass_lu['lamb'], 'Page')
+        self.assertEqual(subclass_lu['goat'], 'PageDirectLink')
+        self.assertEqual(subclass_lu['game'], 'PagePlaceHolder')
+        self.assertEqual(subclass_lu['meat'], 'Node')
+        
+        with self.assertNumQueries(0):
+            self.assertEqual(filter(lambda x: x.name == 'goat', menu_items)[0].get_absolute_url(), 'http://www.google.com')
+            
+        # a list of nodes: one more query for the subclasses
+        nodes = list(Node.objects.filter(parent=meat).order_by('left_val'))
+        active_path_ids = [meat.parent_id, meat.id]
+        with self.assertNumQueries(1):
+            menu_items = NodeProcessor.add_node_subclasses(nodes, active_path_ids)
+        subclass_lu = dict(map(lambda x: (x.name, x.__class__.__name__), menu_items))
+        self.assertEqual([subclass_lu['lamb'], subclass_lu['goat'], subclass_lu['game'], subclass_lu['beef']]\
+                        , ['Page', 'PageDirectLink', 'PagePlaceHolder', 'Node'])
+        self.assertEqual(filter(lambda x: x.active_branch, menu_items), menu_items)
+        
+        # selected "goat": menu, subclasses and breadcrumbs
+        goat = Node.objects.get(name='goat')
+        with self.assertNumQueries(2):
+            mb = MenuBuilder(selected_node=goat)
+        self.assertEqual(map(lambda x: x.__class__.__name__, mb.get_breadcrumb_nodes()), ['Node', 'Node', 'PageDirectLink'])
+        self.assertEqual(filter(lambda x: x.selected_node, mb.get_menu_items())[0].get_absolute_url(), 'http://www.google.com')
+
+
+class CompactMenuItemTest(TestCase):
+    """MenuBuilder(compact_menu_items=True): MenuItem objects with the same values as the Node/Page menu"""
+    fixtures = ['cms_menu_node_test_data.json']
+    urls = 'cms_page.tests'
+    
+    def runTest(self):
+        from django.contrib.auth.models import User
+        from cms_menu_node.models import Node
+        from cms_page.models import Page, PageDirectLink
+        from cms_menu_builder.menu_builder import MenuBuilder, MenuItem, MENU_ITEM_NODE_ATTRS, MENU_ITEM_FLAGS
+        
+        meat = Node.objects.get(name='meat')
+        author = User.objects.create(username='author')
+        Page(name='lamb', title='Lamb Recipes', content='lamb ' * 1000, author=author, parent=meat).save()
+        PageDirectLink(name='goat', direct_url='http://www.google.com', parent=meat).save()
+        lamb = Page.objects.get(name='lamb')
+        
+        for kwargs in ({}, { 'is_left_menu' : True }, { 'build_full_tree_to_level3' : True }):
+            mb = MenuBuilder(selected_node=lamb, **kwargs)
+            mb_compact = MenuBuilder(selected_node=lamb, compact_menu_items=True, **kwargs)
+            for items, compact_items in ((mb.get_menu_items(), mb_compact.get_menu_items())\
+                                        , (mb.get_breadcrumb_nodes(), mb_compact.get_breadcrumb_nodes())):
+                self.assertEqual(len(compact_items), len(items))
+                for item, compact_item in zip(items, compact_items):
+                    self.assertEqual(isinstance(compact_item, MenuItem), True)
+                    self.assertEqual(hasattr(compact_item, '__dict__'), False)     # __slots__ only
+                    for attr in MENU_ITEM_NODE_ATTRS:
+                        self.assertEqual(getattr(compact_item, attr), getattr(item, attr))
+                    for attr in MENU_ITEM_FLAGS:
+                        self.assertEqual(getattr(compact_item, attr), bool(getattr(item, attr, False)))
+                    self.assertEqual(compact_item.get_absolute_url(), item.get_absolute_url())
+                    self.assertEqual(unicode(compact_item), unicode(item))
+                    
+        lamb_item = filter(lambda x: x.selected_node, mb_compact.get_menu_items())[0]
+        self.assertEqual(unicode(lamb_item), 'Lamb Recipes')
+        self.assertEqual(lamb_item.breadcrumb(), lamb.breadcrumb())
+
+
+class MenuCacheTest(TestCase):
+    """Cached menus are reused until the tree version changes"""
+    fixtures = ['cms_menu_node_test_data.json']
+    urls = 'cms_page.tests'
+
+    def setUp(self):
+        from cms_menu_builder.menu_cache import clear_menu_cache
+        clear_menu_cache()      # the database is rolled back between tests, version numbers repeat
+
+    def runTest(self):
+        from django.contrib.auth.models import User
+        from cms_menu_node.models import Node
+        from cms_page.models import Page
+        from cms_menu_builder.menu_builder import MenuBuilder
+        from cms_menu_builder.menu_cache import get_cached_menu, LRUCache
+
+        meat = Node.objects.get(name='meat')
+        author = User.objects.create(username='author')
+        Page(name='lamb', title='Lamb Recipes', content='lamb', author=author, parent=meat).save()
+        lamb = Page.objects.get(name='lamb')
+
+        for kwargs in ({}, { 'is_left_menu' : True }, { 'build_full_tree_to_level3' : True }):
+            menu = get_cached_menu(selected_node=lamb, **kwargs)
+            with self.assertNumQueries(1):      # tree version check only
+                self.assertEqual(get_cached_menu(selected_node=lamb, **kwargs) is menu, True)
+
+            mb = MenuBuilder(selected_node=lamb, **kwargs)
+            self.assertEqual(map(unicode, menu.get_menu_items()), map(unicode, mb.get_menu_items()))
+            self.assertEqual(map(unicode, menu.get_breadcrumb_nodes()), map(unicode, mb.get_breadcrumb_nodes()))
+            self.assertEqual(unicode(menu.get_menu_item_on_active_path(2)), unicode(mb.get_menu_item_on_active_path(2)))
+            self.assertEqual(menu.get_breadcrumb_handler().get_last_breadcrumb_string()\
+                            , mb.get_breadcrumb_handler().get_last_breadcrumb_string())
+
+        # other options: another entry
+        menu = get_cached_menu(selected_node=lamb)
+        self.assertEqual(get_cached_menu(selected_node=lamb, include_root_node=False) is menu, False)
+
+        # a renamed node bumps the tree version: the menu is rebuilt
+        beef = Node.objects.get(name='beef')
+        beef.name = 'steak'
+        beef.save()
+        new_menu = get_cached_menu(selected_node=lamb)
+        self.assertEqual(new_menu is menu, False)
+        self.assertEqual('steak' in map(unicode, new_menu.get_menu_items()), True)
+
+        # breadcrumbs from the stored breadcrumb_path, no query
+        nodes = dict(map(lambda x: (x.id, x), Node.objects.filter(id__in=map(lambda x: x.id, new_menu.get_menu_items()))))
+        with self.assertNumQueries(0):
+            for item in new_menu.get_menu_items():
+                self.assertEqual(item.breadcrumb(), nodes[item.id].breadcrumb())
+                self.assertEqual(item.breadcrumb_without_leaf(), nodes[item.id].breadcrumb_without_leaf())
+        self.assertEqual(new_menu.get_breadcrumb_nodes()[-1].breadcrumb(), lamb.breadcrumb())
+
+        # pickled for the Django cache, protocol 0 for python-memcached
+        import pickle
+        for protocol in (0, 1, pickle.HIGHEST_PROTOCOL):
+            unpickled_menu = pickle.loads(pickle.dumps(new_menu, protocol))
+            self.assertEqual(map(unicode, unpickled_menu.get_menu_items()), map(unicode, new_menu.get_menu_items()))
+            self.assertEqual(map(lambda x: (x.id, x.url, x.active_path, x.selected_node), unpickled_menu.get_menu_items())\
+                            , map(lambda x: (x.id, x.url, x.active_path, x.selected_node), new_menu.get_menu_items()))
+            self.assertEqual(unicode(unpickled_menu.get_menu_item_on_active_path(2)), unicode(new_menu.get_menu_item_on_active_path(2)))
+
+            snapshot_items = MenuBuilder(selected_node=lamb, use_tree_snapshot=True).get_menu_items()
+            unpickled_items = pickle.loads(pickle.dumps(snapshot_items, protocol))
+            self.assertEqual(map(lambda x: (x.id, x.name, x.get_absolute_url()), unpickled_items)\
+                            , map(lambda x: (x.id, x.name, x.get_absolute_url()), snapshot_items))
+            self.assertEqual(unpickled_items[-1].breadcrumb(), snapshot_items[-1].breadcrumb())
+
+        # with the Django cache: clear_menu_cache() leaves the other entries alone
+        from django.core.cache import get_cache
+        from django.test.utils import override_settings
+        from cms_menu_node.tree_builder import get_tree_version_key
+        from cms_menu_builder.menu_cache import clear_menu_cache, get_menu_cache_key, get_backend_key
+        with override_settings(CMS_MENU_CACHE_BACKEND='default'):
+            backend_cache = get_cache('default')
+            backend_cache.set('other_app_key', 'kept')
+            clear_menu_cache()
+            menu = get_cached_menu(selected_node=lamb)
+            key = get_menu_cache_key({ 'selected_node' : lamb }, get_tree_version_key())
+            self.assertEqual(map(unicode, backend_cache.get(get_backend_key(backend_cache, key)).get_menu_items())\
+                            , map(unicode, menu.get_menu_items()))
+            clear_menu_cache()
+            self.assertEqual(backend_cache.get(get_backend_key(backend_cache, key)), None)
+            self.assertEqual(backend_cache.get('other_app_key'), 'kept')
+            self.assertEqual(get_cached_menu(selected_node=lamb) is menu, False)
+            clear_menu_cache()
+
+        # least recently used entries are dropped first
+        lru = LRUCache(2)
+        lru.set('a', 1)
+        lru.set('b', 2)
+        lru.get('a')
+        lru.set('c', 3)
+        self.assertEqual((lru.get('a'), lru.get('b'), lru.get('c')), (1, None, 3))
+
+
+class RequestMenusTest(TestCase):
+    """The top, left and level 3 menus of a request share one selected node, snapshot and breadcrumb trail"""
+    fixtures = ['cms_menu_node_test_data.json']
+    urls = 'cms_page.tests'
+
+    def setUp(self):
+        from cms_menu_node.tree_snapshot import clear_tree_snapshot
+        clear_tree_snapshot()
+
+    def runTest(self):
+        from django.test.client import RequestFactory
+        from django.template import Template, Context
+        from cms_menu_node.models import Node
+        from cms_menu_node.tree_snapshot import get_tree_snapshot
+        from cms_menu_builder.menu_builder import MenuBuilder
+        from cms_menu_builder.middleware import RequestMenusMiddleware
+
+        get_tree_snapshot()     # loaded by an earlier request
+        papaya = Node.objects.get(name='papaya')
+
+        request = RequestFactory().get('/p/papaya/')
+        RequestMenusMiddleware().process_view(request, page_view_for_tests, (), { 'page_slug' : 'papaya' })
+
+        # selected node + tree version check, for all of the menus
+        template = Template('{% load cms_menu_tags %}{% get_top_menu as top_menu %}{% get_left_menu as left_menu %}'\
+                        + '{% get_level3_menu as level3_menu %}{% get_breadcrumbs as breadcrumbs %}'\
+                        + '{% for item in top_menu.get_menu_items %}{{ item.name }},{% endfor %}|'\
+                        + '{% for item in left_menu.get_menu_items %}{{ item.name }},{% endfor %}|'\
+                        + '{% for item in breadcrumbs.get_breadcrumbs %}{{ item.name }},{% endfor %}')
+        with self.assertNumQueries(2):
+            html = template.render(Context({ 'request' : request }))
+        menus = request.cms_menus
+        self.assertEqual(menus.get_selected_node().id, papaya.id)
+
+        def get_names(items):
+            return ','.join(map(lambda x: x.name, items)) + ','
+        self.assertEqual(html, '|'.join((get_names(MenuBuilder(selected_node=papaya).get_menu_items())\
+                                , get_names(MenuBuilder(selected_node=papaya, is_left_menu=True).get_menu_items())\
+                                , get_names(MenuBuilder(selected_node=papaya).get_breadcrumb_nodes()))))
+
+        # the menus reuse the breadcrumb trail
+        mb = MenuBuilder(selected_node=papaya, build_full_tree_to_level3=True)
+        self.assertEqual(get_names(menus.get_level3_menu().get_menu_items()), get_names(mb.get_menu_items()))
+        self.assertEqual(menus.get_active_path_ids(), mb.active_path_ids)
+        for menu in (menus.get_top_menu(), menus.get_left_menu(), menus.get_level3_menu()):
+            self.assertEqual(menu.breadcrumb_source is menus.get_path_builder(), True)
+            self.assertEqual(menu.active_path_ids, menus.get_active_path_ids())
+
+
+class NodeLinkTest(TestCase):
+    """Node.cached_url and Node.link_target: menu links without the subclass rows"""
+    fixtures = ['cms_menu_node_test_data.json']
+    urls = 'cms_page.tests'
+
+    def setUp(self):
+        from cms_menu_node.tree_snapshot import clear_tree_snapshot
+        clear_tree_snapshot()
+
+    def get_link(self, name):
+        from cms_menu_node.models import Node
+        return tuple(Node.objects.filter(name=name).values_list('cached_url', 'link_target')[0])
+
+    def runTest(self):
+        from django.contrib.auth.models import User
+        from cms_menu_node.models import Node
+        from cms_menu_node.tree_builder import get_tree_version
+        from cms_menu_node.node_links import refresh_node_links
+        from cms_page.models import Page, PageDirectLink, PagePlaceHolder
+        from cms_menu_builder.menu_builder import MenuBuilder
+
+        meat = Node.objects.get(name='meat')
+        author = User.objects.create(username='author')
+        Page(name='lamb', title='Lamb Recipes', content='lamb', author=author, parent=meat).save()
+        PageDirectLink(name='goat', direct_url='http://www.google.com', parent=meat).save()
+        PagePlaceHolder(name='game', parent=meat).save()
+
+        # links are stored on save
+        self.assertEqual(self.get_link('lamb'), ('/p/lamb/', ''))
+        self.assertEqual(self.get_link('goat'), ('http://www.google.com', '_blank'))
+        self.assertEqual(self.get_link('game'), ('#', ''))
+        self.assertEqual(self.get_link('meat'), ('', ''))
+        self.assertEqual(Node.objects.get(name='lamb').menu_label, 'Lamb Recipes')
+        self.assertEqual(Node.objects.get(name='meat').menu_label, '')
+
+        # renamed as a Page or as a Node
+        lamb = Page.objects.get(name='lamb')
+        lamb.name = 'lamb chops'
+        lamb.save()
+        self.assertEqual(self.get_link('lamb chops'), ('/p/lamb-chops/', ''))
+        lamb_node = Node.objects.get(name='lamb chops')
+        self.assertEqual(lamb_node.get_subclass_obj().__class__, Page)
+        lamb_node.name = 'lamb stew'
+        lamb_node.save()
+        self.assertEqual(self.get_link('lamb stew'), ('/p/lamb-stew/', ''))
+
+        # menus from Node rows only
+        goat = Node.objects.get(name='goat')
+        with self.assertNumQueries(2):
+            mb = MenuBuilder(selected_node=goat, join_subclasses=False)
+        with self.assertNumQueries(0):
+            self.assertEqual(set(map(lambda x: x.__class__, mb.get_menu_items())), set([Node]))
+            goat_item = filter(lambda x: x.selected_node, mb.get_menu_items())[0]
+            self.assertEqual((goat_item.get_absolute_url(), goat_item.link_target), ('http://www.google.com', '_blank'))
+
+        mb = MenuBuilder(selected_node=goat, use_tree_snapshot=True)
+        with self.assertNumQueries(0):
+            urls = dict(map(lambda x: (x.name, x.get_absolute_url()), mb.get_menu_items()))
+        self.assertEqual((urls['lamb stew'], urls['goat'], urls['game']), ('/p/lamb-stew/', 'http://www.google.com', '#'))
+
+        # the menu label follows the Page title
+        lamb = Page.objects.get(name='lamb stew')
+        lamb.title = 'Lamb Stew Recipes'
+        lamb.save()
+        mb = MenuBuilder(selected_node=goat, use_tree_snapshot=True)
+        self.assertEqual('Lamb Stew Recipes' in map(unicode, mb.get_menu_items()), True)
+
+        # bulk refresh, e.g. after a URL conf change
+        Node.objects.all().update(cached_url='', link_target='')
+        version = get_tree_version()
+        self.assertEqual(refresh_node_links(missing_only=True), 3)
+        self.assertEqual(get_tree_version(), version + 1)
+        self.assertEqual(self.get_link('goat'), ('http://www.google.com', '_blank'))
+        self.assertEqual(refresh_node_links(), 0)
+        self.assertEqual(get_tree_version(), version + 1)
+
+
 __test__ = {"doctest": """
 Another way to test that 1 + 1 is equal to 2.
 
@@ -4,7 +4,7 @@ from django.shortcuts import render_to_response
 
 from cms_menu_node.models import Node
 from cms_page.models import Page
-from cms_menu_builder.menu_builder import build_menu
+from cms_menu_builder.request_menus import get_request_menus
 
 
 def view_cms_page_by_id(request, page_id):
@@ -15,10 +15,12 @@ def view_cms_page_by_id(request, page_id):
     except DoesNotExist:
         return render_to_response(page.template, lu, context_instance=RequestContext(request))
     
-    nodes = build_menu(Node.objects.select_related('parent').filter(visible=True).order_by('left_val', 'right_val'))
+    # top, left and level 3 menus share one breadcrumb/active path, see cms_menu_builder/request_menus.py
+    menus = get_request_menus(request, selected_node=page)
     
     lu.update({'page': page \
-            , 'nodes' : nodes
+            , 'menus' : menus \
+            , 'nodes' : menus.get_top_menu().get_menu_items()
             #, 'nodes' : Node.objects.select_related('parent').filter(visible=True).order_by('left_val', 'right_val')
     })
 